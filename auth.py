@@ -1,8 +1,6 @@
-from argon2 import PasswordHasher
 from sqlalchemy import text
 from database import engine
-
-ph = PasswordHasher()
+from services.password_service import verify_password
 
 def authenticate_admin(username: str, password: str) -> bool:
     with engine.connect() as conn:
@@ -14,13 +12,8 @@ def authenticate_admin(username: str, password: str) -> bool:
             {"username": username}
         ).fetchone()
 
-        if not result:
-            return False
-
-        stored_hash = result[0]
+    if not result:
+        return False
 
-        try:
-            ph.verify(stored_hash, password)
-            return True
-        except Exception:
-            return False
+    # verify after releasing the connection; hashing is the slow part
+    return verify_password(password, result[0])
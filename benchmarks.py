@@ -0,0 +1,402 @@
+"""
+Microbenchmarks for the wallet, betting and engine hot paths.
+
+Measures ops/sec and per-op latency for credit_wallet, debit_wallet,
+place_bet, get_current_round and the per-tick body of run_multiplier,
+under configurable contention (one shared wallet vs a wallet per thread,
+0 vs N active bets in the round). Results are written as JSON so runs
+from different commits can be compared.
+
+Usage:
+    DATABASE_URL=postgresql://... python benchmarks.py run --out before.json
+    python benchmarks.py run --only tick --out tick.json      # no queries
+    python benchmarks.py compare before.json after.json
+
+The database benchmarks insert users 25478xxxxxxx and an 'open' round,
+so point them at a throwaway database with the server stopped.
+"""
+
+import argparse
+import json
+import math
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+
+PHONE_PREFIX = "25478"
+BENCH_BALANCE = 1_000_000_000
+
+
+# -------------------
+# MEASUREMENT
+# -------------------
+def percentile(values, q):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def measure(op, threads: int, ops_per_thread: int, warmup: int = 10):
+    """
+    Runs op(thread_index) ops_per_thread times on each of threads threads
+    and returns throughput and latency figures.
+    """
+    for _ in range(warmup):
+        op(0)
+
+    latencies = [[] for _ in range(threads)]
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(index):
+        timings = latencies[index]
+        barrier.wait()
+        for _ in range(ops_per_thread):
+            started = time.perf_counter()
+            op(index)
+            timings.append(time.perf_counter() - started)
+
+    workers = [
+        threading.Thread(target=worker, args=(i,), daemon=True)
+        for i in range(threads)
+    ]
+    for thread in workers:
+        thread.start()
+
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    samples = sorted(t for timings in latencies for t in timings)
+    return {
+        "ops": len(samples),
+        "seconds": elapsed,
+        "ops_per_sec": len(samples) / elapsed if elapsed else 0.0,
+        "p50_us": percentile(samples, 0.50) * 1e6,
+        "p95_us": percentile(samples, 0.95) * 1e6,
+        "p99_us": percentile(samples, 0.99) * 1e6,
+        "max_us": samples[-1] * 1e6 if samples else 0.0,
+    }
+
+
+# -------------------
+# FIXTURES
+# -------------------
+def seed_wallets(count: int):
+    from sqlalchemy import text
+    from database import engine
+
+    phones = [f"{PHONE_PREFIX}{i:07d}" for i in range(count)]
+    with engine.begin() as conn:
+        rows = conn.execute(
+            text("""
+                WITH new_users AS (
+                    INSERT INTO users (phone, password_hash)
+                    SELECT phone, 'benchmark' FROM unnest(CAST(:phones AS TEXT[])) AS phone
+                    ON CONFLICT (phone) DO UPDATE SET phone = EXCLUDED.phone
+                    RETURNING id
+                )
+                INSERT INTO wallets (user_id, balance)
+                SELECT id, :b FROM new_users
+                ON CONFLICT (user_id) DO UPDATE
+                SET balance = EXCLUDED.balance, locked_balance = 0
+                RETURNING user_id
+            """),
+            {"phones": phones, "b": BENCH_BALANCE}
+        ).fetchall()
+
+    return sorted(row[0] for row in rows)
+
+
+def open_bench_round(user_ids, active_bets: int):
+    """Opens a round holding active_bets bets spread over user_ids."""
+    from sqlalchemy import text
+    from database import engine
+
+    with engine.begin() as conn:
+        conn.execute(text("""
+            UPDATE game_rounds SET status = 'closed', ended_at = COALESCE(ended_at, NOW())
+            WHERE status IN ('open', 'running')
+        """))
+
+        round_id = conn.execute(text("""
+            INSERT INTO game_rounds (crash_point, status, betting_close_at, created_at)
+            VALUES (20.00, 'open', NOW() + INTERVAL '1 hour', NOW())
+            RETURNING id
+        """)).scalar_one()
+
+        if active_bets:
+            conn.execute(
+                text("""
+                    INSERT INTO bets (user_id, round_id, bet_amount, auto_cashout, status)
+                    SELECT (CAST(:users AS BIGINT[]))[1 + i % :n], :r, 100,
+                        CAST(1.1 + random() * 5 AS NUMERIC(6,2)), 'active'
+                    FROM generate_series(0, :count - 1) AS i
+                """),
+                {"users": user_ids, "n": len(user_ids), "r": round_id, "count": active_bets}
+            )
+
+    return round_id
+
+
+def close_bench_round(round_id: int):
+    from sqlalchemy import text
+    from database import engine
+
+    with engine.begin() as conn:
+        conn.execute(
+            text("UPDATE game_rounds SET status = 'closed', ended_at = NOW() WHERE id = :r"),
+            {"r": round_id}
+        )
+
+
+def pick_wallet(user_ids, contention: str):
+    if contention == "same":
+        return lambda index: user_ids[0]
+    return lambda index: user_ids[index]
+
+
+# -------------------
+# BENCHMARKS
+# -------------------
+def bench_wallet(args, user_ids):
+    from services.settings_service import get_settings
+    from services.wallet_service import credit_wallet, debit_wallet
+
+    settings = get_settings()
+    results = []
+
+    for contention in args.contention:
+        wallet = pick_wallet(user_ids, contention)
+        params = {"threads": args.threads, "contention": contention}
+
+        if settings["deposit_enabled"]:
+            amount = max(1.0, settings["min_deposit"])
+            results.append(("credit_wallet", params, measure(
+                lambda i: credit_wallet(wallet(i), amount, "bench", "bench"),
+                args.threads, args.ops,
+            )))
+
+        if settings["withdraw_enabled"]:
+            amount = max(1.0, settings["min_withdraw"])
+            results.append(("debit_wallet", params, measure(
+                lambda i: debit_wallet(wallet(i), amount, "bench", "bench"),
+                args.threads, args.ops,
+            )))
+
+    return results
+
+
+def bench_round(args, user_ids):
+    from services.aviator_service import get_current_round
+    from services.bet_service import place_bet
+    from services.settings_service import get_settings
+
+    settings = get_settings()
+    stake = max(1.0, settings["min_withdraw"])
+    results = []
+
+    for active_bets in args.active_bets:
+        round_id = open_bench_round(user_ids, active_bets)
+        try:
+            params = {"threads": args.threads, "active_bets": active_bets}
+            results.append(("get_current_round", params, measure(
+                lambda i: get_current_round(), args.threads, args.ops,
+            )))
+
+            if settings["withdraw_enabled"]:
+                for contention in args.contention:
+                    wallet = pick_wallet(user_ids, contention)
+                    results.append((
+                        "place_bet",
+                        {**params, "contention": contention},
+                        measure(
+                            lambda i: place_bet(wallet(i), stake, 2.0),
+                            args.threads, args.ops,
+                        ),
+                    ))
+        finally:
+            close_bench_round(round_id)
+
+    return results
+
+
+def bench_tick(args, _user_ids=None):
+    """One engine tick: order book advance, payouts and the broadcast."""
+    from services.broadcast_service import broadcaster
+    from services.multiplier_service import (
+        TICK_SECONDS,
+        _payouts,
+        crash_elapsed,
+        multiplier_at,
+    )
+    from services.order_book import RoundOrderBook
+
+    rng = random.Random(1)
+    results = []
+
+    for active_bets in args.active_bets:
+        rows = [
+            (i, i % 1000, 100.0, round(rng.uniform(1.1, 20.0), 2) if i % 5 else None)
+            for i in range(active_bets)
+        ]
+        ticks_per_round = math.ceil(crash_elapsed(20.0) / TICK_SECONDS)
+        rounds = max(1, args.ops // ticks_per_round)
+
+        books = [RoundOrderBook(1, rows) for _ in range(rounds)]
+        state = {"book": 0, "tick": 0}
+
+        def tick(_index):
+            book = books[state["book"]]
+            state["tick"] += 1
+            multiplier = multiplier_at(state["tick"] * TICK_SECONDS)
+
+            broadcaster.publish("tick", round_id=1, multiplier=multiplier)
+            _payouts(book.advance(multiplier) + book.drain_cashouts())
+
+            if state["tick"] >= ticks_per_round:
+                state["book"] = (state["book"] + 1) % len(books)
+                state["tick"] = 0
+
+        results.append((
+            "engine_tick",
+            {"active_bets": active_bets},
+            measure(tick, 1, rounds * ticks_per_round, warmup=0),
+        ))
+
+    return results
+
+
+BENCHMARKS = {
+    "wallet": bench_wallet,
+    "round": bench_round,
+    "tick": bench_tick,
+}
+DATABASE_BENCHMARKS = {"wallet", "round"}
+
+
+# -------------------
+# CLI
+# -------------------
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_key(entry):
+    params = ",".join(f"{k}={v}" for k, v in sorted(entry["params"].items()))
+    return f"{entry['name']}[{params}]"
+
+
+def run(args):
+    names = args.only or list(BENCHMARKS)
+    user_ids = None
+    if DATABASE_BENCHMARKS.intersection(names):
+        user_ids = seed_wallets(max(args.threads, 1000))
+
+    results = []
+    for name in names:
+        for bench, params, figures in BENCHMARKS[name](args, user_ids):
+            entry = {"name": bench, "params": params, **figures}
+            results.append(entry)
+            print(
+                f"{result_key(entry):<60} {entry['ops_per_sec']:>10.0f} ops/s  "
+                f"p50 {entry['p50_us']:>9.1f}us  p99 {entry['p99_us']:>9.1f}us",
+                file=sys.stderr,
+            )
+
+    report = {
+        "commit": git_commit(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "settings": {
+            "threads": args.threads,
+            "ops": args.ops,
+            "contention": args.contention,
+            "active_bets": args.active_bets,
+        },
+        "results": results,
+    }
+
+    if args.out:
+        with open(args.out, "w") as handle:
+            json.dump(report, handle, indent=2)
+    return report
+
+
+def compare(args):
+    with open(args.base) as handle:
+        base = json.load(handle)
+    with open(args.head) as handle:
+        head = json.load(handle)
+
+    base_results = {result_key(entry): entry for entry in base["results"]}
+    print(f"{'benchmark':<60}{'base ops/s':>12}{'head ops/s':>12}{'change':>9}"
+          f"{'p99 base':>11}{'p99 head':>11}")
+
+    regressions = 0
+    for entry in head["results"]:
+        key = result_key(entry)
+        old = base_results.get(key)
+        if old is None:
+            print(f"{key:<60}{'-':>12}{entry['ops_per_sec']:>12.0f}")
+            continue
+
+        change = entry["ops_per_sec"] / old["ops_per_sec"] - 1 if old["ops_per_sec"] else 0.0
+        flag = ""
+        if change < -args.threshold:
+            regressions += 1
+            flag = "  REGRESSION"
+
+        print(
+            f"{key:<60}{old['ops_per_sec']:>12.0f}{entry['ops_per_sec']:>12.0f}"
+            f"{change * 100:>8.1f}%{old['p99_us']:>10.0f}u{entry['p99_us']:>10.0f}u{flag}"
+        )
+
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run benchmarks")
+    run_parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS))
+    run_parser.add_argument("--threads", type=int, default=8)
+    run_parser.add_argument("--ops", type=int, default=500, help="ops per thread")
+    run_parser.add_argument(
+        "--contention", nargs="+", choices=["same", "distinct"],
+        default=["same", "distinct"],
+    )
+    run_parser.add_argument("--active-bets", type=int, nargs="+", default=[0, 10000])
+    run_parser.add_argument("--out", help="write results as JSON")
+
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("head")
+    compare_parser.add_argument(
+        "--threshold", type=float, default=0.10,
+        help="flag throughput drops larger than this fraction",
+    )
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        run(args)
+    else:
+        sys.exit(compare(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,16 @@
+import asyncio
 import os
+import re
+import threading
+import time
+import weakref
+from datetime import datetime, timezone
 from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
 from sqlalchemy.orm import sessionmaker, declarative_base
 from dotenv import load_dotenv
-from passlib.context import CryptContext
 
 # Load .env locally (Render ignores this safely)
 load_dotenv()
@@ -12,11 +20,263 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise RuntimeError("DATABASE_URL is not set")
 
-engine = create_engine(
-    DATABASE_URL,
-    pool_pre_ping=True,
+
+# -------------------
+# CONNECTION POOL
+# -------------------
+class PoolWaitStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def record(self, seconds: float, timed_out: bool = False):
+        with self._lock:
+            self.checkouts += 1
+            self.timeouts += timed_out
+            self.wait_seconds += seconds
+            if seconds > self.max_wait_seconds:
+                self.max_wait_seconds = seconds
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_seconds": self.wait_seconds,
+                "max_wait_seconds": self.max_wait_seconds,
+            }
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waits."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_stats = PoolWaitStats()
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except Exception:
+            self.wait_stats.record(time.perf_counter() - started, timed_out=True)
+            raise
+        self.wait_stats.record(time.perf_counter() - started)
+        return connection
+
+    def recreate(self):
+        # engine.dispose() swaps in a new pool; keep the counters
+        pool = super().recreate()
+        pool.wait_stats = self.wait_stats
+        return pool
+
+
+class TimedAsyncQueuePool(TimedQueuePool, AsyncAdaptedQueuePool):
+    """TimedQueuePool for asyncio engines."""
+
+
+def pool_stats(db_engine):
+    pool = getattr(db_engine, "sync_engine", db_engine).pool
+    capacity = pool.size() + max(pool._max_overflow, 0)
+    stats = {
+        "size": pool.size(),
+        "capacity": capacity,
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "utilisation": pool.checkedout() / capacity if capacity else 0.0,
+    }
+    if isinstance(pool, TimedQueuePool):
+        stats.update(pool.wait_stats.snapshot())
+    return stats
+
+
+# -------------------
+# NAMED ENGINES
+# -------------------
+# Each workload gets its own pool so one can't starve another:
+#   api    - request handlers
+#   game   - the round loop, settlement and the bet flusher; never
+#            shares connections with HTTP traffic
+#   worker - payout queue and partition maintenance
+# Every setting can be overridden as DB_<NAME>_<SETTING>, e.g.
+# DB_GAME_POOL_SIZE=6. statement_timeout is in milliseconds, 0 = none.
+#
+# The defaults fit a budget of 24 primary connections per process at
+# peak: api 4+2, async 5+5, game 2+1 and worker 2+0, plus three
+# dedicated sessions (LISTEN, the engine leader lock and the NOTIFY
+# relay). Four workers then stay within Postgres' default
+# max_connections=100. read points at the replica and is not counted.
+POOL_DEFAULTS = {
+    "api": {
+        "pool_size": 4, "max_overflow": 2, "pool_timeout": 10,
+        "pool_recycle": 1800, "statement_timeout": 10000,
+    },
+    "game": {
+        "pool_size": 2, "max_overflow": 1, "pool_timeout": 5,
+        "pool_recycle": 1800, "statement_timeout": 30000,
+    },
+    "worker": {
+        "pool_size": 2, "max_overflow": 0, "pool_timeout": 30,
+        "pool_recycle": 1800, "statement_timeout": 0,
+    },
+    "read": {
+        "pool_size": 5, "max_overflow": 5, "pool_timeout": 10,
+        "pool_recycle": 1800, "statement_timeout": 10000,
+    },
+    "async": {
+        "pool_size": 5, "max_overflow": 5, "pool_timeout": 10,
+        "pool_recycle": 1800, "statement_timeout": 10000,
+    },
+}
+
+
+def pool_config(name: str):
+    config = {}
+    for setting, default in POOL_DEFAULTS[name].items():
+        value = os.getenv(f"DB_{name.upper()}_{setting.upper()}")
+        config[setting] = type(default)(value) if value else default
+    return config
+
+
+def create_named_engine(name: str, url: str):
+    config = pool_config(name)
+    connect_args = {}
+    if config["statement_timeout"]:
+        connect_args["options"] = f"-c statement_timeout={config['statement_timeout']}"
+
+    return create_engine(
+        url,
+        pool_pre_ping=True,
+        poolclass=TimedQueuePool,
+        pool_size=config["pool_size"],
+        max_overflow=config["max_overflow"],
+        pool_timeout=config["pool_timeout"],
+        pool_recycle=config["pool_recycle"],
+        connect_args=connect_args,
+    )
+
+
+engine_api = create_named_engine("api", DATABASE_URL)
+engine_game = create_named_engine("game", DATABASE_URL)
+engine_worker = create_named_engine("worker", DATABASE_URL)
+
+# request-path services use the API pool under its original name
+engine = engine_api
+
+# Optional read-only engine (e.g. a replica) for hot reads that tolerate
+# a little lag; falls back to the primary
+DATABASE_READ_URL = os.getenv("DATABASE_READ_URL")
+
+read_engine = (
+    create_named_engine("read", DATABASE_READ_URL)
+    if DATABASE_READ_URL
+    else engine
+)
+
+ENGINES = {"api": engine_api, "game": engine_game, "worker": engine_worker}
+if read_engine is not engine:
+    ENGINES["read"] = read_engine
+
+
+# -------------------
+# ASYNC ENGINES
+# -------------------
+# asyncpg engines for async endpoints: a request waiting on the
+# database holds a coroutine, not a threadpool thread. The sync engines
+# above stay in use by the game engine, workers and scripts. Configured
+# as DB_ASYNC_* (see POOL_DEFAULTS).
+
+
+def async_database_url(url: str):
+    """Rewrites a libpq URL for asyncpg, which spells sslmode as ssl."""
+    parsed = make_url(url).set(drivername="postgresql+asyncpg")
+    query = dict(parsed.query)
+    if "sslmode" in query:
+        query["ssl"] = query.pop("sslmode")
+    return parsed.set(query=query)
+
+
+class AsyncEngines:
+    """
+    One AsyncEngine per event loop. asyncpg connections belong to the
+    loop that opened them; the server runs one loop per process, but
+    TestClient starts a new loop for every request. Only the loop passed
+    to serve() gets a pool; other loops close each connection on release
+    so a finished loop leaves nothing open.
+    """
+
+    def __init__(self, url: str):
+        self.url = async_database_url(url)
+        self._lock = threading.Lock()
+        self._engines = weakref.WeakKeyDictionary()
+        self._server_loop = None
+
+    def serve(self):
+        """Pool connections for the running loop (the server's)."""
+        with self._lock:
+            self._server_loop = weakref.ref(asyncio.get_running_loop())
+
+    def get(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            db_engine = self._engines.get(loop)
+            if db_engine is None:
+                config = pool_config("async")
+                server_settings = {}
+                if config["statement_timeout"]:
+                    server_settings["statement_timeout"] = str(config["statement_timeout"])
+
+                if self._server_loop is not None and self._server_loop() is loop:
+                    pool_args = dict(
+                        poolclass=TimedAsyncQueuePool,
+                        pool_size=config["pool_size"],
+                        max_overflow=config["max_overflow"],
+                        pool_timeout=config["pool_timeout"],
+                        pool_recycle=config["pool_recycle"],
+                    )
+                else:
+                    pool_args = dict(poolclass=NullPool)
+
+                db_engine = create_async_engine(
+                    self.url,
+                    pool_pre_ping=True,
+                    connect_args={"server_settings": server_settings},
+                    **pool_args,
+                )
+                self._engines[loop] = db_engine
+            return db_engine
+
+    def current(self):
+        """The server loop's pooled engine, if it has one, for stats."""
+        with self._lock:
+            loop = self._server_loop() if self._server_loop is not None else None
+            db_engine = self._engines.get(loop) if loop is not None else None
+            return [db_engine] if db_engine is not None else []
+
+    async def dispose(self):
+        with self._lock:
+            db_engine = self._engines.pop(asyncio.get_running_loop(), None)
+        if db_engine is not None:
+            await db_engine.dispose()
+
+
+async_engines = AsyncEngines(DATABASE_URL)
+async_read_engines = (
+    AsyncEngines(DATABASE_READ_URL) if DATABASE_READ_URL else async_engines
 )
 
+
+def async_engine():
+    return async_engines.get()
+
+
+def async_read_engine():
+    return async_read_engines.get()
+
+
 SessionLocal = sessionmaker(
     autocommit=False,
     autoflush=False,
@@ -25,11 +285,185 @@ SessionLocal = sessionmaker(
 
 Base = declarative_base()
 
-pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
+
+# -------------------
+# PARTITIONED LEDGER TABLES
+# -------------------
+# bets and transactions are append-heavy, so they are range partitioned
+# by month on created_at. Old months can then be detached and archived
+# (see services/partition_service.py) instead of deleted row by row.
+PARTITIONED_TABLES = ("bets", "transactions")
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+
+# pg_advisory_xact_lock key held while the schema is migrated
+SCHEMA_LOCK_KEY = 0x534348454D41
+
+BETS_COLUMNS = """
+    user_id BIGINT NOT NULL REFERENCES users(id),
+    round_id BIGINT NOT NULL REFERENCES game_rounds(id),
+    bet_amount NUMERIC(10,2) NOT NULL,
+    cashout_multiplier NUMERIC(6,2),
+    auto_cashout NUMERIC(6,2),
+    payout NUMERIC(12,2) DEFAULT 0.00,
+    status VARCHAR(20) DEFAULT 'active',
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (id, created_at)
+"""
+
+TRANSACTIONS_COLUMNS = """
+    user_id BIGINT NOT NULL REFERENCES users(id),
+    type VARCHAR(20) NOT NULL,
+    amount NUMERIC(12,2) NOT NULL,
+    balance_before NUMERIC(12,2) DEFAULT 0.00,
+    balance_after NUMERIC(12,2) DEFAULT 0.00,
+    status VARCHAR(20) DEFAULT 'completed',
+    reference VARCHAR(100),
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (id, created_at)
+"""
+
+_BOUND_RE = re.compile(r"FROM \((.+?)\) TO \((.+?)\)")
+
+
+def month_start(moment: datetime | None = None):
+    moment = moment or datetime.now(timezone.utc)
+    return datetime(moment.year, moment.month, 1, tzinfo=timezone.utc)
+
+
+def add_months(moment: datetime, months: int):
+    index = moment.year * 12 + moment.month - 1 + months
+    return moment.replace(year=index // 12, month=index % 12 + 1)
+
+
+def _parse_bound(value: str):
+    if value in ("MINVALUE", "MAXVALUE"):
+        return None
+    return datetime.fromisoformat(value.strip("'")).astimezone(timezone.utc)
+
+
+def list_partitions(conn, table: str):
+    """Returns (name, lower, upper) per partition; None is unbounded."""
+    rows = conn.execute(
+        text("""
+            SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = CAST(:t AS regclass)
+            ORDER BY c.relname
+        """),
+        {"t": table}
+    ).fetchall()
+
+    partitions = []
+    for name, bound in rows:
+        match = _BOUND_RE.search(bound)
+        if match:
+            partitions.append(
+                (name, _parse_bound(match.group(1)), _parse_bound(match.group(2)))
+            )
+
+    return partitions
+
+
+def migrate_to_partitioned(conn, table: str, columns: str):
+    relkind = conn.execute(
+        text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:t)"),
+        {"t": table}
+    ).scalar()
+
+    if relkind != "r":
+        return
+
+    # the old heap keeps every existing row and covers up to next month
+    legacy = f"{table}_legacy"
+    boundary = add_months(month_start(), 1)
+
+    conn.execute(text(f"ALTER TABLE {table} RENAME TO {legacy}"))
+    conn.execute(text(
+        f"ALTER TABLE {legacy} RENAME CONSTRAINT {table}_pkey TO {legacy}_pkey"
+    ))
+    for index in (f"{table}_user_id_idx", f"{table}_round_id_idx"):
+        conn.execute(text(
+            f"ALTER INDEX IF EXISTS {index} RENAME TO {legacy}_{index[len(table) + 1:]}"
+        ))
+
+    conn.execute(text(f"""
+        CREATE TABLE {table} (
+            id BIGINT NOT NULL DEFAULT nextval('{table}_id_seq'),
+            {columns}
+        ) PARTITION BY RANGE (created_at)
+    """))
+    conn.execute(text(f"ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id"))
+    conn.execute(text(f"""
+        ALTER TABLE {table} ATTACH PARTITION {legacy}
+        FOR VALUES FROM (MINVALUE) TO ('{boundary.isoformat()}')
+    """))
+
+
+def create_month_partition(conn, table: str, start: datetime):
+    name = f"{table}_p{start:%Y_%m}"
+    following = add_months(start, 1)
+
+    # built detached so rows that fell into the default partition while
+    # this month was missing can be moved over before it is attached
+    conn.execute(text(f"""
+        CREATE TABLE {name}
+        (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+    """))
+    conn.execute(
+        text(f"""
+            WITH moved AS (
+                DELETE FROM {table}_default
+                WHERE created_at >= :s AND created_at < :e
+                RETURNING *
+            )
+            INSERT INTO {name} SELECT * FROM moved
+        """),
+        {"s": start, "e": following}
+    )
+    conn.execute(text(f"""
+        ALTER TABLE {table} ATTACH PARTITION {name}
+        FOR VALUES FROM ('{start.isoformat()}') TO ('{following.isoformat()}')
+    """))
+
+
+def ensure_partitions(conn, months_ahead: int = PARTITION_MONTHS_AHEAD):
+    """
+    Creates monthly partitions up to months_ahead past the current month.
+    Each table also gets a DEFAULT partition, so inserts keep working if
+    maintenance falls behind; its rows move out when their month is
+    created.
+    """
+    current = month_start()
+    end = add_months(current, months_ahead + 1)
+
+    for table in PARTITIONED_TABLES:
+        conn.execute(text(f"""
+            CREATE TABLE IF NOT EXISTS {table}_default
+            PARTITION OF {table} DEFAULT
+        """))
+
+        uppers = [upper for _, _, upper in list_partitions(conn, table) if upper]
+        start = max([current] + uppers)
+
+        while start < end:
+            create_month_partition(conn, table, start)
+            start = add_months(start, 1)
+
+
+def lock_schema(conn):
+    """
+    Serialises schema changes across processes until conn commits:
+    every worker runs init_db_schema at startup.
+    """
+    conn.execute(text("SELECT pg_advisory_xact_lock(:k)"), {"k": SCHEMA_LOCK_KEY})
 
 
 def init_db_schema():
-    with engine.begin() as conn:
+    # migrations may run longer than the API statement timeout
+    with engine_worker.begin() as conn:
+        lock_schema(conn)
+
         conn.execute(text("""
             CREATE TABLE IF NOT EXISTS admins (
                 id BIGSERIAL PRIMARY KEY,
@@ -100,18 +534,11 @@ def init_db_schema():
             ADD COLUMN IF NOT EXISTS server_hash VARCHAR(128)
         """))
 
-        conn.execute(text("""
+        conn.execute(text(f"""
             CREATE TABLE IF NOT EXISTS bets (
-                id BIGSERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL REFERENCES users(id),
-                round_id BIGINT NOT NULL REFERENCES game_rounds(id),
-                bet_amount NUMERIC(10,2) NOT NULL,
-                cashout_multiplier NUMERIC(6,2),
-                auto_cashout NUMERIC(6,2),
-                payout NUMERIC(12,2) DEFAULT 0.00,
-                status VARCHAR(20) DEFAULT 'active',
-                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-            )
+                id BIGSERIAL,
+                {BETS_COLUMNS}
+            ) PARTITION BY RANGE (created_at)
         """))
 
         conn.execute(text("""
@@ -131,20 +558,18 @@ def init_db_schema():
             )
         """))
 
-        conn.execute(text("""
+        conn.execute(text(f"""
             CREATE TABLE IF NOT EXISTS transactions (
-                id BIGSERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL REFERENCES users(id),
-                type VARCHAR(20) NOT NULL,
-                amount NUMERIC(12,2) NOT NULL,
-                balance_before NUMERIC(12,2) DEFAULT 0.00,
-                balance_after NUMERIC(12,2) DEFAULT 0.00,
-                status VARCHAR(20) DEFAULT 'completed',
-                reference VARCHAR(100),
-                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-            )
+                id BIGSERIAL,
+                {TRANSACTIONS_COLUMNS}
+            ) PARTITION BY RANGE (created_at)
         """))
 
+        # tables created before partitioning become the first partition
+        migrate_to_partitioned(conn, "bets", BETS_COLUMNS)
+        migrate_to_partitioned(conn, "transactions", TRANSACTIONS_COLUMNS)
+        ensure_partitions(conn)
+
         conn.execute(text("""
             CREATE INDEX IF NOT EXISTS bets_user_id_idx ON bets(user_id)
         """))
@@ -158,6 +583,90 @@ def init_db_schema():
             CREATE INDEX IF NOT EXISTS mpesa_transactions_user_id_idx ON mpesa_transactions(user_id)
         """))
 
+        # stakes reserved by buffered bets until their bet row is
+        # written, see services.bet_service
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS bet_reservations (
+                bet_id BIGINT PRIMARY KEY,
+                user_id BIGINT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+                round_id BIGINT NOT NULL REFERENCES game_rounds(id),
+                amount NUMERIC(10,2) NOT NULL,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            )
+        """))
+        conn.execute(text("""
+            CREATE INDEX IF NOT EXISTS bet_reservations_round_id_idx
+            ON bet_reservations(round_id)
+        """))
+
+        # STK callbacks are matched and claimed through these keys
+        conn.execute(text("""
+            ALTER TABLE mpesa_transactions
+            ADD COLUMN IF NOT EXISTS reference VARCHAR(64),
+            ADD COLUMN IF NOT EXISTS checkout_request_id VARCHAR(64),
+            ADD COLUMN IF NOT EXISTS merchant_request_id VARCHAR(64),
+            ADD COLUMN IF NOT EXISTS result_code INT,
+            ADD COLUMN IF NOT EXISTS result_desc VARCHAR(255),
+            ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        """))
+        conn.execute(text("""
+            CREATE UNIQUE INDEX IF NOT EXISTS mpesa_transactions_reference_key
+            ON mpesa_transactions(reference)
+        """))
+        conn.execute(text("""
+            CREATE UNIQUE INDEX IF NOT EXISTS mpesa_transactions_checkout_key
+            ON mpesa_transactions(checkout_request_id)
+        """))
+
+        # B2C withdrawal queue, drained by services.payout_service
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS payouts (
+                id BIGSERIAL PRIMARY KEY,
+                user_id BIGINT NOT NULL REFERENCES users(id),
+                phone VARCHAR(20) NOT NULL,
+                amount NUMERIC(12,2) NOT NULL,
+                status VARCHAR(20) NOT NULL DEFAULT 'queued',
+                attempts INT NOT NULL DEFAULT 0,
+                next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                conversation_id VARCHAR(64) UNIQUE,
+                originator_conversation_id VARCHAR(64) UNIQUE,
+                result_code INT,
+                result_desc VARCHAR(255),
+                mpesa_code VARCHAR(20),
+                created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            )
+        """))
+        # Transaction Status queries of payouts whose outcome is unknown
+        conn.execute(text("""
+            ALTER TABLE payouts
+            ADD COLUMN IF NOT EXISTS reconcile_conversation_id VARCHAR(64) UNIQUE
+        """))
+        conn.execute(text("DROP INDEX IF EXISTS payouts_due_idx"))
+        conn.execute(text("""
+            CREATE INDEX IF NOT EXISTS payouts_pending_idx
+            ON payouts(next_attempt_at)
+            WHERE status IN ('queued', 'submitting', 'submitted', 'needs_reconcile')
+        """))
+        conn.execute(text("""
+            CREATE INDEX IF NOT EXISTS payouts_user_id_idx ON payouts(user_id)
+        """))
+
+        # single row fencing the game engine, see services.leader_service
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS engine_leader (
+                id SMALLINT PRIMARY KEY CHECK (id = 1),
+                epoch BIGINT NOT NULL DEFAULT 0,
+                holder VARCHAR(128),
+                backend_pid INT,
+                heartbeat_at TIMESTAMPTZ
+            )
+        """))
+        conn.execute(text("""
+            INSERT INTO engine_leader (id) VALUES (1)
+            ON CONFLICT (id) DO NOTHING
+        """))
+
         conn.execute(text("""
             INSERT INTO admin_settings (setting_key, setting_value)
             VALUES
@@ -170,6 +679,9 @@ def init_db_schema():
 
 
 def ensure_admin_user():
+    # imported here: the pool reads its sizing from the .env loaded above
+    from services.password_service import hash_password
+
     username = os.getenv("ADMIN_USERNAME", "admin")
     password = os.getenv("ADMIN_PASSWORD", "admin123")
 
@@ -185,7 +697,7 @@ def ensure_admin_user():
         if existing:
             return
 
-        hashed = pwd_context.hash(password)
+        hashed = hash_password(password)
         conn.execute(
             text("""
                 INSERT INTO admins (username, password_hash, role, status)
@@ -1,10 +1,20 @@
+from dataclasses import dataclass
+
 from fastapi import Depends, HTTPException
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from jwt_utils import verify_token
+from services.user_service import get_cached_user_id_async
 
 security = HTTPBearer()
 
 
+@dataclass(frozen=True)
+class Principal:
+    subject: str
+    user_id: int
+    role: str
+
+
 def require_admin_token(
     credentials: HTTPAuthorizationCredentials = Depends(security)
 ):
@@ -15,3 +25,20 @@ def require_admin_token(
         raise HTTPException(status_code=401, detail="Invalid or expired token")
 
     return payload
+
+
+async def require_user(payload: dict = Depends(require_admin_token)):
+    user_id = payload.get("uid")
+
+    # older tokens only carry the phone number
+    if user_id is None:
+        user_id = await get_cached_user_id_async(payload["sub"])
+
+    if not user_id:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    return Principal(
+        subject=payload["sub"],
+        user_id=int(user_id),
+        role=payload.get("role", "user"),
+    )
@@ -7,10 +7,17 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
 
 
-def create_access_token(data: dict):
+def create_access_token(data: dict, user_id: int | None = None, role: str | None = None):
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     to_encode.update({"exp": expire})
+
+    # let authenticated routes resolve the caller without a DB lookup
+    if user_id is not None:
+        to_encode["uid"] = user_id
+    if role is not None:
+        to_encode["role"] = role
+
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 
@@ -0,0 +1,415 @@
+"""
+Round-synchronised load harness for a running Aviator backend.
+
+Seeds players straight into the (throwaway!) database, logs them in, and
+drives traffic that follows the live round stream: balance polls, a burst
+of bets inside each betting window, and manual cashouts while the plane
+flies. Reports p50/p95/p99 latency and error rates per endpoint, the tick
+interval seen by a stream client, and the server's DB pool wait and
+engine tick lag from /admin/stats.
+
+Usage:
+    DATABASE_URL=postgresql://... python load_test.py --users 2000 --duration 120
+
+Run the server with the mock M-Pesa module (the default in main.py).
+Business rejections (e.g. "Betting closed", "Insufficient balance") are
+counted separately from errors.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime
+
+import httpx
+
+
+PHONE_PREFIX = "25479"
+
+
+# -------------------
+# SEEDING
+# -------------------
+def seed_users(database_url: str, users: int, password: str, balance: float):
+    """Creates users 25479xxxxxxx with funded wallets; returns their phones."""
+    from argon2 import PasswordHasher
+    from sqlalchemy import create_engine, text
+
+    phones = [f"{PHONE_PREFIX}{i:07d}" for i in range(users)]
+    password_hash = PasswordHasher().hash(password)
+
+    db = create_engine(database_url)
+    with db.begin() as conn:
+        conn.execute(
+            text("""
+                WITH new_users AS (
+                    INSERT INTO users (phone, password_hash)
+                    SELECT phone, :h FROM unnest(CAST(:phones AS TEXT[])) AS phone
+                    ON CONFLICT (phone) DO UPDATE SET password_hash = EXCLUDED.password_hash
+                    RETURNING id
+                )
+                INSERT INTO wallets (user_id, balance)
+                SELECT id, :b FROM new_users
+                ON CONFLICT (user_id) DO UPDATE
+                SET balance = EXCLUDED.balance, locked_balance = 0
+            """),
+            {"phones": phones, "h": password_hash, "b": balance}
+        )
+    db.dispose()
+
+    return phones
+
+
+# -------------------
+# RECORDING
+# -------------------
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.outcomes = defaultdict(lambda: defaultdict(int))
+
+    def record(self, name: str, seconds: float, outcome: str):
+        self.latencies[name].append(seconds)
+        self.outcomes[name][outcome] += 1
+
+    def summary(self):
+        rows = {}
+        for name, latencies in sorted(self.latencies.items()):
+            outcomes = self.outcomes[name]
+            total = sum(outcomes.values())
+            errors = total - outcomes["ok"] - outcomes["rejected"]
+            rows[name] = {
+                "requests": total,
+                "error_rate": errors / total if total else 0.0,
+                "rejected_rate": outcomes["rejected"] / total if total else 0.0,
+                "p50_ms": percentile(latencies, 0.50) * 1000,
+                "p95_ms": percentile(latencies, 0.95) * 1000,
+                "p99_ms": percentile(latencies, 0.99) * 1000,
+                "max_ms": max(latencies) * 1000,
+                "outcomes": dict(outcomes),
+            }
+        return rows
+
+
+async def call(client, recorder, name, method, url, **kwargs):
+    started = time.perf_counter()
+    try:
+        response = await client.request(method, url, **kwargs)
+    except httpx.HTTPError as e:
+        recorder.record(name, time.perf_counter() - started, type(e).__name__)
+        return None
+
+    status = response.status_code
+    if status < 400:
+        outcome = "ok"
+    elif status == 400:
+        outcome = "rejected"
+    else:
+        outcome = str(status)
+
+    recorder.record(name, time.perf_counter() - started, outcome)
+    return response
+
+
+# -------------------
+# ROUND STREAM
+# -------------------
+class RoundState:
+    """Latest round phase as seen on /aviator/stream."""
+
+    def __init__(self):
+        self.changed = asyncio.Condition()
+        self.round_id = 0
+        self.phase = None
+        self.window_seconds = 5.0
+        self.tick_intervals = []
+        self._last_tick = None
+
+    async def update(self, message: dict):
+        event = message["event"]
+
+        if event == "tick":
+            now = time.perf_counter()
+            if self._last_tick is not None:
+                self.tick_intervals.append(now - self._last_tick)
+            self._last_tick = now
+            return
+
+        self._last_tick = None
+
+        async with self.changed:
+            self.round_id = message.get("round_id", self.round_id)
+            self.phase = event
+            if event == "round_open" and message.get("betting_close_at"):
+                close_at = datetime.fromisoformat(message["betting_close_at"])
+                self.window_seconds = max(
+                    0.5, close_at.timestamp() - message["server_time"]
+                )
+            self.changed.notify_all()
+
+    async def wait_for(self, phase: str, after_round: int = 0):
+        async with self.changed:
+            await self.changed.wait_for(
+                lambda: self.phase == phase and self.round_id > after_round
+            )
+            return self.round_id
+
+
+async def follow_stream(client, state: RoundState, stop: asyncio.Event):
+    while not stop.is_set():
+        try:
+            async with client.stream("GET", "/aviator/stream", timeout=None) as response:
+                async for line in response.aiter_lines():
+                    if line.startswith("data: "):
+                        await state.update(json.loads(line[6:]))
+                    if stop.is_set():
+                        return
+        except httpx.HTTPError:
+            await asyncio.sleep(1)
+
+
+# -------------------
+# PLAYERS
+# -------------------
+async def login(client, recorder, phone, password, semaphore):
+    async with semaphore:
+        response = await call(
+            client, recorder, "POST /auth/login", "POST", "/auth/login",
+            json={"phone": phone, "password": password},
+        )
+    if response is None or response.status_code != 200:
+        return None
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+async def poll_balance(client, recorder, headers, args, stop):
+    await asyncio.sleep(random.uniform(0, args.poll_interval))
+    while not stop.is_set():
+        await call(
+            client, recorder, "GET /wallet/balance", "GET", "/wallet/balance",
+            headers=headers,
+        )
+        await asyncio.sleep(args.poll_interval * random.uniform(0.5, 1.5))
+
+
+async def play_rounds(client, recorder, headers, state, args, stop):
+    last_round = state.round_id
+
+    while not stop.is_set():
+        round_id = await state.wait_for("round_open", last_round)
+        last_round = round_id
+
+        if random.random() >= args.bet_probability:
+            continue
+
+        # most bets land early in the window
+        await asyncio.sleep(random.betavariate(1.2, 3) * state.window_seconds)
+
+        manual = random.random() < args.manual_cashout
+        response = await call(
+            client, recorder, "POST /aviator/bet", "POST", "/aviator/bet",
+            headers=headers,
+            json={
+                "amount": random.choice(args.stakes),
+                "auto_cashout": None if manual else round(random.uniform(1.1, 5.0), 2),
+            },
+        )
+        if not manual or response is None or response.status_code != 200:
+            continue
+
+        bet_id = response.json()["bet_id"]
+        await state.wait_for("betting_closed", round_id - 1)
+        await asyncio.sleep(random.expovariate(1 / args.cashout_delay))
+
+        await call(
+            client, recorder, "POST /aviator/cashout", "POST", "/aviator/cashout",
+            headers=headers, json={"bet_id": bet_id},
+        )
+
+
+async def admin_stats(client, args):
+    response = await client.post(
+        "/admin/login",
+        json={"username": args.admin_username, "password": args.admin_password},
+    )
+    if response.status_code != 200:
+        return None
+
+    token = response.json()["access_token"]
+    response = await client.get(
+        "/admin/stats", headers={"Authorization": f"Bearer {token}"}
+    )
+    return response.json() if response.status_code == 200 else None
+
+
+async def run(args, phones):
+    recorder = Recorder()
+    state = RoundState()
+    stop = asyncio.Event()
+
+    limits = httpx.Limits(
+        max_connections=args.connections,
+        max_keepalive_connections=args.connections,
+    )
+    async with httpx.AsyncClient(
+        base_url=args.base_url, limits=limits, timeout=args.timeout
+    ) as client, httpx.AsyncClient(base_url=args.base_url) as control:
+        stats_before = await admin_stats(control, args)
+        stream = asyncio.create_task(follow_stream(control, state, stop))
+
+        semaphore = asyncio.Semaphore(args.login_concurrency)
+        logins = await asyncio.gather(*(
+            login(client, recorder, phone, args.password, semaphore)
+            for phone in phones
+        ))
+        players = [headers for headers in logins if headers]
+        print(f"{len(players)}/{len(phones)} players logged in", file=sys.stderr)
+
+        tasks = []
+        for headers in players:
+            tasks.append(asyncio.create_task(
+                poll_balance(client, recorder, headers, args, stop)
+            ))
+            tasks.append(asyncio.create_task(
+                play_rounds(client, recorder, headers, state, args, stop)
+            ))
+
+        started_round = state.round_id
+        await asyncio.sleep(args.duration)
+        stop.set()
+
+        for task in tasks + [stream]:
+            task.cancel()
+        await asyncio.gather(*tasks, stream, return_exceptions=True)
+
+        stats_after = await admin_stats(control, args)
+
+    return {
+        "users": len(phones),
+        "players": len(players),
+        "duration_seconds": args.duration,
+        "rounds": max(0, state.round_id - started_round),
+        "endpoints": recorder.summary(),
+        "stream_tick_interval_ms": {
+            "p50": percentile(state.tick_intervals, 0.50) * 1000,
+            "p99": percentile(state.tick_intervals, 0.99) * 1000,
+            "max": max(state.tick_intervals, default=0.0) * 1000,
+        },
+        "server": server_deltas(stats_before, stats_after),
+    }
+
+
+def server_deltas(before, after):
+    if not before or not after:
+        return None
+
+    pool_before, pool_after = before["db_pool"], after["db_pool"]
+    checkouts = pool_after["checkouts"] - pool_before["checkouts"]
+    wait = pool_after["wait_seconds"] - pool_before["wait_seconds"]
+
+    return {
+        "db_pool": {
+            "checkouts": checkouts,
+            "timeouts": pool_after["timeouts"] - pool_before["timeouts"],
+            "avg_wait_ms": wait / checkouts * 1000 if checkouts else 0.0,
+            "max_wait_ms": pool_after["max_wait_seconds"] * 1000,
+        },
+        "engine_ticks": after["engine_ticks"],
+        "password_pool": after["password_pool"],
+    }
+
+
+# -------------------
+# CLI
+# -------------------
+def format_report(result: dict):
+    lines = [
+        f"{result['players']}/{result['users']} players, "
+        f"{result['rounds']} rounds in {result['duration_seconds']}s",
+        "",
+        f"{'endpoint':<24}{'requests':>9}{'err%':>7}{'rej%':>7}"
+        f"{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}",
+    ]
+    for name, row in result["endpoints"].items():
+        lines.append(
+            f"{name:<24}{row['requests']:>9}"
+            f"{row['error_rate'] * 100:>7.2f}{row['rejected_rate'] * 100:>7.2f}"
+            f"{row['p50_ms']:>9.1f}{row['p95_ms']:>9.1f}"
+            f"{row['p99_ms']:>9.1f}{row['max_ms']:>9.1f}"
+        )
+
+    ticks = result["stream_tick_interval_ms"]
+    lines += [
+        "",
+        f"stream tick interval  p50 {ticks['p50']:.1f}ms  "
+        f"p99 {ticks['p99']:.1f}ms  max {ticks['max']:.1f}ms",
+    ]
+
+    server = result["server"]
+    if server:
+        pool, engine_ticks = server["db_pool"], server["engine_ticks"]
+        lines += [
+            f"db pool wait          avg {pool['avg_wait_ms']:.2f}ms  "
+            f"max {pool['max_wait_ms']:.1f}ms  "
+            f"over {pool['checkouts']} checkouts, {pool['timeouts']} timeouts",
+            f"engine tick lag       p50 {engine_ticks['lag_p50_seconds'] * 1000:.1f}ms  "
+            f"p99 {engine_ticks['lag_p99_seconds'] * 1000:.1f}ms  "
+            f"max {engine_ticks['lag_max_seconds'] * 1000:.1f}ms",
+        ]
+    else:
+        lines.append("server stats unavailable (check --admin-username/--admin-password)")
+
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL"))
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--password", default="loadtest123")
+    parser.add_argument("--balance", type=float, default=1_000_000)
+    parser.add_argument("--skip-seed", action="store_true")
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--connections", type=int, default=200)
+    parser.add_argument("--login-concurrency", type=int, default=50)
+    parser.add_argument("--timeout", type=float, default=10)
+    parser.add_argument("--poll-interval", type=float, default=2.0)
+    parser.add_argument("--bet-probability", type=float, default=0.6)
+    parser.add_argument("--manual-cashout", type=float, default=0.3)
+    parser.add_argument("--cashout-delay", type=float, default=0.5,
+                        help="mean seconds after betting closes")
+    parser.add_argument("--stakes", type=float, nargs="+", default=[50, 100, 200, 500])
+    parser.add_argument("--admin-username", default=os.getenv("ADMIN_USERNAME", "admin"))
+    parser.add_argument("--admin-password", default=os.getenv("ADMIN_PASSWORD", "admin123"))
+    parser.add_argument("--json", metavar="PATH", help="also write the result as JSON")
+    args = parser.parse_args(argv)
+
+    phones = [f"{PHONE_PREFIX}{i:07d}" for i in range(args.users)]
+    if not args.skip_seed:
+        if not args.database_url:
+            parser.error("--database-url (or DATABASE_URL) is needed to seed users")
+        phones = seed_users(args.database_url, args.users, args.password, args.balance)
+
+    result = asyncio.run(run(args, phones))
+    print(format_report(result))
+
+    if args.json:
+        with open(args.json, "w") as handle:
+            json.dump(result, handle, indent=2)
+
+
+if __name__ == "__main__":
+    main()
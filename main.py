@@ -1,28 +1,66 @@
-from fastapi import FastAPI, Depends, HTTPException
+import asyncio
+import os
+
+import anyio.to_thread
+from fastapi import (
+    FastAPI,
+    Depends,
+    HTTPException,
+    Request,
+    Response,
+    WebSocket,
+    WebSocketDisconnect,
+)
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from fastapi.openapi.utils import get_openapi
-from sqlalchemy import text
 
-from database import engine, init_db_schema, ensure_admin_user
+from database import (
+    ENGINES,
+    async_engines,
+    async_read_engines,
+    engine,
+    ensure_admin_user,
+    init_db_schema,
+    pool_stats,
+)
 
 from auth import authenticate_admin
 from jwt_utils import create_access_token
-from dependencies import require_admin_token
+from dependencies import require_admin_token, require_user, Principal
 
-from services.settings_service import get_settings, update_settings
+from services.settings_service import (
+    get_settings_async,
+    update_settings,
+    start_settings_listener,
+)
 from services.wallet_service import (
-    get_wallet,
-    credit_wallet,
-    debit_wallet,
+    get_wallet_async,
     create_pending_deposit,
+    attach_checkout,
+    complete_deposit_async,
+    fail_deposit_async,
 )
-from services.user_service import get_user_id
 from services.auth_service import register_user, authenticate_user
-from services.mpesa_service_mock import stk_push, b2c_withdraw  # Use mock by default
+from services.password_service import PasswordServiceBusy, password_pool
+from services.mpesa_service_mock import stk_push  # Use mock by default
+from services.payout_service import (
+    get_payout,
+    handle_result,
+    handle_status_result,
+    handle_timeout,
+    payout_worker,
+    request_payout,
+)
 
-from services.aviator_service import get_current_round, get_recent_rounds
-from services.bet_service import place_bet
+from services.aviator_service import get_current_round_async, get_round_proof, recent_rounds
+from services.bet_service import bet_buffer, submit_bet_async
+from services.order_book import get_live_book
+from services.leader_service import forward_cashout
+from services.multiplier_service import tick_stats
+from services.broadcast_service import broadcaster
+from services.metrics_service import MetricsMiddleware, registry
 
 from database import Base
 
@@ -58,6 +96,112 @@ app.add_middleware(
 )
 
 
+# -------------------
+# METRICS
+# -------------------
+# optional bearer token for /metrics; open when unset
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+app.add_middleware(MetricsMiddleware)
+
+def db_engines():
+    engines = dict(ENGINES)
+    # only the server loop's async engine is pooled
+    for db_engine in async_engines.current():
+        engines["async"] = db_engine
+    if async_read_engines is not async_engines:
+        for db_engine in async_read_engines.current():
+            engines["async_read"] = db_engine
+    return engines
+
+
+def _per_engine(field):
+    return lambda: {
+        (name,): pool_stats(db_engine)[field]
+        for name, db_engine in db_engines().items()
+    }
+
+
+for field, kind, documentation in (
+    ("size", "gauge", "Configured connections per DB pool"),
+    ("capacity", "gauge", "Pool size plus allowed overflow"),
+    ("utilisation", "gauge", "Checked out connections as a fraction of capacity"),
+    ("checked_out", "gauge", "DB connections currently checked out"),
+    ("overflow", "gauge", "DB connections opened beyond the pool size"),
+    ("checkouts", "counter", "DB connection checkouts"),
+    ("timeouts", "counter", "DB checkouts that failed or timed out"),
+    ("wait_seconds", "counter", "Total time spent waiting for a DB connection"),
+    ("max_wait_seconds", "gauge", "Longest wait for a DB connection"),
+):
+    registry.collect(
+        f"db_pool_{field}", documentation, kind, labelnames=("engine",)
+    )(_per_engine(field))
+
+
+@registry.collect("threadpool_tokens_capacity", "Starlette threadpool capacity")
+def _threadpool_capacity():
+    return anyio.to_thread.current_default_thread_limiter().total_tokens
+
+
+@registry.collect("threadpool_tokens_borrowed", "Starlette threadpool threads in use")
+def _threadpool_borrowed():
+    return anyio.to_thread.current_default_thread_limiter().borrowed_tokens
+
+
+@registry.collect("threadpool_tasks_waiting", "Sync endpoints queued for a thread")
+def _threadpool_waiting():
+    return anyio.to_thread.current_default_thread_limiter().statistics().tasks_waiting
+
+
+@registry.collect("password_pool_pending", "Argon2 calls queued or running")
+def _password_pending():
+    return password_pool.stats()["pending"]
+
+
+@registry.collect("password_pool_rejected", "Argon2 calls rejected as busy", "counter")
+def _password_rejected():
+    return password_pool.stats()["rejected"]
+
+
+@registry.collect("bet_buffer_pending", "Reserved bets waiting to be flushed")
+def _bets_pending():
+    return len(bet_buffer)
+
+
+@registry.collect("payouts_in_flight", "B2C payouts being submitted to M-Pesa")
+def _payouts_in_flight():
+    return payout_worker.stats()["in_flight"]
+
+
+@registry.collect("stream_subscribers", "Open WebSocket and SSE subscriptions")
+def _stream_subscribers():
+    return broadcaster.subscriber_count()
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics(request: Request):
+    # async so threadpool stats are read on the event loop
+    if METRICS_TOKEN and request.headers.get("authorization") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+
+    return PlainTextResponse(
+        registry.render(),
+        media_type="text/plain; version=0.0.4",
+    )
+
+
+# -------------------
+# ERROR HANDLERS
+# -------------------
+@app.exception_handler(PasswordServiceBusy)
+def password_service_busy(request, exc):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Authentication is busy, please retry"},
+        headers={"Retry-After": "1"},
+    )
+
+
 # -------------------
 # REQUEST MODELS
 # -------------------
@@ -87,6 +231,10 @@ class BetRequest(BaseModel):
     auto_cashout: float | None = None
 
 
+class CashoutRequest(BaseModel):
+    bet_id: int | None = None
+
+
 # -------------------
 # PUBLIC ROUTES
 # -------------------
@@ -99,45 +247,142 @@ def root():
 # AVIATOR ROUND INFO
 # -------------------
 @app.get("/aviator/round")
-def aviator_round():
-    round_data = get_current_round()
+async def aviator_round():
+    round_data = await get_current_round_async()
     if not round_data:
         return {"round": None}
 
     return {
         "round_id": round_data[0],
-        "crash_point": float(round_data[1]) if round_data[1] is not None else None,
+        # the crash point stays secret until the round ends
+        "server_hash": round_data[1],
         "status": round_data[2],
         "betting_close_at": round_data[3],
     }
 
 
+# -------------------
+# AVIATOR LIVE STREAM
+# -------------------
+SSE_KEEPALIVE_SECONDS = 15
+
+
+@app.websocket("/ws/aviator")
+async def aviator_ws(websocket: WebSocket):
+    subscription = broadcaster.subscribe()
+    try:
+        await websocket.accept()
+        while True:
+            message = await subscription.get()
+            await websocket.send_text(message)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        broadcaster.unsubscribe(subscription)
+
+
+@app.get("/aviator/stream")
+async def aviator_stream():
+    """Server-sent events fallback for /ws/aviator"""
+    async def events():
+        subscription = broadcaster.subscribe()
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(
+                        subscription.get(), SSE_KEEPALIVE_SECONDS
+                    )
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"data: {message}\n\n"
+        finally:
+            broadcaster.unsubscribe(subscription)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.get("/aviator/recent")
-def aviator_recent():
+def aviator_recent(request: Request):
     """Get recent completed rounds"""
-    rounds = get_recent_rounds(limit=20)
-    return {"recent_rounds": rounds}
+    etag, body = recent_rounds.snapshot()
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+@app.get("/aviator/verify/{round_id}")
+def aviator_verify(round_id: int):
+    """Reveal a finished round's seed and recompute its crash point"""
+    proof = get_round_proof(round_id)
+    if not proof:
+        raise HTTPException(status_code=404, detail="Round not found or not finished")
+    return proof
 
 
 # -------------------
 # AVIATOR BET
 # -------------------
 @app.post("/aviator/bet")
-def aviator_bet(
+async def aviator_bet(
     data: BetRequest,
-    payload: dict = Depends(require_admin_token),
+    principal: Principal = Depends(require_user),
 ):
-    user_id = get_user_id(payload["sub"])
-    if not user_id:
-        raise HTTPException(status_code=404, detail="User not found")
+    try:
+        bet = await submit_bet_async(
+            user_id=principal.user_id,
+            amount=data.amount,
+            auto_cashout=data.auto_cashout,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-    place_bet(
-        user_id=user_id,
-        amount=data.amount,
-        auto_cashout=data.auto_cashout,
-    )
+    return {"success": True, **bet}
+
+
+# -------------------
+# AVIATOR CASHOUT
+# -------------------
+@app.post("/aviator/cashout")
+async def aviator_cashout(
+    data: CashoutRequest,
+    principal: Principal = Depends(require_user),
+):
+    # in-memory only: the engine persists cashouts with the next tick
+    book = get_live_book()
 
-    return {"success": True}
+    try:
+        if book is not None:
+            round_id = book.round_id
+            entries = book.cash_out(principal.user_id, data.bet_id)
+        else:
+            # the round runs in the engine leader's process
+            round_id, entries = await forward_cashout(principal.user_id, data.bet_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Cashout not confirmed by the engine")
+
+    return {
+        "success": True,
+        "round_id": round_id,
+        "cashouts": [
+            {
+                "bet_id": bet_id,
+                "multiplier": multiplier,
+                "payout": round(bet_amount * multiplier, 2),
+            }
+            for bet_id, _, bet_amount, multiplier in entries
+        ],
+    }
 
 
 # -------------------
@@ -148,7 +393,7 @@ def admin_login(data: AdminLoginRequest):
     if not authenticate_admin(data.username, data.password):
         raise HTTPException(status_code=401, detail="Invalid credentials")
 
-    token = create_access_token({"sub": data.username})
+    token = create_access_token({"sub": data.username}, role="admin")
     return {
         "success": True,
         "access_token": token,
@@ -164,6 +409,8 @@ def user_register(data: UserAuthRequest):
     try:
         register_user(data.phone, data.password)
         return {"success": True, "message": "User registered successfully"}
+    except PasswordServiceBusy:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Registration failed: {str(e)}")
 
@@ -174,7 +421,7 @@ def user_login(data: UserAuthRequest):
     if not user_id:
         raise HTTPException(status_code=401, detail="Invalid credentials")
 
-    token = create_access_token({"sub": data.phone})
+    token = create_access_token({"sub": data.phone}, user_id=user_id, role="user")
     return {
         "success": True,
         "access_token": token,
@@ -197,9 +444,23 @@ def admin_protected(payload: dict = Depends(require_admin_token)):
     }
 
 
+@app.get("/admin/stats")
+def admin_stats(payload: dict = Depends(require_admin_token)):
+    return {
+        "password_pool": password_pool.stats(),
+        "db_pool": pool_stats(engine),
+        "db_pools": {
+            name: pool_stats(db_engine) for name, db_engine in db_engines().items()
+        },
+        "engine_ticks": tick_stats.snapshot(),
+        "payouts": payout_worker.stats(),
+        "engine_leader": engine_leader.stats(),
+    }
+
+
 @app.get("/admin/settings")
-def read_settings(payload: dict = Depends(require_admin_token)):
-    settings = get_settings()
+async def read_settings(payload: dict = Depends(require_admin_token)):
+    settings = await get_settings_async()
     if not settings:
         raise HTTPException(status_code=404, detail="Settings not found")
     return settings
@@ -223,121 +484,157 @@ def edit_settings(
 # WALLET ROUTES
 # -------------------
 @app.get("/wallet/balance")
-def wallet_balance(payload: dict = Depends(require_admin_token)):
-    user_id = get_user_id(payload["sub"])
-    if not user_id:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    return {"balance": get_wallet(user_id)}
+async def wallet_balance(principal: Principal = Depends(require_user)):
+    return {"balance": await get_wallet_async(principal.user_id)}
 
 
 @app.post("/wallet/deposit/stk")
 def wallet_stk_deposit(
     data: WalletAmountRequest,
-    payload: dict = Depends(require_admin_token),
+    principal: Principal = Depends(require_user),
 ):
-    phone = payload["sub"]
-    user_id = get_user_id(phone)
+    phone = principal.subject
 
-    if not user_id:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    reference = f"stk_{user_id}_{int(data.amount)}"
-
-    create_pending_deposit(
-        user_id=user_id,
-        amount=data.amount,
-        reference=reference,
-    )
+    try:
+        reference = create_pending_deposit(
+            user_id=principal.user_id,
+            phone=phone,
+            amount=data.amount,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
     response = stk_push(
         phone=phone,
         amount=data.amount,
         reference=reference,
     )
+    attach_checkout(reference, response)
 
-    return {"success": True, "mpesa": response}
+    return {"success": True, "reference": reference, "mpesa": response}
 
 
 @app.post("/wallet/withdraw/mpesa")
 def wallet_withdraw_mpesa(
     data: WalletAmountRequest,
-    payload: dict = Depends(require_admin_token),
+    principal: Principal = Depends(require_user),
 ):
-    phone = payload["sub"]
-    user_id = get_user_id(phone)
+    # debited and queued at once; the payout worker submits the B2C request
+    try:
+        payout = request_payout(principal.user_id, principal.subject, data.amount)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return {"success": True, **payout}
 
-    debit_wallet(
-        user_id=user_id,
-        amount=data.amount,
-        tx_type="withdraw",
-        reference="mpesa_withdraw",
-    )
 
-    response = b2c_withdraw(phone, data.amount)
-    return {"success": True, "mpesa": response}
+@app.get("/wallet/withdraw/{payout_id}")
+def wallet_withdraw_status(
+    payout_id: int,
+    principal: Principal = Depends(require_user),
+):
+    payout = get_payout(payout_id, principal.user_id)
+    if not payout:
+        raise HTTPException(status_code=404, detail="Payout not found")
+    return payout
 
 
 # -------------------
 # M-PESA STK CALLBACK
 # -------------------
 @app.post("/mpesa/stk/callback")
-def stk_callback(payload: dict):
+async def stk_callback(payload: dict):
+    # Safaricom retries until it gets ResultCode 0; replays are no-ops
     callback = payload["Body"]["stkCallback"]
     result_code = callback["ResultCode"]
+    checkout_request_id = callback.get("CheckoutRequestID")
 
     if result_code != 0:
+        await fail_deposit_async(checkout_request_id, result_code, callback.get("ResultDesc"))
         return {"ResultCode": 0}
 
-    metadata = callback["CallbackMetadata"]["Item"]
-    amount = next(i["Value"] for i in metadata if i["Name"] == "Amount")
-    reference = next(i["Value"] for i in metadata if i["Name"] == "AccountReference")
-
-    with engine.begin() as conn:
-        tx = conn.execute(
-            text("""
-                SELECT user_id
-                FROM transactions
-                WHERE reference = :r AND status = 'pending'
-            """),
-            {"r": reference},
-        ).fetchone()
-
-        if not tx:
-            return {"ResultCode": 0}
-
-        conn.execute(
-            text("""
-                UPDATE transactions
-                SET status = 'completed'
-                WHERE reference = :r
-            """),
-            {"r": reference},
-        )
+    metadata = {
+        item["Name"]: item.get("Value")
+        for item in callback.get("CallbackMetadata", {}).get("Item", [])
+    }
 
-    credit_wallet(
-        user_id=tx[0],
-        amount=amount,
-        tx_type="deposit",
-        reference=reference,
+    await complete_deposit_async(
+        checkout_request_id=checkout_request_id,
+        reference=metadata.get("AccountReference"),
+        receipt=metadata.get("MpesaReceiptNumber"),
     )
 
     return {"ResultCode": 0}
 
 
+# -------------------
+# M-PESA B2C CALLBACKS
+# -------------------
+@app.post("/mpesa/b2c/result")
+def b2c_result(payload: dict):
+    handle_result(payload)
+    return {"ResultCode": 0, "ResultDesc": "Accepted"}
+
+
+@app.post("/mpesa/b2c/timeout")
+def b2c_timeout(payload: dict):
+    handle_timeout(payload)
+    return {"ResultCode": 0, "ResultDesc": "Accepted"}
+
+
+@app.post("/mpesa/b2c/status/result")
+def b2c_status_result(payload: dict):
+    handle_status_result(payload)
+    return {"ResultCode": 0, "ResultDesc": "Accepted"}
+
+
+@app.post("/mpesa/b2c/status/timeout")
+def b2c_status_timeout(payload: dict):
+    # unanswered status queries are repeated by the payout worker
+    return {"ResultCode": 0, "ResultDesc": "Accepted"}
+
+
 # -------------------
 # SWAGGER JWT SUPPORT
 # -------------------
 from services.aviator_service import game_loop
-import threading
+from services.partition_service import partition_maintenance_loop
+from services.leader_service import engine_leader, lead, relay
+
+
+async def run_engine(epoch: int):
+    # leader-only work; standbys serve API traffic
+    try:
+        await asyncio.gather(game_loop(epoch), partition_maintenance_loop())
+    finally:
+        # another process pushes rounds now
+        recent_rounds.mark_stale()
 
 
 @app.on_event("startup")
-def start_aviator_engine():
+async def start_aviator_engine():
+    async_engines.serve()
+    async_read_engines.serve()
     init_db_schema()
     ensure_admin_user()
-    t = threading.Thread(target=game_loop, daemon=True)
-    t.start()
+    start_settings_listener()
+    payout_worker.start()
+    relay.start()
+    engine_leader.start()
+    app.state.engine_task = asyncio.create_task(lead(run_engine))
+
+
+@app.on_event("shutdown")
+async def stop_aviator_engine():
+    task = getattr(app.state, "engine_task", None)
+    if task:
+        task.cancel()
+
+    # write or refund every bet this process still holds
+    await anyio.to_thread.run_sync(bet_buffer.stop)
+
+    await async_engines.dispose()
+    await async_read_engines.dispose()
 
 def custom_openapi():
     if app.openapi_schema:
@@ -0,0 +1,331 @@
+"""
+Monte Carlo check of the crash generators' house edge.
+
+Simulates rounds with vectorized NumPy batches, lets a table of players
+bet with auto-cashout targets drawn from a strategy mix, and reports RTP,
+variance, tail exposure and max drawdown with confidence intervals.
+
+Usage:
+    python rtp_simulator.py --generator hmac --rounds 1000000 --players 20
+    python rtp_simulator.py --generator piecewise --targets "fixed:2@1" --json
+
+A bet wins when its target is strictly below the crash point and pays
+stake * target, the same rule the engine's order book applies.
+
+Deliberately independent of the database and the app settings, so it
+runs anywhere NumPy is installed.
+"""
+
+import argparse
+import json
+import math
+import sys
+import time
+
+import numpy as np
+
+from services.provablt_fair import HOUSE_EDGE
+
+
+# -------------------
+# CRASH GENERATORS
+# -------------------
+def piecewise_crash_points(rng, n: int, cap: float):
+    """Vectorized aviator_service.generate_crash_point."""
+    r = rng.random(n)
+    u = rng.random(n)
+
+    low = np.select([r < 0.7, r < 0.9, r < 0.98], [1.0, 2.0, 4.0], 10.0)
+    high = np.select([r < 0.7, r < 0.9, r < 0.98], [2.0, 4.0, 10.0], 20.0)
+
+    return np.minimum(np.round(low + (high - low) * u, 2), cap)
+
+
+def hmac_crash_points(rng, n: int, cap: float, house_edge: float = HOUSE_EDGE):
+    """
+    Vectorized provablt_fair.calculate_crash_point. The first 52 bits of
+    an HMAC-SHA256 digest are modelled as uniform integers.
+    """
+    h = rng.integers(0, 2 ** 52, size=n, dtype=np.int64).astype(np.float64)
+    crash = (2 ** 52 / (h + 1)) * (1 - house_edge)
+    return np.minimum(np.round(np.maximum(1.0, crash), 2), cap)
+
+
+GENERATORS = {
+    "piecewise": piecewise_crash_points,
+    "hmac": hmac_crash_points,
+}
+
+
+# -------------------
+# STRATEGIES
+# -------------------
+def parse_mix(spec: str):
+    """
+    Parses "kind:arg[:arg]@weight,..." into [(kind, args, weight)].
+    Kinds: fixed:V, uniform:LO:HI, lognormal:MEDIAN:SIGMA.
+    """
+    mix = []
+    for part in spec.split(","):
+        dist, _, weight = part.strip().partition("@")
+        kind, *args = dist.split(":")
+
+        if kind not in ("fixed", "uniform", "lognormal"):
+            raise ValueError(f"Unknown distribution: {kind}")
+
+        expected = 1 if kind == "fixed" else 2
+        if len(args) != expected:
+            raise ValueError(f"{kind} takes {expected} argument(s): {part}")
+
+        mix.append((kind, [float(arg) for arg in args], float(weight or 1)))
+
+    total = sum(weight for _, _, weight in mix)
+    return [(kind, args, weight / total) for kind, args, weight in mix]
+
+
+def sample_mix(rng, mix, shape):
+    choice = rng.choice(len(mix), size=shape, p=[weight for _, _, weight in mix])
+    values = np.empty(shape)
+
+    for i, (kind, args, _) in enumerate(mix):
+        selected = choice == i
+        count = int(selected.sum())
+
+        if kind == "fixed":
+            values[selected] = args[0]
+        elif kind == "uniform":
+            values[selected] = rng.uniform(args[0], args[1], count)
+        else:
+            values[selected] = args[0] * np.exp(args[1] * rng.standard_normal(count))
+
+    return values
+
+
+# -------------------
+# SIMULATION
+# -------------------
+def running_max_drawdown(profit, start: float = 0.0):
+    """Returns (max drawdown, end balance) of a cumulative profit path."""
+    path = start + np.cumsum(profit)
+    peaks = np.maximum.accumulate(np.concatenate(([start], path)))[1:]
+    return float(np.max(peaks - path, initial=0.0)), float(path[-1]) if len(path) else start
+
+
+def simulate(
+    generator: str = "hmac",
+    rounds: int = 1_000_000,
+    players: int = 20,
+    targets: str = "fixed:1.5@0.3,fixed:2@0.3,lognormal:3:0.7@0.4",
+    stakes: str = "lognormal:200:1.0",
+    min_bet: float = 10.0,
+    max_bet: float = 50000.0,
+    cap: float = 20.0,
+    batch_bets: int = 2_000_000,
+    blocks: int = 20,
+    seed: int | None = None,
+):
+    rng = np.random.default_rng(seed)
+    make_crash = GENERATORS[generator]
+    target_mix = parse_mix(targets)
+    stake_mix = parse_mix(stakes)
+
+    batch_rounds = max(1, batch_bets // players)
+
+    # per-round house profit is kept for quantiles and the drawdown path
+    profit = np.empty(rounds)
+    staked_total = paid_total = 0.0
+    sum_s = sum_p = sum_ss = sum_pp = sum_sp = 0.0
+    bets = wins = 0
+    return_sum = return_sq = 0.0
+
+    done = 0
+    while done < rounds:
+        n = min(batch_rounds, rounds - done)
+
+        crash = make_crash(rng, n, cap)
+        target = np.clip(np.round(sample_mix(rng, target_mix, (n, players)), 2), 1.01, cap)
+        stake = np.clip(np.round(sample_mix(rng, stake_mix, (n, players)), 2), min_bet, max_bet)
+
+        won = target < crash[:, None]
+        payout = np.where(won, stake * target, 0.0)
+
+        s = stake.sum(axis=1)
+        p = payout.sum(axis=1)
+        profit[done:done + n] = s - p
+
+        staked_total += s.sum()
+        paid_total += p.sum()
+        sum_s += s.sum()
+        sum_p += p.sum()
+        sum_ss += (s * s).sum()
+        sum_pp += (p * p).sum()
+        sum_sp += (s * p).sum()
+
+        ratio = payout / stake
+        bets += ratio.size
+        wins += int(won.sum())
+        return_sum += ratio.sum()
+        return_sq += (ratio * ratio).sum()
+
+        done += n
+
+    # RTP is a ratio of per-round sums; its standard error comes from the
+    # delta method on the independent rounds
+    rtp = paid_total / staked_total
+    mean_s = sum_s / rounds
+    var_s = sum_ss / rounds - mean_s ** 2
+    var_p = sum_pp / rounds - (sum_p / rounds) ** 2
+    cov_sp = sum_sp / rounds - mean_s * (sum_p / rounds)
+    var_ratio = max(var_p - 2 * rtp * cov_sp + rtp ** 2 * var_s, 0.0)
+    rtp_se = math.sqrt(var_ratio / rounds) / mean_s
+
+    bet_return_mean = return_sum / bets
+    bet_return_var = return_sq / bets - bet_return_mean ** 2
+
+    profit_mean = float(profit.mean())
+    profit_std = float(profit.std())
+    max_drawdown, end_balance = running_max_drawdown(profit)
+
+    quantiles = [0.99, 0.999, 0.9999]
+    # house losses are negative profit; the upper tail of -profit
+    losses = -profit
+    exposure = {
+        f"p{q * 100:g}": float(np.quantile(losses, q)) for q in quantiles
+    }
+    exposure["worst_round"] = float(losses.max())
+
+    # batch means over equal blocks give intervals for the tail figures
+    blocks = max(2, min(blocks, rounds))
+    block_quantiles = {q: [] for q in quantiles}
+    block_drawdowns = []
+    for block in np.array_split(profit, blocks):
+        for q in quantiles:
+            block_quantiles[q].append(np.quantile(-block, q))
+        block_drawdowns.append(running_max_drawdown(block)[0])
+
+    z = 1.96
+
+    def interval(values):
+        values = np.asarray(values)
+        half = z * values.std(ddof=1) / math.sqrt(len(values))
+        return [float(values.mean() - half), float(values.mean() + half)]
+
+    return {
+        "generator": generator,
+        "rounds": rounds,
+        "bets": bets,
+        "players": players,
+        "targets": targets,
+        "stakes": stakes,
+        "rtp": rtp,
+        "rtp_ci95": [rtp - z * rtp_se, rtp + z * rtp_se],
+        "house_edge": 1 - rtp,
+        "win_rate": wins / bets,
+        "bet_return_variance": bet_return_var,
+        "round_profit_mean": profit_mean,
+        "round_profit_mean_ci95": [
+            profit_mean - z * profit_std / math.sqrt(rounds),
+            profit_mean + z * profit_std / math.sqrt(rounds),
+        ],
+        "round_profit_std": profit_std,
+        "total_staked": staked_total,
+        "house_profit": end_balance,
+        "tail_exposure": exposure,
+        "tail_exposure_block_ci95": {
+            f"p{q * 100:g}": interval(values)
+            for q, values in block_quantiles.items()
+        },
+        "max_drawdown": max_drawdown,
+        "block_max_drawdown": {
+            "rounds_per_block": rounds // blocks,
+            "mean_ci95": interval(block_drawdowns),
+            "max": float(max(block_drawdowns)),
+        },
+    }
+
+
+# -------------------
+# CLI
+# -------------------
+def format_report(result: dict, seconds: float):
+    lines = [
+        f"generator       {result['generator']}",
+        f"rounds / bets   {result['rounds']:,} / {result['bets']:,} ({seconds:.1f}s)",
+        f"RTP             {result['rtp']:.5f}  "
+        f"95% CI [{result['rtp_ci95'][0]:.5f}, {result['rtp_ci95'][1]:.5f}]",
+        f"house edge      {result['house_edge'] * 100:.3f}%",
+        f"win rate        {result['win_rate'] * 100:.2f}%",
+        f"bet return var  {result['bet_return_variance']:.4f}",
+        f"round profit    mean {result['round_profit_mean']:,.2f}  "
+        f"std {result['round_profit_std']:,.2f}",
+        f"house profit    {result['house_profit']:,.2f} "
+        f"on {result['total_staked']:,.2f} staked",
+        "tail exposure (house loss per round):",
+    ]
+
+    intervals = result["tail_exposure_block_ci95"]
+    for key, value in result["tail_exposure"].items():
+        suffix = ""
+        if key in intervals:
+            low, high = intervals[key]
+            suffix = f"  blocks 95% CI [{low:,.2f}, {high:,.2f}]"
+        lines.append(f"  {key:<12}  {value:,.2f}{suffix}")
+
+    block = result["block_max_drawdown"]
+    lines += [
+        f"max drawdown    {result['max_drawdown']:,.2f}",
+        f"  per {block['rounds_per_block']:,} rounds  "
+        f"mean 95% CI [{block['mean_ci95'][0]:,.2f}, {block['mean_ci95'][1]:,.2f}]  "
+        f"max {block['max']:,.2f}",
+    ]
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--generator", choices=sorted(GENERATORS), default="hmac")
+    parser.add_argument("--rounds", type=int, default=1_000_000)
+    parser.add_argument("--players", type=int, default=20, help="bets per round")
+    parser.add_argument(
+        "--targets",
+        default="fixed:1.5@0.3,fixed:2@0.3,lognormal:3:0.7@0.4",
+        help="auto-cashout mix, e.g. 'fixed:2@0.5,uniform:1.1:10@0.5'",
+    )
+    parser.add_argument("--stakes", default="lognormal:200:1.0", help="bet size mix")
+    parser.add_argument("--min-bet", type=float, default=10.0)
+    parser.add_argument("--max-bet", type=float, default=50000.0)
+    parser.add_argument("--cap", type=float, default=20.0, help="max crash point")
+    parser.add_argument("--batch-bets", type=int, default=2_000_000)
+    parser.add_argument("--blocks", type=int, default=20)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--json", action="store_true", help="print JSON")
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    try:
+        result = simulate(
+            generator=args.generator,
+            rounds=args.rounds,
+            players=args.players,
+            targets=args.targets,
+            stakes=args.stakes,
+            min_bet=args.min_bet,
+            max_bet=args.max_bet,
+            cap=args.cap,
+            batch_bets=args.batch_bets,
+            blocks=args.blocks,
+            seed=args.seed,
+        )
+    except ValueError as e:
+        parser.error(str(e))
+    seconds = time.perf_counter() - started
+
+    if args.json:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    else:
+        print(format_report(result, seconds))
+
+
+if __name__ == "__main__":
+    main()
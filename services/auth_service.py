@@ -1,12 +1,10 @@
 from sqlalchemy import text
 from database import engine
-from passlib.context import CryptContext
-
-pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
+from services.password_service import hash_password, verify_password
 
 
 def register_user(phone_number: str, password: str):
-    hashed = pwd_context.hash(password)
+    hashed = hash_password(password)
 
     with engine.begin() as conn:
         # create user and get id (Postgres needs RETURNING instead of lastrowid)
@@ -42,11 +40,11 @@ def authenticate_user(phone_number: str, password: str):
             {"p": phone_number}
         ).fetchone()
 
-        if not row:
-            return None
+    if not row:
+        return None
 
-        if not pwd_context.verify(password, row[1]):
-            return None
+    if not verify_password(password, row[1]):
+        return None
 
-        return int(row[0])
+    return int(row[0])
 
@@ -1,9 +1,40 @@
+import asyncio
+import json
+import logging
+import os
 import random
 import threading
-from datetime import datetime
+import time
+from collections import deque
 from sqlalchemy import text
-from database import engine
+from database import async_engine, engine, engine_game
 from services.multiplier_service import run_multiplier
+from services.broadcast_service import broadcaster
+from services.wallet_service import refund_round_bets, settle_bets
+from services.game_executor import run_db
+from services.hash_chain import hash_chain, hash_seed
+from services.leader_service import LeadershipLost, check_epoch
+from services.metrics_service import engine_settlement_duration
+from services.provablt_fair import calculate_crash_point
+from services.bet_service import (
+    BET_FLUSH_INTERVAL,
+    BET_FLUSH_TIMEOUT,
+    bet_buffer,
+    pending_reservations,
+    release_orphaned_reservations,
+    release_round_reservations,
+)
+
+
+logger = logging.getLogger(__name__)
+
+BETTING_WINDOW_SECONDS = 5
+CRASH_DISPLAY_SECONDS = 2
+ROUND_GAP_SECONDS = 2
+
+MAX_CRASH_POINT = 20.0
+# public salt mixed into every round; published so players can verify
+CLIENT_SEED = os.getenv("AVIATOR_CLIENT_SEED", "aviator")
 
 
 # -------------------
@@ -22,14 +53,19 @@ def generate_crash_point():
         return min(crash, 20.0)  # Hard cap at 20x
 
 
+def crash_point_from_seed(server_seed: str, nonce: int, client_seed: str = CLIENT_SEED):
+    crash = calculate_crash_point(server_seed, client_seed, nonce)
+    return min(crash, MAX_CRASH_POINT)
+
+
 # -------------------
 # ROUND CONTROL
 # -------------------
-def create_new_round():
-    crash = generate_crash_point()
-    now = datetime.utcnow()
+def create_new_round(epoch: int):
+    with engine_game.begin() as conn:
+        # only the current engine leader may open rounds
+        check_epoch(conn, epoch)
 
-    with engine.begin() as conn:
         active = conn.execute(
             text("""
                 SELECT id FROM game_rounds
@@ -41,72 +77,169 @@ def create_new_round():
         if active:
             return None
 
-        conn.execute(
+        # the seed's hash is stored (and published) before betting opens
+        server_seed, nonce = hash_chain.pop()
+        crash = crash_point_from_seed(server_seed, nonce)
+
+        round_id, betting_close_at = conn.execute(
             text("""
                 INSERT INTO game_rounds
-                (crash_point, status, betting_close_at, created_at)
-                VALUES (:c, 'open', :n + INTERVAL '5 seconds', :n)
+                (crash_point, status, server_seed, server_hash, client_seed,
+                 nonce, betting_close_at, created_at)
+                VALUES (:c, 'open', :seed, :hash, :client, :n,
+                    NOW() + make_interval(secs => :w), NOW())
+                RETURNING id, betting_close_at
             """),
-            {"c": crash, "n": now}
-        )
+            {
+                "c": crash,
+                "seed": server_seed,
+                "hash": hash_seed(server_seed),
+                "client": CLIENT_SEED,
+                "n": nonce,
+                "w": BETTING_WINDOW_SECONDS,
+            }
+        ).fetchone()
+
+    return round_id, crash, betting_close_at
 
-    return crash
 
+def start_round(round_id, epoch: int):
+    # started_at is set at takeoff by the multiplier engine
+    with engine_game.begin() as conn:
+        check_epoch(conn, epoch)
 
-def start_round(round_id):
-    with engine.begin() as conn:
-        conn.execute(
+        row = conn.execute(
             text("""
                 UPDATE game_rounds
-                SET status='running', started_at=:n
-                WHERE id=:r
+                SET status='running'
+                WHERE id=:r AND status='open'
+                RETURNING id
             """),
-            {"r": round_id, "n": datetime.utcnow()}
-        )
+            {"r": round_id}
+        ).fetchone()
 
+    if row is None:
+        raise RuntimeError(f"round {round_id} is no longer open")
 
-def crash_round(round_id):
-    with engine.begin() as conn:
-        conn.execute(
-            text("""
+
+ROUND_SUMMARY_COLUMNS = """
+    id, crash_point, server_hash, server_seed, created_at, started_at, ended_at
+"""
+
+
+def _round_summary(row):
+    round_id, crash, server_hash, server_seed, created_at, started_at, ended_at = row
+    return {
+        "round_id": round_id,
+        "crash_point": float(crash),
+        "server_hash": server_hash,
+        "server_seed": server_seed,
+        "created_at": created_at,
+        "started_at": started_at,
+        "ended_at": ended_at,
+    }
+
+
+def crash_round(round_id, epoch: int):
+    """Marks the running round crashed and returns its summary."""
+    with engine_game.begin() as conn:
+        check_epoch(conn, epoch)
+
+        row = conn.execute(
+            text(f"""
                 UPDATE game_rounds
-                SET status='crashed', ended_at=:n
-                WHERE id=:r
+                SET status='crashed', ended_at=NOW()
+                WHERE id=:r AND status='running'
+                RETURNING {ROUND_SUMMARY_COLUMNS}
             """),
-            {"r": round_id, "n": datetime.utcnow()}
-        )
+            {"r": round_id}
+        ).fetchone()
+
+    if row is None:
+        raise RuntimeError(f"round {round_id} is no longer running")
+
+    return _round_summary(row)
+
 
+def close_round(round_id, epoch: int):
+    """Closes round_id if it crashed. Returns True if closed."""
+    with engine_game.begin() as conn:
+        check_epoch(conn, epoch)
 
-def close_round(round_id):
-    with engine.begin() as conn:
-        conn.execute(
+        row = conn.execute(
             text("""
                 UPDATE game_rounds
                 SET status='closed'
-                WHERE id=:r
+                WHERE id=:r AND status='crashed'
+                RETURNING id
             """),
             {"r": round_id}
-        )
+        ).fetchone()
 
+    return row is not None
 
-def get_current_round():
-    with engine.connect() as conn:
-        return conn.execute(
+
+def void_active_rounds():
+    """
+    Voids rounds a previous engine leader left open or running; their
+    outcome was never played out. Returns the voided round ids.
+    """
+    with engine_game.begin() as conn:
+        rows = conn.execute(
             text("""
-                SELECT id, crash_point, status, betting_close_at
-                FROM game_rounds
+                UPDATE game_rounds
+                SET status='voided', ended_at=NOW()
                 WHERE status IN ('open','running')
-                ORDER BY id DESC
-                LIMIT 1
+                RETURNING id
             """)
+        ).fetchall()
+
+    return [row[0] for row in rows]
+
+
+def void_round(round_id, epoch: int):
+    """Voids round_id unless it already crashed. Returns True if voided."""
+    with engine_game.begin() as conn:
+        check_epoch(conn, epoch)
+
+        row = conn.execute(
+            text("""
+                UPDATE game_rounds
+                SET status='voided', ended_at=NOW()
+                WHERE id=:r AND status IN ('open','running')
+                RETURNING id
+            """),
+            {"r": round_id}
         ).fetchone()
 
+    return row is not None
+
+
+CURRENT_ROUND_SQL = text("""
+    SELECT id, server_hash, status, betting_close_at
+    FROM game_rounds
+    WHERE status IN ('open','running')
+    ORDER BY id DESC
+    LIMIT 1
+""")
+
+
+def get_current_round():
+    with engine.connect() as conn:
+        return conn.execute(CURRENT_ROUND_SQL).fetchone()
+
+
+async def get_current_round_async():
+    async with async_engine().connect() as conn:
+        return (await conn.execute(CURRENT_ROUND_SQL)).fetchone()
+
+
 def get_recent_rounds(limit=20):
     """Get recent completed rounds with their crash points"""
     with engine.connect() as conn:
         results = conn.execute(
-            text("""
-                SELECT crash_point, ended_at
+            text(f"""
+                SELECT {ROUND_SUMMARY_COLUMNS}
                 FROM game_rounds
                 WHERE ended_at IS NOT NULL
                 AND status IN ('crashed', 'closed')
@@ -115,41 +248,271 @@ def get_recent_rounds(limit=20):
             """),
             {"limit": limit}
         ).fetchall()
-        
-        return [{"crash_point": float(row[0]), "ended_at": row[1]} for row in results]
+
+    return [_round_summary(row) for row in results]
+
+
+def settle_losses(round_id):
+    with engine_settlement_duration.labels("crash").time():
+        return settle_bets(round_id, [], lose_remaining=True)
+
 
 # -------------------
-# GAME LOOP (THREAD)
+# VERIFICATION
 # -------------------
-def game_loop():
-    import time
+def get_round_proof(round_id: int):
+    """
+    Recomputes a finished round from its revealed seed. The seed of the
+    previous round in the chain must be the hash of this one.
+    """
+    with engine.connect() as conn:
+        row = conn.execute(
+            text("""
+                SELECT r.id, r.crash_point, r.server_seed, r.server_hash,
+                    r.client_seed, r.nonce, prev.server_seed
+                FROM game_rounds r
+                LEFT JOIN LATERAL (
+                    SELECT server_seed FROM game_rounds
+                    WHERE id < r.id AND server_seed IS NOT NULL
+                    ORDER BY id DESC
+                    LIMIT 1
+                ) prev ON TRUE
+                WHERE r.id = :r
+                AND r.status IN ('crashed', 'closed')
+                AND r.server_seed IS NOT NULL
+            """),
+            {"r": round_id}
+        ).fetchone()
 
-    while True:
-        result = create_new_round()
-        if not result:
-            time.sleep(1)
-            continue
-
-        with engine.connect() as conn:
-            round_id, crash, *_ = conn.execute(
-                text("""
-                    SELECT id, crash_point
-                    FROM game_rounds
-                    WHERE status='open'
-                    ORDER BY id DESC LIMIT 1
-                """)
-            ).fetchone()
-
-        time.sleep(5)  # betting window
-        start_round(round_id)
-
-        t = threading.Thread(
-            target=run_multiplier,
-            args=(round_id, crash),
-            daemon=False
+    if not row:
+        return None
+
+    _, crash, server_seed, server_hash, client_seed, nonce, previous_seed = row
+    expected = crash_point_from_seed(server_seed, nonce, client_seed)
+
+    return {
+        "round_id": round_id,
+        "crash_point": float(crash),
+        "server_seed": server_seed,
+        "server_hash": server_hash,
+        "client_seed": client_seed,
+        "nonce": nonce,
+        "computed_crash_point": expected,
+        "hash_valid": hash_seed(server_seed) == server_hash,
+        "crash_valid": expected == float(crash),
+        # a new chain starts a new link, so a mismatch is not proof of tampering
+        "previous_seed": previous_seed,
+        "chain_link_valid": previous_seed == server_hash,
+    }
+
+
+# -------------------
+# RECENT ROUNDS BUFFER
+# -------------------
+RECENT_ROUNDS_SIZE = 20
+RECENT_ROUNDS_REFRESH_SECONDS = 5
+
+
+def _json_default(value):
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)
+
+
+class RecentRounds:
+    """
+    Ring buffer of the last completed rounds, kept pre-serialized with
+    an ETag derived from the newest round id.
+
+    The process running the engine pushes every crashed round. Other
+    processes, and the engine's once it loses leadership, reload from
+    the database at most every RECENT_ROUNDS_REFRESH_SECONDS.
+    """
+
+    def __init__(self, size: int):
+        self._lock = threading.Lock()
+        self._rounds = deque(maxlen=size)
+        self._body = None
+        self._etag = None
+        self._loaded_at = 0.0
+        self._live = False
+        self.size = size
+
+    def _render(self):
+        rounds = list(reversed(self._rounds))
+        self._body = json.dumps(
+            {"recent_rounds": rounds}, default=_json_default
+        ).encode()
+        self._etag = f'"r{rounds[0]["round_id"]}"' if rounds else '"r0"'
+
+    def _load(self):
+        self._rounds.clear()
+        self._rounds.extend(reversed(get_recent_rounds(self.size)))
+        self._loaded_at = time.monotonic()
+
+    def push(self, summary: dict):
+        with self._lock:
+            # the first push after the engine (re)starts here backfills
+            # from the database, which already holds the pushed round
+            if not self._live:
+                self._load()
+            if not self._rounds or self._rounds[-1]["round_id"] != summary["round_id"]:
+                self._rounds.append(summary)
+            self._live = True
+            self._render()
+
+    def mark_stale(self):
+        """This process stopped running the engine: reload from now on."""
+        with self._lock:
+            self._live = False
+            self._loaded_at = 0.0
+
+    def _stale(self):
+        if self._body is None:
+            return True
+        return (
+            not self._live
+            and time.monotonic() - self._loaded_at > RECENT_ROUNDS_REFRESH_SECONDS
         )
-        t.start()
 
-        # Wait for the round to complete before starting next one
-        t.join()
-        time.sleep(2)  # buffer before next round
+    def snapshot(self):
+        """Returns (etag, body)."""
+        if self._stale():
+            with self._lock:
+                if self._stale():
+                    self._load()
+                    self._render()
+
+        return self._etag, self._body
+
+
+recent_rounds = RecentRounds(RECENT_ROUNDS_SIZE)
+
+
+# -------------------
+# GAME LOOP (ASYNCIO)
+# -------------------
+async def await_round_bets(round_id: int):
+    """
+    Flush barrier: returns once every bet reserved for round_id, in any
+    process, is written. Bets still unwritten after BET_FLUSH_TIMEOUT
+    are refunded, which also stops a late flush from writing them.
+    """
+    await run_db(bet_buffer.flush)
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + BET_FLUSH_TIMEOUT
+
+    while await run_db(pending_reservations, round_id):
+        if loop.time() >= deadline:
+            refunded = await run_db(release_round_reservations, round_id)
+            logger.warning(
+                "Refunded unflushed bets of round %s for %d users",
+                round_id, len(refunded),
+            )
+            return
+        await asyncio.sleep(BET_FLUSH_INTERVAL)
+
+
+async def recover_orphaned_rounds():
+    """
+    Refunds the bets of rounds left behind by a leader that died.
+    Runs once per election, before the first round.
+    """
+    voided = await run_db(void_active_rounds)
+    if not voided:
+        return
+
+    # unwritten bets are refunded first: once their reservations are
+    # gone no buffer can still write them into a voided round
+    await run_db(release_orphaned_reservations)
+
+    for round_id in voided:
+        await run_db(refund_round_bets, round_id)
+        broadcaster.publish("round_voided", round_id=round_id)
+        logger.warning("Voided orphaned round %s", round_id)
+
+
+async def abandon_round(round_id: int, epoch: int):
+    """
+    Cleans up a round whose lifecycle failed part way, so the next one
+    can open. A round that never crashed is voided and its bets
+    refunded; a crashed one has its remaining bets lost and is closed.
+    """
+    if await run_db(void_round, round_id, epoch):
+        await run_db(release_round_reservations, round_id)
+        await run_db(refund_round_bets, round_id)
+        broadcaster.publish("round_voided", round_id=round_id)
+        logger.warning("Voided failed round %s", round_id)
+        return
+
+    await run_db(settle_losses, round_id)
+    await run_db(release_orphaned_reservations)
+    if await run_db(close_round, round_id, epoch):
+        broadcaster.publish("round_closed", round_id=round_id)
+
+
+async def run_round(epoch: int, round_id: int, crash, betting_close_at):
+    """
+    Drives one created round through its whole lifecycle:
+    open -> running -> crashed -> closed
+    """
+    broadcaster.publish(
+        "round_open",
+        round_id=round_id,
+        betting_close_at=betting_close_at,
+    )
+
+    await asyncio.sleep(BETTING_WINDOW_SECONDS)
+    await run_db(start_round, round_id, epoch)
+    broadcaster.publish("betting_closed", round_id=round_id)
+
+    # bets reserved before the close may still sit in ingestion buffers
+    await await_round_bets(round_id)
+
+    await run_multiplier(round_id, crash)
+
+    summary = await run_db(crash_round, round_id, epoch)
+    # the first push may backfill from the database
+    await run_db(recent_rounds.push, summary)
+    broadcaster.publish("crash", round_id=round_id, crash_point=float(crash))
+
+    # lose remaining bets
+    await run_db(settle_losses, round_id)
+
+    await asyncio.sleep(CRASH_DISPLAY_SECONDS)
+    await run_db(release_orphaned_reservations)
+    if not await run_db(close_round, round_id, epoch):
+        raise RuntimeError(f"round {round_id} is no longer crashed")
+    broadcaster.publish("round_closed", round_id=round_id)
+
+    await asyncio.sleep(ROUND_GAP_SECONDS)  # buffer before next round
+
+
+async def game_loop(epoch: int):
+    """Runs rounds for as long as epoch is the current leadership."""
+    await recover_orphaned_rounds()
+
+    # a round that failed stays active and would block every next one,
+    # so it is cleaned up (retried until that succeeds) first
+    in_flight = None
+
+    while True:
+        try:
+            if in_flight is not None:
+                await abandon_round(in_flight, epoch)
+                in_flight = None
+
+            created = await run_db(create_new_round, epoch)
+            if not created:
+                await asyncio.sleep(1)
+                continue
+
+            in_flight = created[0]
+            await run_round(epoch, *created)
+            in_flight = None
+        except (asyncio.CancelledError, LeadershipLost):
+            raise
+        except Exception:
+            logger.exception("Aviator round failed")
+            await asyncio.sleep(1)
@@ -1,47 +1,458 @@
+import logging
+import os
+import threading
+import time
+from decimal import Decimal
 from sqlalchemy import text
-from database import engine
-from services.wallet_service import debit_wallet
-from services.aviator_service import get_current_round
+from database import async_engine, engine, engine_game
+from services.settings_service import get_settings, get_settings_async
+from services.wallet_service import balance_cache, cache_balances
+
+
+logger = logging.getLogger(__name__)
 
 
 MAX_BET = 50000
 
 
-def place_bet(user_id: int, amount: float, auto_cashout: float | None):
+# Validates the round, debits the wallet, writes the ledger row and
+# inserts the bet in one statement. FOR SHARE makes start_round wait for
+# in-flight bets, so every accepted bet is visible when betting closes.
+PLACE_BET_SQL = text("""
+    WITH r AS (
+        SELECT id, status
+        FROM game_rounds
+        WHERE status IN ('open', 'running')
+        ORDER BY id DESC
+        LIMIT 1
+        FOR SHARE
+    ),
+    w AS (
+        UPDATE wallets
+        SET balance = balance - CAST(:a AS NUMERIC),
+            updated_at = NOW()
+        WHERE user_id = :u
+        AND balance >= CAST(:a AS NUMERIC)
+        AND EXISTS (SELECT 1 FROM r WHERE status = 'open')
+        RETURNING balance
+    ),
+    tx AS (
+        INSERT INTO transactions
+        (user_id, amount, type, balance_before, balance_after, status, reference)
+        SELECT :u, CAST(:a AS NUMERIC), 'bet', w.balance + CAST(:a AS NUMERIC),
+            w.balance, 'completed', 'bet_round_' || r.id
+        FROM w, r
+    ),
+    b AS (
+        INSERT INTO bets
+        (user_id, round_id, bet_amount, auto_cashout, status)
+        SELECT :u, r.id, CAST(:a AS NUMERIC), CAST(:ac AS NUMERIC), 'active'
+        FROM w, r
+        RETURNING id
+    )
+    SELECT
+        (SELECT id FROM r),
+        (SELECT status FROM r),
+        (SELECT balance FROM w),
+        (SELECT id FROM b),
+        EXISTS (SELECT 1 FROM wallets WHERE user_id = :u)
+""")
+
+
+def validate_bet(amount: float):
+    _check_bet(amount, get_settings())
+
+
+async def validate_bet_async(amount: float):
+    _check_bet(amount, await get_settings_async())
+
+
+def _check_bet(amount: float, settings: dict):
     if amount <= 0:
         raise ValueError("Invalid bet amount")
 
     if amount > MAX_BET:
         raise ValueError("Bet exceeds max limit")
 
-    round_data = get_current_round()
-    if not round_data:
-        raise ValueError("No active round")
+    # bets are debits and follow the same limits as debit_wallet
+    if not settings["withdraw_enabled"]:
+        raise ValueError("Withdrawals are disabled")
+
+    if amount < settings["min_withdraw"]:
+        raise ValueError("Withdraw below minimum limit")
+
 
-    round_id, _, status, betting_close_at = round_data
+def _bet_result(row):
+    round_id, status, balance, bet_id, wallet_exists = row
+
+    if round_id is None:
+        raise ValueError("No active round")
 
     if status != "open":
         raise ValueError("Betting closed")
 
-    # debit wallet immediately
-    debit_wallet(
-        user_id=user_id,
-        amount=amount,
-        tx_type="bet",
-        reference=f"bet_round_{round_id}"
+    if bet_id is None:
+        if not wallet_exists:
+            raise ValueError("Wallet not found")
+        raise ValueError("Insufficient balance")
+
+    return {
+        "bet_id": int(bet_id),
+        "round_id": int(round_id),
+        "balance": float(balance),
+    }
+
+
+def place_bet(user_id: int, amount: float, auto_cashout: float | None):
+    validate_bet(amount)
+
+    with engine.begin() as conn:
+        row = conn.execute(
+            PLACE_BET_SQL,
+            {"u": user_id, "a": amount, "ac": auto_cashout}
+        ).fetchone()
+
+    bet = _bet_result(row)
+    balance_cache.set(user_id, bet["balance"])
+    return bet
+
+
+# -------------------
+# BUFFERED INGESTION
+# -------------------
+# Bets arrive in a burst during the betting window. Each request only
+# reserves the stake (balance -> locked_balance) and records a
+# reservation under a bet id drawn from bets_id_seq, in one statement.
+# The flusher writes the bet and ledger rows in batches, claiming each
+# reservation as it does; a reservation that is refunded first can no
+# longer be written as a bet.
+RESERVE_BET_SQL = text("""
+    WITH r AS (
+        SELECT id, status
+        FROM game_rounds
+        WHERE status IN ('open', 'running')
+        ORDER BY id DESC
+        LIMIT 1
+        FOR SHARE
+    ),
+    w AS (
+        UPDATE wallets
+        SET balance = balance - CAST(:a AS NUMERIC),
+            locked_balance = locked_balance + CAST(:a AS NUMERIC),
+            updated_at = NOW()
+        WHERE user_id = :u
+        AND balance >= CAST(:a AS NUMERIC)
+        AND EXISTS (SELECT 1 FROM r WHERE status = 'open')
+        RETURNING balance
+    ),
+    res AS (
+        INSERT INTO bet_reservations (bet_id, user_id, round_id, amount)
+        SELECT nextval('bets_id_seq'), :u, r.id, CAST(:a AS NUMERIC)
+        FROM w, r
+        RETURNING bet_id
+    )
+    SELECT
+        (SELECT id FROM r),
+        (SELECT status FROM r),
+        (SELECT balance FROM w),
+        (SELECT bet_id FROM res),
+        EXISTS (SELECT 1 FROM wallets WHERE user_id = :u),
+        NOW()
+""")
+
+BET_FLUSH_INTERVAL = float(os.getenv("BET_FLUSH_INTERVAL", "0.005"))
+BET_FLUSH_RETRIES = 3
+
+# how long the engine waits after betting closes for every process's
+# buffered bets to land; reservations still pending are refunded
+BET_FLUSH_TIMEOUT = float(os.getenv("BET_FLUSH_TIMEOUT", "2"))
+
+
+# Writes only the bets whose reservation this statement claims, and
+# releases exactly the claimed stakes from locked_balance
+WRITE_BETS_SQL = text("""
+    WITH v AS (
+        SELECT *
+        FROM unnest(
+            CAST(:ids AS BIGINT[]),
+            CAST(:autos AS NUMERIC[]),
+            CAST(:balances AS NUMERIC[]),
+            CAST(:created AS TIMESTAMPTZ[])
+        ) AS v(id, auto, balance, created_at)
+    ),
+    claimed AS (
+        DELETE FROM bet_reservations
+        WHERE bet_id IN (SELECT id FROM v)
+        RETURNING bet_id, user_id, round_id, amount
+    ),
+    b AS (
+        INSERT INTO bets
+        (id, user_id, round_id, bet_amount, auto_cashout, status, created_at)
+        SELECT c.bet_id, c.user_id, c.round_id, c.amount, v.auto, 'active', v.created_at
+        FROM claimed c
+        JOIN v ON v.id = c.bet_id
+    ),
+    tx AS (
+        INSERT INTO transactions
+        (user_id, amount, type, balance_before, balance_after, status, reference, created_at)
+        SELECT c.user_id, c.amount, 'bet', v.balance + c.amount, v.balance,
+            'completed', 'bet_round_' || c.round_id, v.created_at
+        FROM claimed c
+        JOIN v ON v.id = c.bet_id
+    ),
+    unlocked AS (
+        UPDATE wallets
+        SET locked_balance = locked_balance - per_user.total
+        FROM (
+            SELECT user_id, SUM(amount) AS total
+            FROM claimed
+            GROUP BY user_id
+        ) AS per_user
+        WHERE wallets.user_id = per_user.user_id
     )
+    SELECT COUNT(*) FROM claimed
+""")
+
+
+# the engine waits on the flush when betting closes, so it writes
+# through the game pool rather than queueing behind API requests
+def _write_bets(batch):
+    columns = {"ids": [], "autos": [], "balances": [], "created": []}
+    for bet_id, _, _, _, auto, balance, created_at in batch:
+        columns["ids"].append(bet_id)
+        columns["autos"].append(auto)
+        columns["balances"].append(balance)
+        columns["created"].append(created_at)
+
+    with engine_game.begin() as conn:
+        written = conn.execute(WRITE_BETS_SQL, columns).scalar()
+
+    if written < len(batch):
+        logger.warning(
+            "%d buffered bets were refunded before they were written",
+            len(batch) - written,
+        )
+    return written
+
+
+class BetBuffer:
+    """
+    Per-process buffer of reserved bets, flushed every
+    BET_FLUSH_INTERVAL seconds while bets keep arriving and explicitly
+    by the engine when betting closes.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pending = []
+        self._thread = None
+        self._stop = None
+
+    def add(self, entry):
+        with self._lock:
+            self._pending.append(entry)
+            if self._thread is None:
+                self._stop = threading.Event()
+                self._thread = threading.Thread(
+                    target=self._run, args=(self._stop,), name="bet-flush", daemon=True
+                )
+                self._thread.start()
+
+        self._wakeup.set()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _run(self, stop):
+        while not stop.is_set():
+            self._wakeup.wait()
+            if stop.is_set():
+                return
+            time.sleep(self.interval)  # let the batch fill up
+            self._wakeup.clear()
+            self.flush()
+
+    def stop(self):
+        """
+        Stops the flusher thread and writes what is left before
+        returning. The next add starts a new thread.
+        """
+        with self._lock:
+            thread, stop = self._thread, self._stop
+            self._thread = None
+
+        if thread is not None:
+            stop.set()
+            self._wakeup.set()
+            thread.join()
+
+        self.flush()
+
+    def flush(self):
+        # one flush at a time, so returning means every bet added
+        # before the call is in the database or refunded
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+
+            if not batch:
+                return 0
+
+            for attempt in range(1, BET_FLUSH_RETRIES + 1):
+                try:
+                    return _write_bets(batch)
+                except Exception:
+                    if attempt == BET_FLUSH_RETRIES:
+                        logger.exception("Failed to write %d buffered bets", len(batch))
+                        break
+                    time.sleep(0.05 * attempt)
+
+            try:
+                release_reservations([entry[0] for entry in batch])
+            except Exception:
+                # still reserved: refunded by the engine's next sweep
+                logger.exception("Failed to refund %d buffered bets", len(batch))
+            return 0
+
+
+bet_buffer = BetBuffer(BET_FLUSH_INTERVAL)
+
+
+def submit_bet(user_id: int, amount: float, auto_cashout: float | None):
+    """
+    Reserves the stake and queues the bet for the next flush.
+    The returned bet_id comes from bets_id_seq and is durable.
+    """
+    validate_bet(amount)
 
     with engine.begin() as conn:
-        conn.execute(
-            text("""
-                INSERT INTO bets
-                (user_id, round_id, bet_amount, auto_cashout, status)
-                VALUES (:u, :r, :a, :ac, 'active')
-            """),
+        row = conn.execute(
+            RESERVE_BET_SQL,
+            {"u": user_id, "a": amount, "ac": auto_cashout}
+        ).fetchone()
+
+    return _buffer_bet(row, user_id, amount, auto_cashout)
+
+
+async def submit_bet_async(user_id: int, amount: float, auto_cashout: float | None):
+    await validate_bet_async(amount)
+
+    # asyncpg binds NUMERIC parameters from Decimal, not float
+    async with async_engine().begin() as conn:
+        row = (await conn.execute(
+            RESERVE_BET_SQL,
             {
                 "u": user_id,
-                "r": round_id,
-                "a": amount,
-                "ac": auto_cashout
+                "a": Decimal(str(amount)),
+                "ac": None if auto_cashout is None else Decimal(str(auto_cashout)),
             }
-        )
+        )).fetchone()
+
+    return _buffer_bet(row, user_id, amount, auto_cashout)
+
+
+def _buffer_bet(row, user_id: int, amount: float, auto_cashout: float | None):
+    bet = _bet_result(row[:5])
+    balance_cache.set(user_id, bet["balance"])
+    bet_buffer.add((
+        bet["bet_id"],
+        user_id,
+        bet["round_id"],
+        float(amount),
+        None if auto_cashout is None else float(auto_cashout),
+        bet["balance"],
+        row[5],
+    ))
+
+    return bet
+
+
+# -------------------
+# RESERVATIONS
+# -------------------
+def pending_reservations(round_id: int):
+    """Bets of round_id reserved but not yet written by any process."""
+    with engine_game.connect() as conn:
+        return conn.execute(
+            text("SELECT COUNT(*) FROM bet_reservations WHERE round_id = :r"),
+            {"r": round_id}
+        ).scalar()
+
+
+def _release(condition: str, params: dict):
+    # claims the reservations like a flush would, so a bet is either
+    # written or refunded, never both
+    with engine_game.begin() as conn:
+        rows = conn.execute(
+            text(f"""
+                WITH released AS (
+                    DELETE FROM bet_reservations
+                    WHERE {condition}
+                    RETURNING bet_id, user_id, amount
+                ),
+                credited AS (
+                    UPDATE wallets
+                    SET balance = wallets.balance + per_user.total,
+                        locked_balance = wallets.locked_balance - per_user.total,
+                        updated_at = NOW()
+                    FROM (
+                        SELECT user_id, SUM(amount) AS total
+                        FROM released
+                        GROUP BY user_id
+                    ) AS per_user
+                    WHERE wallets.user_id = per_user.user_id
+                    RETURNING wallets.user_id, wallets.balance
+                ),
+                ledger AS (
+                    INSERT INTO transactions
+                    (user_id, amount, type, balance_before, balance_after, status, reference)
+                    SELECT
+                        r.user_id,
+                        r.amount,
+                        'bet_refund',
+                        c.balance - r.later - r.amount,
+                        c.balance - r.later,
+                        'completed',
+                        'released_bet_' || r.bet_id
+                    FROM (
+                        SELECT bet_id, user_id, amount,
+                            COALESCE(SUM(amount) OVER (
+                                PARTITION BY user_id ORDER BY bet_id
+                                ROWS BETWEEN 1 FOLLOWING AND UNBOUNDED FOLLOWING
+                            ), 0) AS later
+                        FROM released
+                    ) AS r
+                    JOIN credited c ON c.user_id = r.user_id
+                )
+                SELECT user_id, balance FROM credited
+            """),
+            params
+        ).fetchall()
+
+    balances = {int(row[0]): float(row[1]) for row in rows}
+    cache_balances(balances)
+    return balances
+
+
+def release_reservations(bet_ids):
+    """Refunds the given reserved bets. Returns {user_id: balance_after}."""
+    return _release("bet_id = ANY(CAST(:ids AS BIGINT[]))", {"ids": list(bet_ids)})
+
+
+def release_round_reservations(round_id: int):
+    """Refunds the bets of round_id that were never written."""
+    return _release("round_id = :r", {"r": round_id})
+
+
+def release_orphaned_reservations():
+    """
+    Refunds every reservation whose round no longer takes bets, e.g.
+    because a worker died before flushing.
+    """
+    return _release(
+        "round_id NOT IN (SELECT id FROM game_rounds WHERE status = 'open')",
+        {}
+    )
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import threading
+import time
+
+
+# -------------------
+# SUBSCRIPTION
+# -------------------
+class Subscription:
+    def __init__(self, loop, max_queue: int):
+        self.loop = loop
+        self.queue = asyncio.Queue(max_queue)
+
+    def offer(self, message: str):
+        # slow consumers lose their oldest messages, never block the engine
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(message)
+
+    async def get(self):
+        return await self.queue.get()
+
+
+def _fan_out(subscriptions, message: str):
+    for subscription in subscriptions:
+        subscription.offer(message)
+
+
+# -------------------
+# ROUND BROADCASTER
+# -------------------
+class RoundBroadcaster:
+    """
+    In-process pub/sub for round lifecycle events.
+
+    The engine publishes each event once; it is serialized once and
+    handed to every event loop with a single call, which then fans it
+    out to that loop's subscribers. When forward is set, every message
+    is also passed to it (the engine leader relays events to standby
+    processes, which deliver them with publish_message).
+    """
+
+    def __init__(self, max_queue: int = 256):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._max_queue = max_queue
+        self._last_state = None
+        self._last_tick = None
+        self._last_event = None
+        self.forward = None
+
+    def subscribe(self):
+        loop = asyncio.get_running_loop()
+        subscription = Subscription(loop, self._max_queue)
+
+        with self._lock:
+            # late joiners start from the current round state
+            for message in (self._last_state, self._last_tick):
+                if message is not None:
+                    subscription.offer(message)
+            self._subscribers.setdefault(loop, set()).add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscribers.get(subscription.loop)
+            if subscriptions is None:
+                return
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscribers[subscription.loop]
+
+    def current_state(self):
+        """Name of the last lifecycle event, e.g. "takeoff" while flying."""
+        return self._last_event
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(s) for s in self._subscribers.values())
+
+    def publish(self, event: str, **data):
+        message = json.dumps(
+            {"event": event, "server_time": time.time(), **data},
+            default=str,
+        )
+        self.publish_message(event, message)
+
+        forward = self.forward
+        if forward is not None:
+            forward(message)
+
+    def publish_message(self, event: str, message: str):
+        with self._lock:
+            if event == "tick":
+                self._last_tick = message
+            else:
+                self._last_state = message
+                self._last_event = event
+                self._last_tick = None
+
+            targets = [
+                (loop, tuple(subscriptions))
+                for loop, subscriptions in self._subscribers.items()
+            ]
+
+        for loop, subscriptions in targets:
+            try:
+                loop.call_soon_threadsafe(_fan_out, subscriptions, message)
+            except RuntimeError:
+                # event loop already closed
+                with self._lock:
+                    self._subscribers.pop(loop, None)
+
+
+broadcaster = RoundBroadcaster()
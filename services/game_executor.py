@@ -0,0 +1,19 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+
+# -------------------
+# GAME ENGINE DB EXECUTOR
+# -------------------
+# The engine runs on the event loop; its blocking DB calls go through one
+# dedicated thread so they never queue behind request handlers and are
+# applied in the order they were scheduled.
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="aviator-db")
+
+
+async def run_db(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _executor, functools.partial(fn, *args, **kwargs)
+    )
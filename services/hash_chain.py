@@ -0,0 +1,181 @@
+"""
+Precomputed provably-fair seed chain.
+
+A chain is a binary file of 32-byte SHA-256 digests stored in the order
+rounds consume them, where entry[i] == sha256(entry[i + 1]). Revealing a
+round's seed therefore proves the seed of the round before it, and the
+whole chain is committed to by sha256(entry[0]).
+
+index.json keeps the active file, the cursor and the next precomputed
+chain. Chains are generated by a background thread before the active one
+runs out; pops are an O(1) read from a memory map.
+"""
+
+import fcntl
+import hashlib
+import json
+import logging
+import mmap
+import os
+import secrets
+import threading
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
+
+DIGEST_SIZE = 32
+
+HASH_CHAIN_DIR = os.getenv("HASH_CHAIN_DIR", "hash_chain")
+HASH_CHAIN_LENGTH = int(os.getenv("HASH_CHAIN_LENGTH", "1000000"))
+# generate the next chain once fewer seeds than this are left
+HASH_CHAIN_REFILL_AT = int(os.getenv("HASH_CHAIN_REFILL_AT", "100000"))
+# short chain generated inline when nothing has been precomputed yet
+HASH_CHAIN_BOOTSTRAP_LENGTH = 10000
+
+
+def hash_seed(seed_hex: str):
+    return hashlib.sha256(bytes.fromhex(seed_hex)).hexdigest()
+
+
+class HashChain:
+    def __init__(self, directory: str, length: int, refill_at: int):
+        self.directory = directory
+        self.length = length
+        self.refill_at = refill_at
+
+        self._lock = threading.Lock()
+        self._generating = False
+        self._mapped_name = None
+        self._mmap = None
+
+    # -------------------
+    # FILES
+    # -------------------
+    def _path(self, name: str):
+        return os.path.join(self.directory, name)
+
+    @contextmanager
+    def _index_lock(self):
+        # several workers on one host share the chain files
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._path("index.lock"), "w") as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+    def _read_index(self):
+        try:
+            with open(self._path("index.json")) as handle:
+                return json.load(handle)
+        except FileNotFoundError:
+            return None
+
+    def _write_index(self, index: dict):
+        tmp = self._path("index.json.tmp")
+        with open(tmp, "w") as handle:
+            json.dump(index, handle)
+        os.replace(tmp, self._path("index.json"))
+
+    def _generate(self, length: int):
+        """Writes a new chain file and returns its index entry."""
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"chain_{secrets.token_hex(8)}.bin"
+
+        digests = bytearray(length * DIGEST_SIZE)
+        digest = secrets.token_bytes(DIGEST_SIZE)
+        for i in range(length - 1, -1, -1):
+            digests[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE] = digest
+            digest = hashlib.sha256(digest).digest()
+
+        tmp = self._path(name + ".tmp")
+        with open(tmp, "wb") as handle:
+            handle.write(digests)
+        os.replace(tmp, self._path(name))
+
+        return {
+            "name": name,
+            "length": length,
+            "terminal_hash": digest.hex(),
+        }
+
+    def _map(self, name: str):
+        if name == self._mapped_name:
+            return
+
+        if self._mmap is not None:
+            self._mmap.close()
+
+        with open(self._path(name), "rb") as handle:
+            self._mmap = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mapped_name = name
+
+    # -------------------
+    # SEEDS
+    # -------------------
+    def pop(self):
+        """Returns (seed_hex, position) of the next unused seed."""
+        with self._lock, self._index_lock():
+            index = self._read_index()
+
+            if index is None or (
+                index["cursor"] >= index["length"] and not index.get("next")
+            ):
+                chain = self._generate(HASH_CHAIN_BOOTSTRAP_LENGTH)
+                index = {"active": chain, "cursor": 0, "next": None}
+            elif index["cursor"] >= index["length"]:
+                os.remove(self._path(index["active"]["name"]))
+                index = {"active": index["next"], "cursor": 0, "next": None}
+
+            index["length"] = index["active"]["length"]
+            self._map(index["active"]["name"])
+
+            position = index["cursor"]
+            seed = self._mmap[position * DIGEST_SIZE:(position + 1) * DIGEST_SIZE]
+
+            # persist before use: a seed is never handed out twice
+            index["cursor"] = position + 1
+            self._write_index(index)
+
+            refill = (
+                index["next"] is None
+                and index["length"] - index["cursor"] <= self.refill_at
+            )
+
+        if refill:
+            self._start_refill()
+
+        return seed.hex(), position
+
+    def _start_refill(self):
+        with self._lock:
+            if self._generating:
+                return
+            self._generating = True
+
+        threading.Thread(target=self._refill, name="hash-chain", daemon=True).start()
+
+    def _refill(self):
+        try:
+            chain = self._generate(self.length)
+
+            with self._lock, self._index_lock():
+                index = self._read_index()
+                if index is not None and index.get("next") is None:
+                    index["next"] = chain
+                    self._write_index(index)
+                    chain = None
+
+            if chain is not None:
+                # another worker got there first
+                os.remove(self._path(chain["name"]))
+        except Exception:
+            logger.exception("Hash chain generation failed")
+        finally:
+            with self._lock:
+                self._generating = False
+
+
+hash_chain = HashChain(HASH_CHAIN_DIR, HASH_CHAIN_LENGTH, HASH_CHAIN_REFILL_AT)
@@ -0,0 +1,424 @@
+"""
+Game engine leadership across processes.
+
+Exactly one process runs the round loop: the one holding a session-level
+Postgres advisory lock on a dedicated connection. The leader bumps
+engine_leader.epoch when it is elected and refreshes heartbeat_at every
+ENGINE_LEADER_HEARTBEAT_SECONDS; round creation checks the epoch, so a
+deposed leader cannot open rounds.
+
+Failover:
+- a leader whose process or connection dies loses the lock with its
+  session, and a standby takes over at its next attempt
+- a leader that stops heartbeating stops its own engine once its last
+  heartbeat is older than ENGINE_LEADER_TIMEOUT_SECONDS minus one
+  heartbeat; a standby terminates its backend (freeing the lock) once
+  the stored heartbeat is older than ENGINE_LEADER_TIMEOUT_SECONDS
+
+Standbys serve API traffic only. Round events reach their WebSocket and
+SSE clients through NOTIFY, and manual cashouts are forwarded to the
+leader's live order book.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import queue
+import secrets
+import socket
+import threading
+import time
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import NullPool
+from database import DATABASE_URL
+from services.broadcast_service import broadcaster
+from services.notify_service import listen
+from services.order_book import get_live_book
+
+
+logger = logging.getLogger(__name__)
+
+# pg_advisory_lock key for the engine ("AVIATOR" in hex, fits a bigint)
+ENGINE_LOCK_KEY = 0x41564941544F52
+ENGINE_LEADER_HEARTBEAT_SECONDS = float(os.getenv("ENGINE_LEADER_HEARTBEAT_SECONDS", "1"))
+ENGINE_LEADER_TIMEOUT_SECONDS = float(os.getenv("ENGINE_LEADER_TIMEOUT_SECONDS", "5"))
+SUPERVISOR_POLL_SECONDS = 0.25
+
+EVENTS_CHANNEL = "aviator_events"
+CASHOUT_CHANNEL = "aviator_cashouts"
+CASHOUT_RESULTS_CHANNEL = "aviator_cashout_results"
+CASHOUT_FORWARD_TIMEOUT = 2.0
+
+# Lock and relay connections are held for the life of the process and
+# must notice a dead server within the leader timeout
+_timeout_ms = int(ENGINE_LEADER_TIMEOUT_SECONDS * 1000)
+_session_engine = create_engine(
+    DATABASE_URL,
+    poolclass=NullPool,
+    isolation_level="AUTOCOMMIT",
+    connect_args={
+        "connect_timeout": max(1, int(ENGINE_LEADER_TIMEOUT_SECONDS)),
+        "keepalives": 1,
+        "keepalives_idle": 1,
+        "keepalives_interval": 1,
+        "keepalives_count": 3,
+        "options": f"-c statement_timeout={_timeout_ms}",
+    },
+)
+
+
+class LeadershipLost(Exception):
+    """Raised by engine writes fenced off by a newer epoch."""
+
+
+# -------------------
+# ELECTION
+# -------------------
+class EngineLeader:
+    def __init__(self, heartbeat: float, timeout: float):
+        self.heartbeat = heartbeat
+        self.timeout = timeout
+        # stop leading before any standby may decide we are dead
+        self.lease = timeout - heartbeat
+        self.holder = f"{socket.gethostname()}:{os.getpid()}"
+
+        self._lock = threading.Lock()
+        self._epoch = None
+        self._renewed_at = 0.0
+        self._thread = None
+        self._conn = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="engine-leader", daemon=True
+                )
+                self._thread.start()
+
+    @property
+    def epoch(self):
+        """The current epoch while this process leads, else None."""
+        with self._lock:
+            if self._epoch is None:
+                return None
+            if time.monotonic() - self._renewed_at > self.lease:
+                return None
+            return self._epoch
+
+    @property
+    def is_leader(self):
+        return self.epoch is not None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "holder": self.holder,
+                "epoch": self._epoch,
+                "leader": self._epoch is not None,
+                "heartbeat_age_seconds": (
+                    time.monotonic() - self._renewed_at if self._epoch else None
+                ),
+            }
+
+    def _run(self):
+        while True:
+            started = time.monotonic()
+            try:
+                if self._conn is None:
+                    self._conn = _session_engine.connect()
+
+                if self._epoch is None:
+                    self._campaign()
+                else:
+                    self._renew()
+            except Exception:
+                logger.exception("Engine leadership check failed")
+                self._step_down()
+
+            time.sleep(max(0.0, self.heartbeat - (time.monotonic() - started)))
+
+    def _campaign(self):
+        acquired = self._conn.execute(
+            text("SELECT pg_try_advisory_lock(:k)"),
+            {"k": ENGINE_LOCK_KEY}
+        ).scalar()
+
+        if not acquired:
+            self._fence_stale_leader()
+            return
+
+        epoch = self._conn.execute(
+            text("""
+                UPDATE engine_leader
+                SET epoch = epoch + 1,
+                    holder = :h,
+                    backend_pid = pg_backend_pid(),
+                    heartbeat_at = NOW()
+                WHERE id = 1
+                RETURNING epoch
+            """),
+            {"h": self.holder}
+        ).scalar_one()
+
+        with self._lock:
+            self._epoch = epoch
+            self._renewed_at = time.monotonic()
+        logger.info("Elected engine leader (epoch %s)", epoch)
+
+    def _renew(self):
+        renewed = self._conn.execute(
+            text("""
+                UPDATE engine_leader
+                SET heartbeat_at = NOW()
+                WHERE id = 1 AND epoch = :e
+                AND backend_pid = pg_backend_pid()
+            """),
+            {"e": self._epoch}
+        ).rowcount
+
+        if not renewed:
+            logger.warning("Engine leadership lost (epoch %s)", self._epoch)
+            self._step_down()
+            return
+
+        with self._lock:
+            self._renewed_at = time.monotonic()
+
+    def _fence_stale_leader(self):
+        # the holder is alive as far as Postgres knows but has stopped
+        # heartbeating: end its session so the lock is released
+        terminated = self._conn.execute(
+            text("""
+                SELECT pg_terminate_backend(l.pid), l.pid
+                FROM engine_leader e
+                JOIN pg_locks l
+                    ON l.pid = e.backend_pid
+                    AND l.locktype = 'advisory'
+                    AND l.granted
+                    AND l.classid = :hi AND l.objid = :lo AND l.objsubid = 1
+                WHERE e.id = 1
+                AND e.heartbeat_at < NOW() - make_interval(secs => :t)
+            """),
+            {
+                "hi": ENGINE_LOCK_KEY >> 32,
+                "lo": ENGINE_LOCK_KEY & 0xFFFFFFFF,
+                "t": self.timeout,
+            }
+        ).fetchone()
+
+        if terminated:
+            logger.warning("Terminated stale engine leader backend %s", terminated[1])
+
+    def _step_down(self):
+        # closing the session releases the advisory lock
+        with self._lock:
+            self._epoch = None
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+
+engine_leader = EngineLeader(ENGINE_LEADER_HEARTBEAT_SECONDS, ENGINE_LEADER_TIMEOUT_SECONDS)
+
+
+def check_epoch(conn, epoch: int):
+    """
+    Fences an engine write: raises LeadershipLost unless epoch is still
+    current. FOR SHARE holds off a takeover until conn commits.
+    """
+    current = conn.execute(
+        text("SELECT epoch FROM engine_leader WHERE id = 1 FOR SHARE")
+    ).scalar()
+
+    if current != epoch:
+        raise LeadershipLost(f"epoch {epoch} superseded by {current}")
+
+
+async def lead(run):
+    """
+    Runs run(epoch) while this process leads and cancels it as soon as
+    the lease lapses. A run that ends is not restarted within the same
+    epoch.
+    """
+    task, task_epoch = None, None
+
+    try:
+        while True:
+            epoch = engine_leader.epoch
+
+            if task is not None and (task.done() or epoch != task_epoch):
+                if not task.done():
+                    logger.warning("Stopping engine (epoch %s)", task_epoch)
+                    task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+                except Exception:
+                    logger.exception("Engine stopped (epoch %s)", task_epoch)
+                task = None
+                relay.forward_events(False)
+
+            if task is None and epoch is not None and epoch != task_epoch:
+                task, task_epoch = asyncio.create_task(run(epoch)), epoch
+                relay.forward_events(True)
+
+            await asyncio.sleep(SUPERVISOR_POLL_SECONDS)
+    finally:
+        if task is not None:
+            task.cancel()
+
+
+# -------------------
+# RELAY
+# -------------------
+class NotifyRelay:
+    """
+    Sends NOTIFYs from any thread without blocking it: messages are
+    queued and written in batches over one dedicated connection.
+    """
+
+    def __init__(self):
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._forwarding = False
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="notify-relay", daemon=True
+                )
+                self._thread.start()
+
+        listen(EVENTS_CHANNEL, _on_event)
+        listen(CASHOUT_CHANNEL, _on_cashout)
+        listen(CASHOUT_RESULTS_CHANNEL, _on_cashout_result)
+
+    def send(self, channel: str, payload: str):
+        self._queue.put((channel, payload))
+
+    def forward_events(self, enabled: bool):
+        # the leader mirrors everything it broadcasts to the standbys
+        broadcaster.forward = (
+            (lambda message: self.send(EVENTS_CHANNEL, message)) if enabled else None
+        )
+
+    def _run(self):
+        conn = None
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < 100:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                if conn is None:
+                    conn = _session_engine.connect()
+                conn.execute(
+                    text("""
+                        SELECT pg_notify(c, p)
+                        FROM unnest(CAST(:c AS TEXT[]), CAST(:p AS TEXT[])) AS v(c, p)
+                    """),
+                    {"c": [c for c, _ in batch], "p": [p for _, p in batch]}
+                )
+            except Exception:
+                # live events are worthless late; drop the batch
+                logger.exception("Dropping %d notifications", len(batch))
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+                conn = None
+
+
+relay = NotifyRelay()
+
+
+def _on_event(message):
+    if message is None or engine_leader.is_leader:
+        return
+    broadcaster.publish_message(json.loads(message)["event"], message)
+
+
+# -------------------
+# CASHOUT FORWARDING
+# -------------------
+_pending_cashouts = {}
+_pending_lock = threading.Lock()
+
+
+async def forward_cashout(user_id: int, bet_id: int | None):
+    """
+    Asks the leader to cash out on its live order book. Returns
+    (round_id, entries); raises ValueError if the leader refused and
+    TimeoutError if it did not answer.
+    """
+    # standbys follow the round through relayed events
+    if broadcaster.current_state() != "takeoff":
+        raise ValueError("No running round")
+
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    request_id = secrets.token_hex(8)
+
+    with _pending_lock:
+        _pending_cashouts[request_id] = (loop, future)
+
+    relay.send(CASHOUT_CHANNEL, json.dumps(
+        {"id": request_id, "user_id": user_id, "bet_id": bet_id}
+    ))
+
+    try:
+        result = await asyncio.wait_for(future, CASHOUT_FORWARD_TIMEOUT)
+    finally:
+        with _pending_lock:
+            _pending_cashouts.pop(request_id, None)
+
+    if "error" in result:
+        raise ValueError(result["error"])
+
+    return result["round_id"], [tuple(entry) for entry in result["entries"]]
+
+
+def _on_cashout(message):
+    if message is None or not engine_leader.is_leader:
+        return
+
+    request = json.loads(message)
+    book = get_live_book()
+
+    if book is None:
+        result = {"id": request["id"], "error": "No running round"}
+    else:
+        try:
+            entries = book.cash_out(request["user_id"], request["bet_id"])
+            result = {"id": request["id"], "round_id": book.round_id, "entries": entries}
+        except ValueError as e:
+            result = {"id": request["id"], "error": str(e)}
+
+    relay.send(CASHOUT_RESULTS_CHANNEL, json.dumps(result))
+
+
+def _on_cashout_result(message):
+    if message is None:
+        return
+
+    result = json.loads(message)
+    with _pending_lock:
+        pending = _pending_cashouts.get(result["id"])
+
+    if pending is not None:
+        loop, future = pending
+        loop.call_soon_threadsafe(
+            lambda: future.done() or future.set_result(result)
+        )
@@ -0,0 +1,349 @@
+"""
+Prometheus-style metrics without a client library.
+
+Every instrument keeps one shard per thread: the hot path adds to a
+thread-local list without taking a lock, and a scrape sums the shards.
+Values gathered from elsewhere (pool stats, queue depths) are read at
+scrape time through collector functions.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+
+
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+TICK_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.02, 0.03, 0.05, 0.1, 0.25, 0.5,
+)
+COUNT_BUCKETS = (0, 10, 100, 1000, 5000, 10000, 50000, 100000)
+
+
+# -------------------
+# SHARDS
+# -------------------
+class _Sharded:
+    """Fixed-size float vector with one copy per writing thread."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []
+
+    def shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = [0.0] * self.size
+            with self._lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+            return shard
+
+    def total(self):
+        with self._lock:
+            shards = list(self._shards)
+        totals = [0.0] * self.size
+        for shard in shards:
+            for i, value in enumerate(shard):
+                totals[i] += value
+        return totals
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [
+        f'{name}="{_escape(value)}"'
+        for name, value in list(zip(names, values)) + list(extra)
+    ]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+# -------------------
+# INSTRUMENTS
+# -------------------
+class _Family:
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+        # unlabelled families are exported as 0 before the first update
+        if not self.labelnames and self.kind != "collected":
+            self.labels()
+
+    def labels(self, *values):
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _default(self):
+        return self.labels()
+
+    def header(self):
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+
+    def collect(self):
+        lines = self.header()
+        for key, child in sorted(self._children.items()):
+            lines.extend(child.samples(self, key))
+        return lines
+
+
+class _CounterChild:
+    def __init__(self):
+        self._values = _Sharded(1)
+
+    def inc(self, amount: float = 1.0):
+        self._values.shard()[0] += amount
+
+    def samples(self, family, key):
+        return [
+            f"{family.name}{_format_labels(family.labelnames, key)} "
+            f"{_format_value(self._values.total()[0])}"
+        ]
+
+
+class Counter(_Family):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0):
+        self._default().inc(amount)
+
+
+class _GaugeChild(_CounterChild):
+    # a sum of per-thread deltas, so inc/dec work from any thread
+    def dec(self, amount: float = 1.0):
+        self._values.shard()[0] -= amount
+
+
+class Gauge(_Family):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def inc(self, amount: float = 1.0):
+        self._default().inc(amount)
+
+    def dec(self, amount: float = 1.0):
+        self._default().dec(amount)
+
+
+class _Timer:
+    def __init__(self, child):
+        self._child = child
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._child.observe(time.perf_counter() - self._started)
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self._buckets = buckets
+        # one slot per bucket, +Inf, then the running sum
+        self._values = _Sharded(len(buckets) + 2)
+
+    def observe(self, value: float):
+        shard = self._values.shard()
+        shard[bisect_left(self._buckets, value)] += 1
+        shard[-1] += value
+
+    def time(self):
+        return _Timer(self)
+
+    def samples(self, family, key):
+        totals = self._values.total()
+        lines = []
+        cumulative = 0.0
+        for bound, count in zip(self._buckets + (float("inf"),), totals):
+            cumulative += count
+            labels = _format_labels(
+                family.labelnames, key, [("le", _format_value(bound))]
+            )
+            lines.append(f"{family.name}_bucket{labels} {_format_value(cumulative)}")
+
+        labels = _format_labels(family.labelnames, key)
+        lines.append(f"{family.name}_sum{labels} {_format_value(totals[-1])}")
+        lines.append(f"{family.name}_count{labels} {_format_value(cumulative)}")
+        return lines
+
+
+class Histogram(_Family):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+
+class Collected(_Family):
+    """Values read at scrape time: fn() returns a number or {labels: number}."""
+
+    kind = "collected"
+
+    def __init__(self, name, documentation, kind, fn, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.kind = kind
+        self.fn = fn
+
+    def collect(self):
+        values = self.fn()
+        if not isinstance(values, dict):
+            values = {(): values}
+
+        lines = self.header()
+        for key, value in sorted(values.items()):
+            lines.append(
+                f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            )
+        return lines
+
+
+# -------------------
+# REGISTRY
+# -------------------
+class Registry:
+    def __init__(self):
+        self._families = []
+
+    def register(self, family):
+        self._families.append(family)
+        return family
+
+    def collect(self, name, documentation, kind="gauge", labelnames=()):
+        """Decorator registering fn as a Collected family."""
+        def decorator(fn):
+            self.register(Collected(name, documentation, kind, fn, labelnames))
+            return fn
+        return decorator
+
+    def render(self):
+        lines = []
+        for family in self._families:
+            try:
+                lines.extend(family.collect())
+            except Exception as e:
+                lines.append(f"# {family.name} unavailable: {type(e).__name__}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+# -------------------
+# HTTP
+# -------------------
+http_request_duration = registry.register(Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency by route",
+    ("method", "route", "status"),
+))
+http_requests_in_flight = registry.register(Gauge(
+    "http_requests_in_flight",
+    "HTTP requests currently being served, including open streams",
+))
+
+# long-lived responses would swamp the latency histogram
+UNTIMED_ROUTES = {"/aviator/stream"}
+
+
+class MetricsMiddleware:
+    """ASGI middleware timing every HTTP request by route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        http_requests_in_flight.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_requests_in_flight.dec()
+
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "unmatched"
+            if path not in UNTIMED_ROUTES:
+                http_request_duration.labels(
+                    scope["method"], path, status["code"]
+                ).observe(time.perf_counter() - started)
+
+
+# -------------------
+# ENGINE
+# -------------------
+engine_tick_duration = registry.register(Histogram(
+    "engine_tick_duration_seconds",
+    "Time spent in the body of one engine tick",
+    buckets=TICK_BUCKETS,
+))
+engine_tick_lag = registry.register(Histogram(
+    "engine_tick_lag_seconds",
+    "How late engine ticks fire relative to their schedule",
+    buckets=TICK_BUCKETS,
+))
+engine_round_bets = registry.register(Histogram(
+    "engine_round_bets",
+    "Active bets loaded into each round's order book",
+    buckets=COUNT_BUCKETS,
+))
+engine_settlement_duration = registry.register(Histogram(
+    "engine_settlement_seconds",
+    "Time to persist one settlement batch",
+    ("kind",),
+))
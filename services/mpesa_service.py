@@ -1,101 +1,239 @@
 import base64
-import requests
+import os
+import threading
+import time
 from datetime import datetime
 
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-MPESA_BASE_URL = "https://sandbox.safaricom.co.ke"
 
-CONSUMER_KEY = "<CONSUMER_KEY>"
-CONSUMER_SECRET = "<CONSUMER_SECRET>"
-BUSINESS_SHORT_CODE = "<PAYBILL>"
-PASSKEY = "<PASSKEY>"
+MPESA_BASE_URL = os.getenv("MPESA_BASE_URL", "https://sandbox.safaricom.co.ke")
 
-STK_CALLBACK_URL = "https://my-domain.com/mpesa/stk/callback"
-B2C_TIMEOUT_URL = "https://my-domain.com/mpesa/b2c/timeout"
-B2C_RESULT_URL = "https://my-domain.com/mpesa/b2c/result"
+CONSUMER_KEY = os.getenv("MPESA_CONSUMER_KEY", "")
+CONSUMER_SECRET = os.getenv("MPESA_CONSUMER_SECRET", "")
+BUSINESS_SHORT_CODE = os.getenv("MPESA_BUSINESS_SHORT_CODE", "")
+PASSKEY = os.getenv("MPESA_PASSKEY", "")
+INITIATOR_NAME = os.getenv("MPESA_INITIATOR_NAME", "")
+SECURITY_CREDENTIAL = os.getenv("MPESA_SECURITY_CREDENTIAL", "")
 
+STK_CALLBACK_URL = os.getenv("MPESA_STK_CALLBACK_URL", "https://localhost/mpesa/stk/callback")
+B2C_TIMEOUT_URL = os.getenv("MPESA_B2C_TIMEOUT_URL", "https://localhost/mpesa/b2c/timeout")
+B2C_RESULT_URL = os.getenv("MPESA_B2C_RESULT_URL", "https://localhost/mpesa/b2c/result")
+STATUS_TIMEOUT_URL = os.getenv("MPESA_STATUS_TIMEOUT_URL", "https://localhost/mpesa/b2c/status/timeout")
+STATUS_RESULT_URL = os.getenv("MPESA_STATUS_RESULT_URL", "https://localhost/mpesa/b2c/status/result")
 
-def get_access_token():
-    auth = base64.b64encode(
-        f"{CONSUMER_KEY}:{CONSUMER_SECRET}".encode()
-    ).decode()
+MPESA_CONNECT_TIMEOUT = float(os.getenv("MPESA_CONNECT_TIMEOUT", "3.05"))
+MPESA_READ_TIMEOUT = float(os.getenv("MPESA_READ_TIMEOUT", "10"))
+MPESA_RETRIES = int(os.getenv("MPESA_RETRIES", "3"))
+MPESA_BACKOFF = float(os.getenv("MPESA_BACKOFF", "0.5"))
+MPESA_POOL_SIZE = int(os.getenv("MPESA_POOL_SIZE", "20"))
 
-    headers = {"Authorization": f"Basic {auth}"}
-    response = requests.get(
-        f"{MPESA_BASE_URL}/oauth/v1/generate?grant_type=client_credentials",
-        headers=headers
-    )
+# refresh the OAuth token this long before Safaricom expires it
+TOKEN_REFRESH_MARGIN = 60
 
-    return response.json()["access_token"]
+
+# -------------------
+# CLIENT
+# -------------------
+class MpesaClient:
+    """
+    Daraja API client sharing one keep-alive connection pool and one
+    OAuth token across threads.
+
+    Connection failures are retried with backoff for every call. Error
+    statuses are only retried for GETs: a POST that reached Safaricom
+    may already have started a payment.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        consumer_key: str,
+        consumer_secret: str,
+        timeout=(MPESA_CONNECT_TIMEOUT, MPESA_READ_TIMEOUT),
+        retries: int = MPESA_RETRIES,
+        backoff: float = MPESA_BACKOFF,
+        pool_size: int = MPESA_POOL_SIZE,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self._credentials = base64.b64encode(
+            f"{consumer_key}:{consumer_secret}".encode()
+        ).decode()
+
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset({"GET"}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=retry,
+        )
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._token = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    # -------------------
+    # OAUTH
+    # -------------------
+    def _cached_token(self):
+        with self._lock:
+            if self._token and time.monotonic() < self._expires_at - TOKEN_REFRESH_MARGIN:
+                return self._token
+        return None
+
+    def access_token(self):
+        token = self._cached_token()
+        if token:
+            return token
+
+        # single flight: one caller refreshes, the rest wait and reuse it
+        with self._refresh_lock:
+            token = self._cached_token()
+            if token:
+                return token
+
+            response = self.session.get(
+                f"{self.base_url}/oauth/v1/generate",
+                params={"grant_type": "client_credentials"},
+                headers={"Authorization": f"Basic {self._credentials}"},
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+            data = response.json()
+
+            with self._lock:
+                self._token = data["access_token"]
+                self._expires_at = time.monotonic() + float(data.get("expires_in", 3599))
+                return self._token
+
+    def invalidate_token(self, token: str):
+        with self._lock:
+            if self._token == token:
+                self._token = None
+
+    # -------------------
+    # API
+    # -------------------
+    def post(self, path: str, payload: dict):
+        for attempt in range(2):
+            token = self.access_token()
+            response = self.session.post(
+                f"{self.base_url}{path}",
+                json=payload,
+                headers={"Authorization": f"Bearer {token}"},
+                timeout=self.timeout,
+            )
+
+            # token revoked before its expiry: rejected, nothing was started
+            if response.status_code == 401 and attempt == 0:
+                self.invalidate_token(token)
+                continue
+
+            return response.json()
+
+    def stk_push(self, phone: str, amount: float, reference: str):
+        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+        password = base64.b64encode(
+            f"{BUSINESS_SHORT_CODE}{PASSKEY}{timestamp}".encode()
+        ).decode()
+
+        return self.post("/mpesa/stkpush/v1/processrequest", {
+            "BusinessShortCode": BUSINESS_SHORT_CODE,
+            "Password": password,
+            "Timestamp": timestamp,
+            "TransactionType": "CustomerPayBillOnline",
+            "Amount": int(amount),
+            "PartyA": phone,
+            "PartyB": BUSINESS_SHORT_CODE,
+            "PhoneNumber": phone,
+            "CallBackURL": STK_CALLBACK_URL,
+            "AccountReference": reference,
+            "TransactionDesc": "Wallet Deposit"
+        })
+
+    def b2c_withdraw(self, phone: str, amount: float, originator_conversation_id: str):
+        # v3 accepts our own OriginatorConversationID, so a resubmitted
+        # payout is recognised as a duplicate
+        return self.post("/mpesa/b2c/v3/paymentrequest", {
+            "OriginatorConversationID": originator_conversation_id,
+            "InitiatorName": INITIATOR_NAME,
+            "SecurityCredential": SECURITY_CREDENTIAL,
+            "CommandID": "BusinessPayment",
+            "Amount": int(amount),
+            "PartyA": BUSINESS_SHORT_CODE,
+            "PartyB": phone,
+            "Remarks": "Wallet Withdrawal",
+            "QueueTimeOutURL": B2C_TIMEOUT_URL,
+            "ResultURL": B2C_RESULT_URL,
+            "Occasion": "withdraw"
+        })
+
+    def transaction_status(self, originator_conversation_id: str):
+        # looks a B2C payment up by the OriginatorConversationID it was
+        # submitted with; the answer arrives at STATUS_RESULT_URL
+        return self.post("/mpesa/transactionstatus/v1/query", {
+            "Initiator": INITIATOR_NAME,
+            "SecurityCredential": SECURITY_CREDENTIAL,
+            "CommandID": "TransactionStatusQuery",
+            "TransactionID": "",
+            "OriginalConversationID": originator_conversation_id,
+            "PartyA": BUSINESS_SHORT_CODE,
+            "IdentifierType": "4",
+            "ResultURL": STATUS_RESULT_URL,
+            "QueueTimeOutURL": STATUS_TIMEOUT_URL,
+            "Remarks": "Payout reconciliation",
+            "Occasion": "reconcile"
+        })
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = MpesaClient(MPESA_BASE_URL, CONSUMER_KEY, CONSUMER_SECRET)
+    return _client
+
+
+def get_access_token():
+    return get_client().access_token()
 
 
 # -------------------
 # STK PUSH (DEPOSIT)
 # -------------------
 def stk_push(phone: str, amount: float, reference: str):
-    token = get_access_token()
-    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-
-    password = base64.b64encode(
-        f"{BUSINESS_SHORT_CODE}{PASSKEY}{timestamp}".encode()
-    ).decode()
-
-    payload = {
-        "BusinessShortCode": BUSINESS_SHORT_CODE,
-        "Password": password,
-        "Timestamp": timestamp,
-        "TransactionType": "CustomerPayBillOnline",
-        "Amount": int(amount),
-        "PartyA": phone,
-        "PartyB": BUSINESS_SHORT_CODE,
-        "PhoneNumber": phone,
-        "CallBackURL": STK_CALLBACK_URL,
-        "AccountReference": reference,
-        "TransactionDesc": "Wallet Deposit"
-    }
-
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json"
-    }
-
-    response = requests.post(
-        f"{MPESA_BASE_URL}/mpesa/stkpush/v1/processrequest",
-        json=payload,
-        headers=headers
-    )
-
-    return response.json()
+    return get_client().stk_push(phone, amount, reference)
 
 
 # -------------------
 # B2C WITHDRAW
 # -------------------
-def b2c_withdraw(phone: str, amount: float):
-    token = get_access_token()
-
-    payload = {
-        "InitiatorName": "<INITIATOR_NAME>",
-        "SecurityCredential": "<SECURITY_CREDENTIAL>",
-        "CommandID": "BusinessPayment",
-        "Amount": int(amount),
-        "PartyA": BUSINESS_SHORT_CODE,
-        "PartyB": phone,
-        "Remarks": "Wallet Withdrawal",
-        "QueueTimeOutURL": B2C_TIMEOUT_URL,
-        "ResultURL": B2C_RESULT_URL,
-        "Occasion": "withdraw"
-    }
-
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json"
-    }
-
-    response = requests.post(
-        f"{MPESA_BASE_URL}/mpesa/b2c/v1/paymentrequest",
-        json=payload,
-        headers=headers
-    )
-
-    return response.json()
+def b2c_withdraw(phone: str, amount: float, originator_conversation_id: str):
+    return get_client().b2c_withdraw(phone, amount, originator_conversation_id)
+
+
+# -------------------
+# TRANSACTION STATUS
+# -------------------
+def transaction_status(originator_conversation_id: str):
+    return get_client().transaction_status(originator_conversation_id)
@@ -1,87 +1,188 @@
+import asyncio
+import math
+import os
+import threading
 import time
-from datetime import datetime
+from collections import deque
 from sqlalchemy import text
-from database import engine
-from services.wallet_service import credit_wallet
+from database import engine_game
+from services.wallet_service import settle_bets
+from services.order_book import RoundOrderBook, set_live_book
+from services.broadcast_service import broadcaster
+from services.game_executor import run_db
+from services.metrics_service import (
+    engine_round_bets,
+    engine_settlement_duration,
+    engine_tick_duration,
+    engine_tick_lag,
+)
 
 
-MULTIPLIER_GROWTH_RATE = 0.60  # speed of plane (fast gameplay)
+# multiplier(t) = e^(rate * t), t in seconds since takeoff: 2x after
+# ~3.5s, 10x after ~11.5s, 20x after ~15s
+MULTIPLIER_GROWTH_RATE = float(os.getenv("MULTIPLIER_GROWTH_RATE", "0.2"))
+TICK_SECONDS = 0.03  # faster tick (30ms instead of 50ms)
 
 
-def run_multiplier(round_id: int, crash_point: float):
-    """
-    Simulates multiplier growth until crash point
-    """
-    multiplier = 1.00
-
-    while multiplier < crash_point:
-        time.sleep(0.03)  # faster tick (30ms instead of 50ms)
-        multiplier = round(multiplier + MULTIPLIER_GROWTH_RATE, 2)
-
-        # auto cashout
-        with engine.begin() as conn:
-            bets = conn.execute(
-                text("""
-                    SELECT id, user_id, bet_amount, auto_cashout
-                    FROM bets
-                    WHERE round_id = :r
-                    AND status = 'active'
-                    AND auto_cashout IS NOT NULL
-                    AND auto_cashout <= :m
-                """),
-                {"r": round_id, "m": multiplier}
-            ).fetchall()
-
-            for bet_id, user_id, bet_amount, auto in bets:
-                win_amount = round(bet_amount * auto, 2)
-
-                conn.execute(
-                    text("""
-                        UPDATE bets
-                        SET status='won', cashout_multiplier=:m
-                        WHERE id=:b
-                    """),
-                    {"b": bet_id, "m": auto}
-                )
+# -------------------
+# CURVE
+# -------------------
+def multiplier_at(elapsed: float, rate: float = MULTIPLIER_GROWTH_RATE):
+    """Multiplier shown elapsed seconds after takeoff, floored to cents."""
+    return max(1.0, math.floor(math.exp(rate * max(0.0, elapsed)) * 100) / 100)
 
-                credit_wallet(
-                    user_id=user_id,
-                    amount=win_amount,
-                    tx_type="win",
-                    reference=f"auto_cashout_{bet_id}"
-                )
 
-    # CRASH - Update round status directly
-    with engine.begin() as conn:
-        conn.execute(
-            text("""
-                UPDATE game_rounds
-                SET status='crashed', ended_at=:n
-                WHERE id=:r
-            """),
-            {"r": round_id, "n": datetime.utcnow()}
-        )
+def crash_elapsed(crash_point: float, rate: float = MULTIPLIER_GROWTH_RATE):
+    """Seconds after takeoff at which the curve reaches crash_point."""
+    return math.log(max(1.0, float(crash_point))) / rate
+
+
+# -------------------
+# TICK LAG
+# -------------------
+class TickStats:
+    """How late engine ticks fire relative to their schedule."""
+
+    def __init__(self, window: int):
+        self._lock = threading.Lock()
+        self._lags = deque(maxlen=window)
+        self.ticks = 0
+        self.max_lag = 0.0
+
+    def record(self, lag: float):
+        with self._lock:
+            self._lags.append(lag)
+            self.ticks += 1
+            if lag > self.max_lag:
+                self.max_lag = lag
+
+    def snapshot(self):
+        with self._lock:
+            lags = sorted(self._lags)
+            ticks, max_lag = self.ticks, self.max_lag
+
+        def percentile(q):
+            return lags[int(q * (len(lags) - 1))] if lags else 0.0
+
+        return {
+            "ticks": ticks,
+            "lag_p50_seconds": percentile(0.50),
+            "lag_p99_seconds": percentile(0.99),
+            "lag_max_seconds": max_lag,
+        }
+
+
+tick_stats = TickStats(window=2000)
+
+
+def load_order_book(round_id: int):
+    with engine_game.connect() as conn:
+        return RoundOrderBook.load(conn, round_id)
 
-    # lose remaining bets
-    with engine.begin() as conn:
-        conn.execute(
-            text("""
-                UPDATE bets
-                SET status='lost'
-                WHERE round_id=:r AND status='active'
-            """),
-            {"r": round_id}
-        )
 
-    time.sleep(2)
-    
-    # CLOSE - Close the round directly
-    with engine.begin() as conn:
+def record_takeoff(round_id: int, started_at: float):
+    with engine_game.begin() as conn:
         conn.execute(
             text("""
                 UPDATE game_rounds
-                SET status='closed'
-                WHERE id=:r
+                SET started_at = to_timestamp(:t)
+                WHERE id = :r
             """),
-            {"r": round_id}
+            {"r": round_id, "t": started_at}
         )
+
+
+def settle_cashouts(round_id: int, payouts):
+    with engine_settlement_duration.labels("cashout").time():
+        return settle_bets(round_id, payouts)
+
+
+def _payouts(entries, kind: str):
+    return [
+        (bet_id, multiplier, round(bet_amount * multiplier, 2), kind)
+        for bet_id, _, bet_amount, multiplier in entries
+    ]
+
+
+async def run_multiplier(round_id: int, crash_point: float):
+    """
+    Flies the plane until crash point. The multiplier is a function of
+    monotonic time since takeoff and ticks run on absolute deadlines, so
+    slow ticks or settlements never stretch the curve; a late tick just
+    skips to the current time.
+    Returns once every cashout of the round has been settled.
+    """
+    crash_point = float(crash_point)
+
+    # betting is closed: load the round's bets once
+    book = await run_db(load_order_book, round_id)
+    set_live_book(book)
+    engine_round_bets.observe(len(book))
+    settlements = []
+
+    def settle(auto, manual):
+        # persisted off the tick path, one batch per tick
+        payouts = _payouts(auto, "auto_cashout") + _payouts(manual, "cashout")
+        if payouts:
+            settlements.append(asyncio.ensure_future(
+                run_db(settle_cashouts, round_id, payouts)
+            ))
+
+    loop = asyncio.get_running_loop()
+    takeoff = loop.time()
+    crash_at = takeoff + crash_elapsed(crash_point)
+
+    # clients compute the curve themselves from the takeoff time
+    started_at = time.time()
+    broadcaster.publish(
+        "takeoff",
+        round_id=round_id,
+        started_at=started_at,
+        growth_rate=MULTIPLIER_GROWTH_RATE,
+    )
+    settlements.append(asyncio.ensure_future(
+        run_db(record_takeoff, round_id, started_at)
+    ))
+
+    try:
+        tick = 1
+        while True:
+            deadline = min(takeoff + tick * TICK_SECONDS, crash_at)
+            await asyncio.sleep(max(0.0, deadline - loop.time()))
+
+            now = loop.time()
+            lag = max(0.0, now - deadline)
+            tick_stats.record(lag)
+            engine_tick_lag.observe(lag)
+
+            if now >= crash_at:
+                break
+
+            elapsed = now - takeoff
+            multiplier = min(multiplier_at(elapsed), crash_point)
+            # next deadline after now, dropping ticks we are too late for
+            tick = int(elapsed / TICK_SECONDS) + 1
+
+            if multiplier >= crash_point:
+                continue
+
+            with engine_tick_duration.time():
+                broadcaster.publish(
+                    "tick",
+                    round_id=round_id,
+                    multiplier=multiplier,
+                    elapsed=round(elapsed, 3),
+                )
+
+                # auto cashouts reached this tick plus manual cashouts since the last one
+                settle(book.advance(multiplier), book.drain_cashouts())
+
+        book.close()
+
+        # auto cashouts the plane passed between the last tick and the crash
+        settle(book.advance(crash_point, inclusive=False), book.drain_cashouts())
+    finally:
+        book.close()
+        set_live_book(None)
+
+    await asyncio.gather(*settlements)
@@ -0,0 +1,109 @@
+import logging
+import select
+import threading
+import time
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import NullPool
+from database import DATABASE_URL
+
+
+logger = logging.getLogger(__name__)
+
+POLL_SECONDS = 5
+RECONNECT_SECONDS = 2
+
+# LISTEN holds its connection forever, so it gets its own unpooled engine
+_listen_engine = create_engine(DATABASE_URL, poolclass=NullPool)
+
+_lock = threading.Lock()
+_handlers = {}
+_thread = None
+
+
+# -------------------
+# PUBLISH
+# -------------------
+def notify(conn, channel: str, payload: str = ""):
+    """Queues a notification; Postgres delivers it when conn commits."""
+    conn.execute(
+        text("SELECT pg_notify(:c, :p)"),
+        {"c": channel, "p": payload}
+    )
+
+
+# -------------------
+# SUBSCRIBE
+# -------------------
+def listen(channel: str, handler):
+    """
+    Calls handler(payload) for every notification on channel.
+    After a reconnect handlers are called with None, since
+    notifications may have been missed in between.
+    """
+    global _thread
+
+    with _lock:
+        _handlers.setdefault(channel, []).append(handler)
+
+        if _thread is None:
+            _thread = threading.Thread(
+                target=_listen_forever, name="pg-listen", daemon=True
+            )
+            _thread.start()
+
+
+def _dispatch(channel: str, payload):
+    with _lock:
+        handlers = list(_handlers.get(channel, ()))
+
+    for handler in handlers:
+        try:
+            handler(payload)
+        except Exception:
+            logger.exception("LISTEN handler for %s failed", channel)
+
+
+def _listen_forever():
+    connected_before = False
+
+    while True:
+        try:
+            raw = _listen_engine.raw_connection()
+        except Exception:
+            logger.exception("LISTEN connection failed")
+            time.sleep(RECONNECT_SECONDS)
+            continue
+
+        try:
+            conn = raw.driver_connection
+            conn.autocommit = True
+            cursor = conn.cursor()
+            listening = set()
+
+            if connected_before:
+                for channel in list(_handlers):
+                    _dispatch(channel, None)
+            connected_before = True
+
+            while True:
+                with _lock:
+                    channels = set(_handlers) - listening
+                for channel in channels:
+                    cursor.execute(f'LISTEN "{channel}"')
+                    listening.add(channel)
+
+                if select.select([conn], [], [], POLL_SECONDS) == ([], [], []):
+                    continue
+
+                conn.poll()
+                while conn.notifies:
+                    notification = conn.notifies.pop(0)
+                    _dispatch(notification.channel, notification.payload)
+        except Exception:
+            logger.exception("LISTEN connection lost")
+            time.sleep(RECONNECT_SECONDS)
+        finally:
+            try:
+                raw.close()
+            except Exception:
+                pass
@@ -0,0 +1,151 @@
+import math
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from sqlalchemy import text
+
+
+# -------------------
+# ROUND ORDER BOOK
+# -------------------
+class RoundOrderBook:
+    """
+    Active bets of one round, sorted by auto_cashout.
+
+    Loaded once when betting closes. Columns are kept in parallel typed
+    arrays and every tick only moves a cursor forward, so the cost of a
+    tick is proportional to the bets it triggers. Bets without an
+    auto_cashout sit at the end and can only be cashed out manually.
+    """
+
+    def __init__(self, round_id: int, rows=()):
+        rows = sorted(
+            rows,
+            key=lambda row: (
+                math.inf if row[3] is None else float(row[3]),
+                row[0],
+            ),
+        )
+
+        self.round_id = round_id
+        self.bet_ids = array("q", (int(row[0]) for row in rows))
+        self.user_ids = array("q", (int(row[1]) for row in rows))
+        self.amounts = array("d", (float(row[2]) for row in rows))
+        self.targets = array(
+            "d", (math.inf if row[3] is None else float(row[3]) for row in rows)
+        )
+
+        self._by_user = {}
+        for i, user_id in enumerate(self.user_ids):
+            self._by_user.setdefault(user_id, []).append(i)
+
+        self._lock = threading.Lock()
+        self._settled = bytearray(len(rows))
+        self._cursor = 0
+        self._cashouts = []
+        self.multiplier = 1.0
+        self.closed = False
+
+    @classmethod
+    def load(cls, conn, round_id: int):
+        rows = conn.execute(
+            text("""
+                SELECT id, user_id, bet_amount, auto_cashout
+                FROM bets
+                WHERE round_id = :r
+                AND status = 'active'
+                AND created_at >= (SELECT created_at FROM game_rounds WHERE id = :r)
+                ORDER BY auto_cashout NULLS LAST, id
+            """),
+            {"r": round_id}
+        ).fetchall()
+
+        return cls(round_id, rows)
+
+    def __len__(self):
+        return len(self.bet_ids)
+
+    @property
+    def pending(self):
+        return len(self.bet_ids) - sum(self._settled)
+
+    def _entry(self, i: int, multiplier: float):
+        return (self.bet_ids[i], self.user_ids[i], self.amounts[i], multiplier)
+
+    def advance(self, multiplier: float, inclusive: bool = True):
+        """
+        Moves the round to multiplier and returns
+        (bet_id, user_id, bet_amount, auto_cashout) for every bet whose
+        auto_cashout was reached since the previous call. With
+        inclusive=False a target equal to multiplier is not reached.
+        """
+        find = bisect_right if inclusive else bisect_left
+
+        with self._lock:
+            if not self.closed:
+                self.multiplier = multiplier
+
+            start = self._cursor
+            end = max(start, find(self.targets, multiplier, start))
+            self._cursor = end
+
+            triggered = []
+            for i in range(start, end):
+                if not self._settled[i]:
+                    self._settled[i] = 1
+                    triggered.append(self._entry(i, self.targets[i]))
+
+        return triggered
+
+    # -------------------
+    # MANUAL CASHOUT
+    # -------------------
+    def cash_out(self, user_id: int, bet_id: int | None = None):
+        """
+        Cashes out the user's unsettled bets (or just bet_id) at the
+        current multiplier. Returns the entries; they are persisted by
+        the engine through drain_cashouts.
+        """
+        with self._lock:
+            if self.closed:
+                raise ValueError("Round already crashed")
+
+            entries = []
+            for i in self._by_user.get(user_id, ()):
+                if self._settled[i]:
+                    continue
+                if bet_id is not None and self.bet_ids[i] != bet_id:
+                    continue
+                self._settled[i] = 1
+                entries.append(self._entry(i, self.multiplier))
+
+            if not entries:
+                raise ValueError("No active bet")
+
+            self._cashouts.extend(entries)
+
+        return entries
+
+    def drain_cashouts(self):
+        with self._lock:
+            entries, self._cashouts = self._cashouts, []
+        return entries
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+
+
+# -------------------
+# LIVE ROUND
+# -------------------
+_live_book = None
+
+
+def set_live_book(book):
+    global _live_book
+    _live_book = book
+
+
+def get_live_book():
+    return _live_book
@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import os
+from sqlalchemy import text
+from database import (
+    engine_worker,
+    PARTITIONED_TABLES,
+    add_months,
+    ensure_partitions,
+    list_partitions,
+    lock_schema,
+    month_start,
+)
+
+
+logger = logging.getLogger(__name__)
+
+# months of bets/transactions kept attached; 0 keeps everything
+LEDGER_RETENTION_MONTHS = int(os.getenv("LEDGER_RETENTION_MONTHS", "0"))
+LEDGER_ARCHIVE_SCHEMA = os.getenv("LEDGER_ARCHIVE_SCHEMA", "archive")
+PARTITION_MAINTENANCE_SECONDS = float(
+    os.getenv("PARTITION_MAINTENANCE_SECONDS", str(6 * 3600))
+)
+
+
+# -------------------
+# RETENTION
+# -------------------
+def archive_expired_partitions(retention_months: int = LEDGER_RETENTION_MONTHS):
+    """
+    Detaches partitions that end before the retention window and moves
+    them into the archive schema. Returns the archived partition names.
+    """
+    if retention_months <= 0:
+        return []
+
+    cutoff = add_months(month_start(), -retention_months)
+    archived = []
+
+    # DETACH ... CONCURRENTLY is not allowed next to a DEFAULT partition;
+    # a plain DETACH only holds its lock for this short transaction
+    with engine_worker.begin() as conn:
+        lock_schema(conn)
+        conn.execute(text(f"CREATE SCHEMA IF NOT EXISTS {LEDGER_ARCHIVE_SCHEMA}"))
+
+        for table in PARTITIONED_TABLES:
+            for name, _, upper in list_partitions(conn, table):
+                if upper is None or upper > cutoff:
+                    continue
+
+                conn.execute(text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+                conn.execute(text(
+                    f"ALTER TABLE {name} SET SCHEMA {LEDGER_ARCHIVE_SCHEMA}"
+                ))
+                archived.append(name)
+                logger.info("Archived partition %s.%s", LEDGER_ARCHIVE_SCHEMA, name)
+
+    return archived
+
+
+def run_partition_maintenance():
+    with engine_worker.begin() as conn:
+        lock_schema(conn)
+        ensure_partitions(conn)
+
+    return archive_expired_partitions()
+
+
+async def partition_maintenance_loop():
+    while True:
+        try:
+            await asyncio.to_thread(run_partition_maintenance)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Partition maintenance failed")
+
+        await asyncio.sleep(PARTITION_MAINTENANCE_SECONDS)
@@ -0,0 +1,156 @@
+"""
+Argon2 hashing off the request threads.
+
+Hash/verify calls run in a small process pool, so they neither hold the
+GIL nor pile up in the Starlette threadpool. Once the configured number
+of calls is in flight, new calls fail fast with PasswordServiceBusy.
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+
+
+PASSWORD_HASH_WORKERS = int(
+    os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1)))
+)
+PASSWORD_HASH_MAX_PENDING = int(
+    os.getenv("PASSWORD_HASH_MAX_PENDING", str(PASSWORD_HASH_WORKERS * 8))
+)
+PASSWORD_HASH_TIMEOUT = float(os.getenv("PASSWORD_HASH_TIMEOUT", "10"))
+
+
+class PasswordServiceBusy(Exception):
+    pass
+
+
+# -------------------
+# WORKER SIDE
+# -------------------
+_hasher = None
+
+
+def _worker_hasher():
+    global _hasher
+    if _hasher is None:
+        _hasher = PasswordHasher()
+    return _hasher
+
+
+def _hash(password: str):
+    return _worker_hasher().hash(password)
+
+
+def _verify(password_hash: str, password: str):
+    try:
+        return _worker_hasher().verify(password_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+
+# -------------------
+# POOL
+# -------------------
+class PasswordPool:
+    def __init__(self, workers: int, max_pending: int, timeout: float):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = 0
+        self._completed = 0
+        self._rejected = 0
+        self._failed = 0
+        self._busy_seconds = 0.0
+
+    def _get_executor(self):
+        if self._executor is None:
+            # spawn: forking a process that already runs threads is unsafe
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._executor
+
+    def run(self, fn, *args):
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self._rejected += 1
+                raise PasswordServiceBusy("Password service is saturated")
+            self._pending += 1
+            executor = self._get_executor()
+
+        started = time.perf_counter()
+        try:
+            future = executor.submit(fn, *args)
+        except BrokenProcessPool:
+            self._release()
+            with self._lock:
+                self._failed += 1
+                if self._executor is executor:
+                    self._executor = None
+            raise PasswordServiceBusy("Password service restarting")
+
+        # the slot is held until the worker finishes, not until we stop
+        # waiting: a timed-out hash still occupies a process
+        future.add_done_callback(lambda _: self._release())
+
+        try:
+            result = future.result(self.timeout)
+        except FutureTimeout:
+            with self._lock:
+                self._failed += 1
+            raise PasswordServiceBusy("Password service timed out")
+        except BrokenProcessPool:
+            with self._lock:
+                self._failed += 1
+                if self._executor is executor:
+                    self._executor = None
+            raise PasswordServiceBusy("Password service restarting")
+
+        with self._lock:
+            self._completed += 1
+            self._busy_seconds += time.perf_counter() - started
+
+        return result
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "max_pending": self.max_pending,
+                "pending": self._pending,
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "failed": self._failed,
+                "avg_seconds": (
+                    self._busy_seconds / self._completed if self._completed else 0.0
+                ),
+            }
+
+
+password_pool = PasswordPool(
+    PASSWORD_HASH_WORKERS,
+    PASSWORD_HASH_MAX_PENDING,
+    PASSWORD_HASH_TIMEOUT,
+)
+
+
+def hash_password(password: str):
+    return password_pool.run(_hash, password)
+
+
+def verify_password(password: str, password_hash: str):
+    return password_pool.run(_verify, password_hash, password)
@@ -0,0 +1,647 @@
+"""
+Durable B2C withdrawal queue.
+
+A withdrawal debits the wallet and queues a payout row in one statement.
+Worker threads claim queued payouts with SKIP LOCKED, submit them to
+M-Pesa within a concurrency limit and retry requests that were never
+sent with backoff. The result and queue-timeout callbacks settle the
+payout; only a definitive rejection refunds it to the wallet.
+
+A payout whose outcome is unknown (the request failed after it may have
+reached M-Pesa, its worker died mid-submit, or no Result arrived within
+PAYOUT_RESULT_TIMEOUT_SECONDS) is never refunded automatically. It is
+parked in needs_reconcile and resolved with a Transaction Status query;
+if M-Pesa has no record of it, it is resubmitted under the same
+originator id, which M-Pesa deduplicates.
+
+Callbacks are matched on the ConversationID M-Pesa returned for our
+request, never on the guessable originator id.
+
+Payout states:
+    queued -> submitting -> submitted -> completed
+                  |             |
+                  +-> queued    +-> queued (queue timeout, resubmitted)
+                  +-> refunded  +-> refunded (rejected)
+                  |             |
+                  +-------------+-> needs_reconcile -> completed
+                                                    -> refunded
+                                                    -> queued
+"""
+
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import text
+from database import engine, engine_worker
+from services.notify_service import listen, notify
+from services.settings_service import get_settings
+from services.wallet_service import cache_balances
+from services.mpesa_service_mock import b2c_withdraw, transaction_status
+
+
+logger = logging.getLogger(__name__)
+
+PAYOUT_CONCURRENCY = int(os.getenv("PAYOUT_CONCURRENCY", "4"))
+PAYOUT_BATCH_SIZE = int(os.getenv("PAYOUT_BATCH_SIZE", "20"))
+PAYOUT_MAX_ATTEMPTS = int(os.getenv("PAYOUT_MAX_ATTEMPTS", "5"))
+PAYOUT_POLL_SECONDS = float(os.getenv("PAYOUT_POLL_SECONDS", "2"))
+# a payout stuck in 'submitting' this long is reconciled (its worker died)
+PAYOUT_LEASE_SECONDS = 120
+PAYOUT_BACKOFF_SECONDS = 5
+# a submitted payout without a Result after this long is reconciled
+PAYOUT_RESULT_TIMEOUT_SECONDS = float(os.getenv("PAYOUT_RESULT_TIMEOUT_SECONDS", "600"))
+# delay before, and between, Transaction Status queries
+PAYOUT_RECONCILE_SECONDS = float(os.getenv("PAYOUT_RECONCILE_SECONDS", "120"))
+
+# TransactionStatus values that mean the payment was not made
+FAILED_TRANSACTION_STATUSES = ("failed", "cancelled", "declined", "expired", "reversed")
+# Transaction Status ResultCodes meaning M-Pesa has no such payment; only
+# these resubmit a payout. Any other error (initiator, throttling,
+# internal) is queried again instead.
+PAYOUT_NOT_FOUND_RESULT_CODES = frozenset(
+    code.strip()
+    for code in os.getenv("PAYOUT_NOT_FOUND_RESULT_CODES", "R000001").split(",")
+    if code.strip()
+)
+
+PAYOUT_CHANNEL = "payouts_queued"
+
+
+def originator_id(payout_id: int):
+    # sent as OriginatorConversationID so M-Pesa deduplicates resubmissions
+    return f"payout_{payout_id}"
+
+
+# -------------------
+# QUEUE
+# -------------------
+REQUEST_PAYOUT_SQL = text("""
+    WITH w AS (
+        UPDATE wallets
+        SET balance = balance - CAST(:a AS NUMERIC),
+            updated_at = NOW()
+        WHERE user_id = :u
+        AND balance >= CAST(:a AS NUMERIC)
+        RETURNING balance
+    ),
+    p AS (
+        INSERT INTO payouts (user_id, phone, amount, status)
+        SELECT :u, :p, CAST(:a AS NUMERIC), 'queued'
+        FROM w
+        RETURNING id
+    ),
+    tx AS (
+        INSERT INTO transactions
+        (user_id, amount, type, balance_before, balance_after, status, reference)
+        SELECT :u, CAST(:a AS NUMERIC), 'withdraw', w.balance + CAST(:a AS NUMERIC),
+            w.balance, 'completed', 'payout_' || p.id
+        FROM w, p
+    )
+    SELECT
+        (SELECT id FROM p),
+        (SELECT balance FROM w),
+        EXISTS (SELECT 1 FROM wallets WHERE user_id = :u)
+""")
+
+
+def request_payout(user_id: int, phone: str, amount: float):
+    if amount <= 0:
+        raise ValueError("Amount must be positive")
+
+    settings = get_settings()
+
+    if not settings["withdraw_enabled"]:
+        raise ValueError("Withdrawals are disabled")
+
+    if amount < settings["min_withdraw"]:
+        raise ValueError("Withdraw below minimum limit")
+
+    with engine.begin() as conn:
+        payout_id, balance, wallet_exists = conn.execute(
+            REQUEST_PAYOUT_SQL,
+            {"u": user_id, "p": phone, "a": amount}
+        ).fetchone()
+
+        if payout_id is not None:
+            notify(conn, PAYOUT_CHANNEL)
+
+    if payout_id is None:
+        if not wallet_exists:
+            raise ValueError("Wallet not found")
+        raise ValueError("Insufficient balance")
+
+    cache_balances({user_id: balance})
+    payout_worker.wake()
+
+    return {"payout_id": int(payout_id), "status": "queued", "balance": float(balance)}
+
+
+def get_payout(payout_id: int, user_id: int):
+    with engine.connect() as conn:
+        row = conn.execute(
+            text("""
+                SELECT id, amount, status, attempts, mpesa_code, result_desc,
+                    created_at, updated_at
+                FROM payouts
+                WHERE id = :id AND user_id = :u
+            """),
+            {"id": payout_id, "u": user_id}
+        ).fetchone()
+
+    if not row:
+        return None
+
+    return {
+        "payout_id": row[0],
+        "amount": float(row[1]),
+        "status": row[2],
+        "attempts": row[3],
+        "mpesa_code": row[4],
+        "result_desc": row[5],
+        "created_at": row[6],
+        "updated_at": row[7],
+    }
+
+
+def claim_payouts(limit: int):
+    """
+    Leases up to limit due payouts to this worker. Queued payouts come
+    back as 'submitting'; the rest are due for reconciliation and come
+    back as 'needs_reconcile': expired submit leases, submissions
+    whose Result is overdue and earlier unanswered status queries.
+    """
+    with engine_worker.begin() as conn:
+        return conn.execute(
+            text("""
+                UPDATE payouts
+                SET status = CASE WHEN status = 'queued'
+                        THEN 'submitting' ELSE 'needs_reconcile' END,
+                    attempts = attempts + CASE WHEN status = 'queued' THEN 1 ELSE 0 END,
+                    next_attempt_at = NOW() + make_interval(secs => CASE WHEN status = 'queued'
+                        THEN :lease ELSE :reconcile END),
+                    updated_at = NOW()
+                WHERE id IN (
+                    SELECT id FROM payouts
+                    WHERE status IN ('queued', 'submitting', 'submitted', 'needs_reconcile')
+                    AND next_attempt_at <= NOW()
+                    ORDER BY next_attempt_at
+                    LIMIT :limit
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, user_id, phone, amount, attempts, status
+            """),
+            {
+                "limit": limit,
+                "lease": PAYOUT_LEASE_SECONDS,
+                "reconcile": PAYOUT_RECONCILE_SECONDS,
+            }
+        ).fetchall()
+
+
+# -------------------
+# STATE CHANGES
+# -------------------
+def mark_submitted(payout_id: int, conversation_id, originator_conversation_id):
+    with engine_worker.begin() as conn:
+        conn.execute(
+            text("""
+                UPDATE payouts
+                SET status = 'submitted',
+                    conversation_id = :c,
+                    originator_conversation_id = :o,
+                    next_attempt_at = NOW() + make_interval(secs => :timeout),
+                    updated_at = NOW()
+                WHERE id = :id AND status = 'submitting'
+            """),
+            {
+                "id": payout_id,
+                "c": conversation_id,
+                "o": originator_conversation_id,
+                "timeout": PAYOUT_RESULT_TIMEOUT_SECONDS,
+            }
+        )
+
+
+def retry_later(payout_id: int, attempts: int, reason: str, from_status: str = "submitting"):
+    """
+    Requeues with backoff, or refunds once the attempts are used up.
+    Only for requests M-Pesa did not act on: never sent, or answered
+    with a queue timeout.
+    """
+    if attempts >= PAYOUT_MAX_ATTEMPTS:
+        return refund_payout(payout_id, reason, from_status)
+
+    with engine_worker.begin() as conn:
+        conn.execute(
+            text("""
+                UPDATE payouts
+                SET status = 'queued',
+                    result_desc = :d,
+                    next_attempt_at = NOW() + make_interval(secs => :delay),
+                    updated_at = NOW()
+                WHERE id = :id AND status = :from_status
+            """),
+            {
+                "id": payout_id,
+                "d": reason[:255],
+                "delay": PAYOUT_BACKOFF_SECONDS * 2 ** (attempts - 1),
+                "from_status": from_status,
+            }
+        )
+    return False
+
+
+def complete_payout(payout_id: int, receipt: str | None, result_desc: str | None):
+    with engine_worker.begin() as conn:
+        conn.execute(
+            text("""
+                UPDATE payouts
+                SET status = 'completed',
+                    mpesa_code = :code,
+                    result_code = 0,
+                    result_desc = :d,
+                    updated_at = NOW()
+                WHERE id = :id AND status IN ('submitting', 'submitted', 'needs_reconcile')
+            """),
+            {"id": payout_id, "code": receipt, "d": result_desc}
+        )
+
+
+def park_for_reconcile(payout_id: int, reason: str):
+    """The submission may or may not have reached M-Pesa."""
+    with engine_worker.begin() as conn:
+        conn.execute(
+            text("""
+                UPDATE payouts
+                SET status = 'needs_reconcile',
+                    result_desc = :d,
+                    next_attempt_at = NOW() + make_interval(secs => :delay),
+                    updated_at = NOW()
+                WHERE id = :id AND status = 'submitting'
+            """),
+            {"id": payout_id, "d": reason[:255], "delay": PAYOUT_RECONCILE_SECONDS}
+        )
+    logger.warning("Payout %s needs reconciliation: %s", payout_id, reason)
+    return False
+
+
+def resubmit_payout(payout_id: int, attempts: int, reason: str | None):
+    """M-Pesa has no record of the payout: queue it again."""
+    if attempts >= PAYOUT_MAX_ATTEMPTS:
+        # stays in needs_reconcile and is queried again; an operator
+        # decides whether to refund
+        logger.error("Payout %s unresolved after %d attempts", payout_id, attempts)
+        return False
+
+    with engine_worker.begin() as conn:
+        conn.execute(
+            text("""
+                UPDATE payouts
+                SET status = 'queued',
+                    result_desc = :d,
+                    next_attempt_at = NOW(),
+                    updated_at = NOW()
+                WHERE id = :id AND status = 'needs_reconcile'
+            """),
+            {"id": payout_id, "d": (reason or "")[:255]}
+        )
+    return True
+
+
+def refund_payout(payout_id: int, reason: str | None, from_status: str, result_code=None):
+    """
+    Fails the payout and returns the stake to the wallet in one
+    statement; a payout is refunded at most once.
+    """
+    with engine_worker.begin() as conn:
+        row = conn.execute(
+            text("""
+                WITH failed AS (
+                    UPDATE payouts
+                    SET status = 'refunded',
+                        result_code = :rc,
+                        result_desc = :d,
+                        updated_at = NOW()
+                    WHERE id = :id AND status = :from_status
+                    RETURNING id, user_id, amount
+                ),
+                credited AS (
+                    UPDATE wallets w
+                    SET balance = w.balance + f.amount,
+                        updated_at = NOW()
+                    FROM failed f
+                    WHERE w.user_id = f.user_id
+                    RETURNING w.user_id, w.balance, f.amount, f.id
+                )
+                INSERT INTO transactions
+                (user_id, amount, type, balance_before, balance_after, status, reference)
+                SELECT user_id, amount, 'withdraw_refund', balance - amount, balance,
+                    'completed', 'payout_' || id
+                FROM credited
+                RETURNING user_id, balance_after
+            """),
+            {
+                "id": payout_id,
+                "d": (reason or "")[:255],
+                "rc": result_code,
+                "from_status": from_status,
+            }
+        ).fetchone()
+
+    if row:
+        cache_balances({row[0]: row[1]})
+    return row is not None
+
+
+# -------------------
+# SUBMISSION
+# -------------------
+def _rejected(response: dict):
+    # an acknowledgement with a non-zero code, or a 400.x validation
+    # error: M-Pesa refused the request and will not pay it
+    if "ResponseCode" in response:
+        return True
+    return str(response.get("errorCode", "")).startswith("400.")
+
+
+def submit_payout(payout):
+    payout_id, _, phone, amount, attempts, _ = payout
+    response = b2c_withdraw(phone, float(amount), originator_id(payout_id))
+
+    if response.get("unknown_outcome"):
+        return park_for_reconcile(payout_id, str(response["error"]))
+
+    if "error" in response:
+        # nothing was sent (configuration problem): safe to retry
+        return retry_later(payout_id, attempts, str(response["error"]))
+
+    if "Result" in response:
+        # the mock answers with a final result straight away
+        mark_submitted(
+            payout_id,
+            response["Result"].get("ConversationID"),
+            originator_id(payout_id),
+        )
+        handle_result(response)
+        return True
+
+    if str(response.get("ResponseCode")) == "0":
+        mark_submitted(
+            payout_id,
+            response.get("ConversationID"),
+            response.get("OriginatorConversationID") or originator_id(payout_id),
+        )
+        return True
+
+    reason = response.get("errorMessage") or response.get("ResponseDescription") or str(response)
+    if _rejected(response):
+        return refund_payout(payout_id, reason, "submitting")
+    return park_for_reconcile(payout_id, reason)
+
+
+# -------------------
+# RECONCILIATION
+# -------------------
+def record_status_query(payout_id: int, conversation_id):
+    with engine_worker.begin() as conn:
+        conn.execute(
+            text("""
+                UPDATE payouts
+                SET reconcile_conversation_id = :c,
+                    updated_at = NOW()
+                WHERE id = :id AND status = 'needs_reconcile'
+            """),
+            {"id": payout_id, "c": conversation_id}
+        )
+
+
+def reconcile_payout(payout):
+    """
+    Asks M-Pesa what became of the payout. Unanswered queries are
+    repeated when the claim lease lapses.
+    """
+    payout_id = payout[0]
+    response = transaction_status(originator_id(payout_id))
+
+    if "Result" in response:
+        # the mock answers with a final result straight away
+        record_status_query(payout_id, response["Result"].get("ConversationID"))
+        handle_status_result(response)
+        return True
+
+    if str(response.get("ResponseCode")) == "0":
+        record_status_query(payout_id, response.get("ConversationID"))
+        return True
+
+    logger.warning("Status query for payout %s failed: %s", payout_id, response)
+    return False
+
+
+# -------------------
+# CALLBACKS
+# -------------------
+def _find_payout(conn, column: str, result: dict):
+    # the ConversationID is only ever returned to us, unlike the
+    # originator id, which anyone can derive from a payout id
+    conversation_id = result.get("ConversationID")
+    if not conversation_id:
+        return None
+
+    return conn.execute(
+        text(f"""
+            SELECT id, status, attempts
+            FROM payouts
+            WHERE {column} = :c
+        """),
+        {"c": conversation_id}
+    ).fetchone()
+
+
+def _result_parameters(result: dict):
+    parameters = (result.get("ResultParameters") or {}).get("ResultParameter") or []
+    if isinstance(parameters, dict):
+        parameters = [parameters]
+    return {item.get("Key"): item.get("Value") for item in parameters}
+
+
+def handle_result(payload: dict):
+    """B2C ResultURL callback. Replays are no-ops."""
+    result = payload["Result"]
+
+    with engine_worker.connect() as conn:
+        payout = _find_payout(conn, "conversation_id", result)
+
+    if not payout:
+        logger.warning("B2C result for unknown payout: %s", result)
+        return
+
+    payout_id, status, _ = payout
+    if status not in ("submitted", "needs_reconcile"):
+        return
+
+    if int(result.get("ResultCode", -1)) == 0:
+        complete_payout(payout_id, result.get("TransactionID"), result.get("ResultDesc"))
+    else:
+        refund_payout(
+            payout_id,
+            result.get("ResultDesc"),
+            status,
+            result_code=result.get("ResultCode"),
+        )
+
+
+def handle_timeout(payload: dict):
+    """B2C QueueTimeOutURL callback: M-Pesa never processed the request."""
+    result = payload.get("Result", payload)
+
+    with engine_worker.connect() as conn:
+        payout = _find_payout(conn, "conversation_id", result)
+
+    if not payout:
+        return
+
+    payout_id, status, attempts = payout
+    if status == "submitted":
+        retry_later(payout_id, attempts, "M-Pesa queue timeout", from_status="submitted")
+
+
+def handle_status_result(payload: dict):
+    """Transaction Status ResultURL callback for a reconciling payout."""
+    result = payload["Result"]
+
+    with engine_worker.connect() as conn:
+        payout = _find_payout(conn, "reconcile_conversation_id", result)
+
+    if not payout:
+        logger.warning("Status result for unknown payout: %s", result)
+        return
+
+    payout_id, status, attempts = payout
+    if status != "needs_reconcile":
+        return
+
+    result_code = str(result.get("ResultCode", ""))
+
+    if result_code in PAYOUT_NOT_FOUND_RESULT_CODES:
+        # M-Pesa has no such payment: submit it again
+        resubmit_payout(payout_id, attempts, result.get("ResultDesc"))
+        return
+
+    if result_code != "0":
+        # the query itself failed; the payment may exist, so stay parked
+        # and query again when the lease lapses
+        logger.error(
+            "Status query for payout %s failed: %s %s",
+            payout_id, result_code, result.get("ResultDesc"),
+        )
+        return
+
+    parameters = _result_parameters(result)
+    payment_status = str(parameters.get("TransactionStatus", "")).lower()
+
+    if payment_status == "completed":
+        complete_payout(payout_id, parameters.get("ReceiptNo"), result.get("ResultDesc"))
+    elif payment_status in FAILED_TRANSACTION_STATUSES:
+        refund_payout(
+            payout_id,
+            f"M-Pesa transaction {payment_status}",
+            "needs_reconcile",
+        )
+    # anything else is still pending and is queried again later
+
+
+# -------------------
+# WORKER
+# -------------------
+class PayoutWorker:
+    """
+    Claims due payouts in batches and submits them on a bounded thread
+    pool. Woken by new payouts in this process and by NOTIFY from others;
+    otherwise polls for retries that have become due.
+    """
+
+    def __init__(self, concurrency: int, batch_size: int, poll_seconds: float):
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._executor = None
+        self._thread = None
+        self._in_flight = 0
+        self._submitted = 0
+        self._failed = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._executor = ThreadPoolExecutor(
+                self.concurrency, thread_name_prefix="payout"
+            )
+            self._thread = threading.Thread(
+                target=self._run, name="payout-dispatch", daemon=True
+            )
+            self._thread.start()
+
+        listen(PAYOUT_CHANNEL, lambda _: self.wake())
+
+    def wake(self):
+        self._wakeup.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "concurrency": self.concurrency,
+                "in_flight": self._in_flight,
+                "submitted": self._submitted,
+                "failed": self._failed,
+            }
+
+    def _run(self):
+        while True:
+            self._wakeup.clear()
+
+            with self._lock:
+                free = self.concurrency - self._in_flight
+
+            batch = []
+            if free > 0:
+                try:
+                    batch = claim_payouts(min(free, self.batch_size))
+                except Exception:
+                    logger.exception("Claiming payouts failed")
+
+            for payout in batch:
+                with self._lock:
+                    self._in_flight += 1
+                self._executor.submit(self._process, payout)
+
+            # a full batch means more may be waiting
+            if not batch or len(batch) < self.batch_size:
+                self._wakeup.wait(self.poll_seconds)
+
+    def _process(self, payout):
+        ok = False
+        try:
+            if payout[5] == "needs_reconcile":
+                reconcile_payout(payout)
+            else:
+                submit_payout(payout)
+            ok = True
+        except Exception:
+            # the lease expires and the payout is reconciled
+            logger.exception("Processing payout %s failed", payout[0])
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                if ok:
+                    self._submitted += 1
+                else:
+                    self._failed += 1
+            self.wake()
+
+
+payout_worker = PayoutWorker(PAYOUT_CONCURRENCY, PAYOUT_BATCH_SIZE, PAYOUT_POLL_SECONDS)
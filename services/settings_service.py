@@ -1,30 +1,144 @@
+import os
+import threading
+import time
 from sqlalchemy import text
-from database import engine
+from database import async_engine, engine
+from services.notify_service import notify, listen
 
 
-def get_settings():
+SETTINGS_CHANNEL = "admin_settings_changed"
+SETTINGS_CACHE_TTL = float(os.getenv("SETTINGS_CACHE_TTL", "30"))
+
+DEFAULT_SETTINGS = {
+    "min_deposit": 100.0,
+    "min_withdraw": 100.0,
+    "deposit_enabled": True,
+    "withdraw_enabled": True,
+}
+
+
+def _parse_bool(value: str):
+    return value.strip().lower() == "true"
+
+
+def _format_bool(value: bool):
+    return "true" if value else "false"
+
+
+# setting_key -> (parse stored string, format for storage)
+SETTING_TYPES = {
+    "min_deposit": (float, str),
+    "min_withdraw": (float, str),
+    "deposit_enabled": (_parse_bool, _format_bool),
+    "withdraw_enabled": (_parse_bool, _format_bool),
+}
+
+
+# -------------------
+# SETTINGS CACHE
+# -------------------
+class SettingsCache:
+    """
+    Process-local copy of admin_settings.
+
+    Every change bumps the version, which makes the next read reload.
+    Changes made by other processes arrive through NOTIFY; the TTL only
+    bounds staleness while the listener is reconnecting.
+    """
+
+    def __init__(self, ttl: float):
+        self._lock = threading.Lock()
+        self._ttl = ttl
+        self._version = 0
+        self._loaded_version = -1
+        self._loaded_at = 0.0
+        self._values = None
+
+    @property
+    def version(self):
+        return self._version
+
+    def invalidate(self, *_):
+        with self._lock:
+            self._version += 1
+
+    def _cached(self):
+        """Returns (values or None, version to load)."""
+        with self._lock:
+            fresh = (
+                self._values is not None
+                and self._loaded_version == self._version
+                and time.monotonic() - self._loaded_at < self._ttl
+            )
+            if fresh:
+                return dict(self._values), None
+            return None, self._version
+
+    def _store(self, version, values):
+        with self._lock:
+            # a change raced with the load: serve it once, don't keep it
+            if self._version == version:
+                self._values = values
+                self._loaded_version = version
+                self._loaded_at = time.monotonic()
+
+        return dict(values)
+
+    def get(self, loader):
+        values, version = self._cached()
+        if values is not None:
+            return values
+        return self._store(version, loader())
+
+    async def get_async(self, loader):
+        values, version = self._cached()
+        if values is not None:
+            return values
+        return self._store(version, await loader())
+
+
+settings_cache = SettingsCache(SETTINGS_CACHE_TTL)
+
+
+def start_settings_listener():
+    listen(SETTINGS_CHANNEL, settings_cache.invalidate)
+
+
+# -------------------
+# READ / UPDATE
+# -------------------
+LOAD_SETTINGS_SQL = text("""
+    SELECT setting_key, setting_value
+    FROM admin_settings
+""")
+
+
+def _parse_settings(rows):
+    settings = dict(DEFAULT_SETTINGS)
+    for key, value in rows:
+        if key in SETTING_TYPES and value is not None:
+            parse, _ = SETTING_TYPES[key]
+            settings[key] = parse(value)
+
+    return settings
+
+
+def _load_settings():
     with engine.connect() as conn:
-        result = conn.execute(
-            text("""
-                SELECT 
-                    min_deposit,
-                    min_withdraw,
-                    deposit_enabled,
-                    withdraw_enabled
-                FROM admin_settings
-                LIMIT 1
-            """)
-        ).fetchone()
-
-        if not result:
-            return None
-
-        return {
-            "min_deposit": float(result[0]),
-            "min_withdraw": float(result[1]),
-            "deposit_enabled": bool(result[2]),
-            "withdraw_enabled": bool(result[3]),
-        }
+        return _parse_settings(conn.execute(LOAD_SETTINGS_SQL).fetchall())
+
+
+async def _load_settings_async():
+    async with async_engine().connect() as conn:
+        return _parse_settings((await conn.execute(LOAD_SETTINGS_SQL)).fetchall())
+
+
+def get_settings():
+    return settings_cache.get(_load_settings)
+
+
+async def get_settings_async():
+    return await settings_cache.get_async(_load_settings_async)
 
 
 def update_settings(
@@ -33,21 +147,27 @@ def update_settings(
     deposit_enabled: bool,
     withdraw_enabled: bool,
 ):
-    with engine.connect() as conn:
+    values = {
+        "min_deposit": min_deposit,
+        "min_withdraw": min_withdraw,
+        "deposit_enabled": deposit_enabled,
+        "withdraw_enabled": withdraw_enabled,
+    }
+
+    with engine.begin() as conn:
         conn.execute(
             text("""
-                UPDATE admin_settings
-                SET 
-                    min_deposit = :min_deposit,
-                    min_withdraw = :min_withdraw,
-                    deposit_enabled = :deposit_enabled,
-                    withdraw_enabled = :withdraw_enabled
+                INSERT INTO admin_settings (setting_key, setting_value, updated_at)
+                VALUES (:k, :v, NOW())
+                ON CONFLICT (setting_key) DO UPDATE
+                SET setting_value = EXCLUDED.setting_value,
+                    updated_at = NOW()
             """),
-            {
-                "min_deposit": min_deposit,
-                "min_withdraw": min_withdraw,
-                "deposit_enabled": deposit_enabled,
-                "withdraw_enabled": withdraw_enabled,
-            }
+            [
+                {"k": key, "v": SETTING_TYPES[key][1](value)}
+                for key, value in values.items()
+            ]
         )
-        conn.commit()
+        notify(conn, SETTINGS_CHANNEL)
+
+    settings_cache.invalidate()
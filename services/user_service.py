@@ -1,15 +1,44 @@
+import os
 from sqlalchemy import text
-from database import engine
+from database import async_engine, engine
+from services.lru_cache import TTLCache
+
+
+USER_ID_CACHE_SIZE = int(os.getenv("USER_ID_CACHE_SIZE", "10000"))
+USER_ID_CACHE_TTL = float(os.getenv("USER_ID_CACHE_TTL", "300"))
+
+# phone -> user id, for tokens issued before ids were embedded in claims
+_user_ids = TTLCache(USER_ID_CACHE_SIZE, USER_ID_CACHE_TTL)
+
+
+USER_ID_SQL = text("SELECT id FROM users WHERE phone = :p")
 
 
 def get_user_id(phone_number: str):
     with engine.connect() as conn:
-        row = conn.execute(
-            text("SELECT id FROM users WHERE phone = :p"),
-            {"p": phone_number}
-        ).fetchone()
+        row = conn.execute(USER_ID_SQL, {"p": phone_number}).fetchone()
 
         if not row:
             return None
 
         return int(row[0])
+
+
+async def get_user_id_async(phone_number: str):
+    async with async_engine().connect() as conn:
+        row = (await conn.execute(USER_ID_SQL, {"p": phone_number})).fetchone()
+
+    if not row:
+        return None
+
+    return int(row[0])
+
+
+async def get_cached_user_id_async(phone_number: str):
+    user_id = _user_ids.get(phone_number)
+    if user_id is None:
+        user_id = await get_user_id_async(phone_number)
+        if user_id is not None:
+            _user_ids.set(phone_number, user_id)
+
+    return user_id
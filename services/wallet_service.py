@@ -1,54 +1,60 @@
+import os
+import secrets
 from sqlalchemy import text
-from database import engine
+from database import async_engine, async_read_engine, engine, engine_game, read_engine
+from services.settings_service import get_settings
+from services.lru_cache import TTLCache
 
 
 # -------------------
-# ADMIN SETTINGS
+# BALANCE CACHE
 # -------------------
-def get_admin_settings(conn):
-    # Get individual settings from key-value store
-    rows = conn.execute(
-        text("""
-            SELECT setting_key, setting_value
-            FROM admin_settings
-        """)
-    ).fetchall()
-
-    if not rows:
-        # Return defaults if no settings
-        return {
-            "min_deposit": 100,
-            "min_withdraw": 100,
-            "deposit_enabled": True,
-            "withdraw_enabled": True,
-        }
-
-    settings = {}
-    for row in rows:
-        settings[row[0]] = row[1]
-
-    return {
-        "min_deposit": float(settings.get("min_deposit", "100")),
-        "min_withdraw": float(settings.get("min_withdraw", "100")),
-        "deposit_enabled": settings.get("deposit_enabled", "true").lower() == "true",
-        "withdraw_enabled": settings.get("withdraw_enabled", "true").lower() == "true",
-    }
+# Written through by every commit in this process that changes a
+# balance; the TTL bounds staleness from writes made by other processes.
+BALANCE_CACHE_SIZE = int(os.getenv("BALANCE_CACHE_SIZE", "100000"))
+BALANCE_CACHE_TTL = float(os.getenv("BALANCE_CACHE_TTL", "2"))
+
+balance_cache = TTLCache(BALANCE_CACHE_SIZE, BALANCE_CACHE_TTL)
+
+
+def cache_balances(balances: dict):
+    for user_id, balance in balances.items():
+        balance_cache.set(user_id, float(balance))
 
 
 # -------------------
 # WALLET QUERIES
 # -------------------
+WALLET_BALANCE_SQL = text("SELECT balance FROM wallets WHERE user_id = :u")
+
+
 def get_wallet(user_id: int):
-    with engine.connect() as conn:
-        wallet = conn.execute(
-            text("SELECT balance FROM wallets WHERE user_id = :u"),
-            {"u": user_id}
-        ).fetchone()
+    balance = balance_cache.get(user_id)
+    if balance is not None:
+        return balance
+
+    with read_engine.connect() as conn:
+        wallet = conn.execute(WALLET_BALANCE_SQL, {"u": user_id}).fetchone()
+
+    if not wallet:
+        return None
+
+    # don't overwrite a fresher write-through that raced with this read
+    return balance_cache.add(user_id, float(wallet[0]))
 
-        if not wallet:
-            return None
 
-        return float(wallet[0])
+async def get_wallet_async(user_id: int):
+    balance = balance_cache.get(user_id)
+    if balance is not None:
+        return balance
+
+    async with async_read_engine().connect() as conn:
+        wallet = (await conn.execute(WALLET_BALANCE_SQL, {"u": user_id})).fetchone()
+
+    if not wallet:
+        return None
+
+    return balance_cache.add(user_id, float(wallet[0]))
 
 
 # -------------------
@@ -59,7 +65,7 @@ def credit_wallet(user_id: int, amount: float, tx_type: str, reference: str):
         raise ValueError("Amount must be positive")
 
     with engine.begin() as conn:
-        settings = get_admin_settings(conn)
+        settings = get_settings()
 
         if not settings["deposit_enabled"]:
             raise ValueError("Deposits are disabled")
@@ -98,6 +104,8 @@ def credit_wallet(user_id: int, amount: float, tx_type: str, reference: str):
             {"a": amount, "u": user_id}
         )
 
+    balance_cache.set(user_id, balance_after)
+
 
 # -------------------
 # DEBIT (WITHDRAW / BET)
@@ -107,7 +115,7 @@ def debit_wallet(user_id: int, amount: float, tx_type: str, reference: str):
         raise ValueError("Amount must be positive")
 
     with engine.begin() as conn:
-        settings = get_admin_settings(conn)
+        settings = get_settings()
 
         if not settings["withdraw_enabled"]:
             raise ValueError("Withdrawals are disabled")
@@ -151,35 +159,324 @@ def debit_wallet(user_id: int, amount: float, tx_type: str, reference: str):
             {"a": amount, "u": user_id}
         )
 
+    balance_cache.set(user_id, balance_after)
+
 
 # -------------------
 # PENDING DEPOSIT (M-PESA)
 # -------------------
-def create_pending_deposit(user_id: int, amount: float, reference: str):
-    with engine.begin() as conn:
-        settings = get_admin_settings(conn)
+def create_pending_deposit(user_id: int, phone: str, amount: float):
+    """
+    Records an STK push intent and returns its reference. The ledger
+    row is only written when the callback completes the deposit.
+    """
+    settings = get_settings()
 
-        if not settings["deposit_enabled"]:
-            raise ValueError("Deposits are disabled")
+    if not settings["deposit_enabled"]:
+        raise ValueError("Deposits are disabled")
 
-        if amount < settings["min_deposit"]:
-            raise ValueError("Deposit below minimum")
+    if amount < settings["min_deposit"]:
+        raise ValueError("Deposit below minimum")
 
-        # Get current balance
-        wallet = conn.execute(
-            text("SELECT balance FROM wallets WHERE user_id = :u FOR UPDATE"),
+    with engine.begin() as conn:
+        if not conn.execute(
+            text("SELECT 1 FROM wallets WHERE user_id = :u"),
             {"u": user_id}
-        ).fetchone()
-        
-        if not wallet:
+        ).fetchone():
             raise ValueError("Wallet not found")
-        
-        balance_before = float(wallet[0])
 
-        conn.execute(
+        # AccountReference is limited to 12 characters
+        for _ in range(3):
+            reference = f"stk_{secrets.token_hex(4)}"
+            created = conn.execute(
+                text("""
+                    INSERT INTO mpesa_transactions (user_id, phone, amount, status, reference)
+                    VALUES (:u, :p, :a, 'pending', :r)
+                    ON CONFLICT (reference) DO NOTHING
+                    RETURNING id
+                """),
+                {"u": user_id, "p": phone, "a": amount, "r": reference}
+            ).fetchone()
+
+            if created:
+                return reference
+
+    raise ValueError("Could not allocate a deposit reference")
+
+
+def attach_checkout(reference: str, response: dict):
+    """Stores the STK push ids, or fails the deposit if it was rejected."""
+    checkout_request_id = response.get("CheckoutRequestID")
+
+    with engine.begin() as conn:
+        if checkout_request_id:
+            conn.execute(
+                text("""
+                    UPDATE mpesa_transactions
+                    SET checkout_request_id = :c,
+                        merchant_request_id = :m,
+                        updated_at = NOW()
+                    WHERE reference = :r
+                """),
+                {
+                    "r": reference,
+                    "c": checkout_request_id,
+                    "m": response.get("MerchantRequestID"),
+                }
+            )
+        else:
+            conn.execute(
+                text("""
+                    UPDATE mpesa_transactions
+                    SET status = 'failed',
+                        result_desc = :d,
+                        updated_at = NOW()
+                    WHERE reference = :r
+                    AND status = 'pending'
+                """),
+                {"r": reference, "d": str(response.get("error") or response)[:255]}
+            )
+
+
+# Claims the pending deposit, credits the wallet and writes the ledger
+# row in one statement. Only the first callback finds the row pending;
+# replays and concurrent duplicates wait on its row lock and then match
+# nothing.
+COMPLETE_DEPOSIT_SQL = text("""
+    WITH claimed AS (
+        UPDATE mpesa_transactions
+        SET status = 'completed',
+            mpesa_code = :code,
+            result_code = 0,
+            updated_at = NOW()
+        WHERE status = 'pending'
+        AND (checkout_request_id = :checkout OR reference = :ref)
+        RETURNING user_id, amount, reference
+    ),
+    credited AS (
+        UPDATE wallets w
+        SET balance = w.balance + c.amount,
+            updated_at = NOW()
+        FROM claimed c
+        WHERE w.user_id = c.user_id
+        RETURNING w.user_id, w.balance, c.amount, c.reference
+    )
+    INSERT INTO transactions
+    (user_id, amount, type, balance_before, balance_after, status, reference)
+    SELECT user_id, amount, 'deposit', balance - amount, balance, 'completed', reference
+    FROM credited
+    RETURNING user_id, balance_after
+""")
+
+
+FAIL_DEPOSIT_SQL = text("""
+    UPDATE mpesa_transactions
+    SET status = 'failed',
+        result_code = :rc,
+        result_desc = :d,
+        updated_at = NOW()
+    WHERE checkout_request_id = :c
+    AND status = 'pending'
+""")
+
+
+def _credited(row):
+    if not row:
+        return False
+
+    cache_balances({row[0]: row[1]})
+    return True
+
+
+async def complete_deposit_async(
+    checkout_request_id: str | None, reference: str | None, receipt: str | None
+):
+    """Returns True if this call credited the deposit."""
+    async with async_engine().begin() as conn:
+        row = (await conn.execute(
+            COMPLETE_DEPOSIT_SQL,
+            {"checkout": checkout_request_id, "ref": reference, "code": receipt}
+        )).fetchone()
+
+    return _credited(row)
+
+
+async def fail_deposit_async(
+    checkout_request_id: str | None, result_code: int, result_desc: str | None
+):
+    async with async_engine().begin() as conn:
+        await conn.execute(
+            FAIL_DEPOSIT_SQL,
+            {"c": checkout_request_id, "rc": result_code, "d": result_desc}
+        )
+
+
+# -------------------
+# BULK SETTLEMENT (ENGINE)
+# -------------------
+def settle_bets(round_id: int, winners, lose_remaining: bool = False):
+    """
+    Settles a batch of bets of one round in a single transaction.
+
+    winners is an iterable of (bet_id, cashout_multiplier, payout, kind),
+    kind being "auto_cashout" or "cashout"; it prefixes the ledger
+    reference. The bets are marked won, each user's wallet is credited once with the
+    sum of their payouts and one ledger row is written per bet, all in
+    one set-based statement. With lose_remaining, every bet of the round
+    that is still active is marked lost in the same transaction.
+
+    Returns {user_id: balance_after} for the credited wallets.
+    """
+    bet_ids, multipliers, payouts, kinds = [], [], [], []
+    for bet_id, multiplier, payout, kind in winners:
+        bet_ids.append(int(bet_id))
+        multipliers.append(float(multiplier))
+        payouts.append(float(payout))
+        kinds.append(kind)
+
+    balances = {}
+
+    with engine_game.begin() as conn:
+        if bet_ids:
+            rows = conn.execute(
+                text("""
+                    WITH won AS (
+                        UPDATE bets
+                        SET status = 'won',
+                            cashout_multiplier = v.multiplier,
+                            payout = v.payout
+                        FROM unnest(
+                            CAST(:bet_ids AS BIGINT[]),
+                            CAST(:multipliers AS NUMERIC[]),
+                            CAST(:payouts AS NUMERIC[]),
+                            CAST(:kinds AS TEXT[])
+                        ) AS v(bet_id, multiplier, payout, kind)
+                        WHERE bets.id = v.bet_id
+                        AND bets.round_id = :r
+                        AND bets.status = 'active'
+                        AND bets.created_at >= (
+                            SELECT created_at FROM game_rounds WHERE id = :r
+                        )
+                        RETURNING bets.id, bets.user_id, v.payout, v.kind
+                    ),
+                    credited AS (
+                        UPDATE wallets
+                        SET balance = wallets.balance + per_user.total,
+                            updated_at = NOW()
+                        FROM (
+                            SELECT user_id, SUM(payout) AS total
+                            FROM won
+                            GROUP BY user_id
+                        ) AS per_user
+                        WHERE wallets.user_id = per_user.user_id
+                        RETURNING wallets.user_id, wallets.balance
+                    ),
+                    ledger AS (
+                        INSERT INTO transactions
+                        (user_id, amount, type, balance_before, balance_after, status, reference)
+                        SELECT
+                            w.user_id,
+                            w.payout,
+                            'win',
+                            c.balance - w.later - w.payout,
+                            c.balance - w.later,
+                            'completed',
+                            w.kind || '_' || w.id
+                        FROM (
+                            SELECT id, user_id, payout, kind,
+                                COALESCE(SUM(payout) OVER (
+                                    PARTITION BY user_id ORDER BY id
+                                    ROWS BETWEEN 1 FOLLOWING AND UNBOUNDED FOLLOWING
+                                ), 0) AS later
+                            FROM won
+                        ) AS w
+                        JOIN credited c ON c.user_id = w.user_id
+                    )
+                    SELECT user_id, balance FROM credited
+                """),
+                {
+                    "r": round_id,
+                    "bet_ids": bet_ids,
+                    "multipliers": multipliers,
+                    "payouts": payouts,
+                    "kinds": kinds,
+                }
+            ).fetchall()
+
+            balances = {int(row[0]): float(row[1]) for row in rows}
+
+        if lose_remaining:
+            conn.execute(
+                text("""
+                    UPDATE bets
+                    SET status = 'lost'
+                    WHERE round_id = :r AND status = 'active'
+                    AND created_at >= (
+                        SELECT created_at FROM game_rounds WHERE id = :r
+                    )
+                """),
+                {"r": round_id}
+            )
+
+    cache_balances(balances)
+    return balances
+
+
+def refund_round_bets(round_id: int):
+    """
+    Returns the stakes of a voided round's active bets, one ledger row
+    per bet. Returns {user_id: balance_after}.
+    """
+    with engine_game.begin() as conn:
+        rows = conn.execute(
             text("""
-                INSERT INTO transactions (user_id, amount, type, balance_before, balance_after, status, reference)
-                VALUES (:u, :a, 'deposit', :bb, :bb, 'pending', :r)
+                WITH refunded AS (
+                    UPDATE bets
+                    SET status = 'refunded'
+                    WHERE round_id = :r AND status = 'active'
+                    AND created_at >= (
+                        SELECT created_at FROM game_rounds WHERE id = :r
+                    )
+                    RETURNING id, user_id, bet_amount
+                ),
+                credited AS (
+                    UPDATE wallets
+                    SET balance = wallets.balance + per_user.total,
+                        updated_at = NOW()
+                    FROM (
+                        SELECT user_id, SUM(bet_amount) AS total
+                        FROM refunded
+                        GROUP BY user_id
+                    ) AS per_user
+                    WHERE wallets.user_id = per_user.user_id
+                    RETURNING wallets.user_id, wallets.balance
+                ),
+                ledger AS (
+                    INSERT INTO transactions
+                    (user_id, amount, type, balance_before, balance_after, status, reference)
+                    SELECT
+                        b.user_id,
+                        b.bet_amount,
+                        'bet_refund',
+                        c.balance - b.later - b.bet_amount,
+                        c.balance - b.later,
+                        'completed',
+                        'void_bet_' || b.id
+                    FROM (
+                        SELECT id, user_id, bet_amount,
+                            COALESCE(SUM(bet_amount) OVER (
+                                PARTITION BY user_id ORDER BY id
+                                ROWS BETWEEN 1 FOLLOWING AND UNBOUNDED FOLLOWING
+                            ), 0) AS later
+                        FROM refunded
+                    ) AS b
+                    JOIN credited c ON c.user_id = b.user_id
+                )
+                SELECT user_id, balance FROM credited
             """),
-            {"u": user_id, "a": amount, "bb": balance_before, "r": reference}
-        )
+            {"r": round_id}
+        ).fetchall()
+
+    balances = {int(row[0]): float(row[1]) for row in rows}
+    cache_balances(balances)
+    return balances
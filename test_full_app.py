@@ -12,6 +12,7 @@ import json
 from main import app
 from database import engine
 from services.auth_service import register_user, authenticate_user
+from services.bet_service import bet_buffer
 from services.wallet_service import get_wallet, credit_wallet, debit_wallet
 
 client = TestClient(app)
@@ -23,18 +24,26 @@ client = TestClient(app)
 @pytest.fixture(scope="function", autouse=True)
 def setup_teardown():
     """Setup and teardown for each test"""
-    # Cleanup before test
+    # Cleanup before test; the bet flusher must not write while rows are deleted
+    bet_buffer.stop()
     with engine.begin() as conn:
+        conn.execute(text("DELETE FROM bet_reservations"))
         conn.execute(text("DELETE FROM bets"))
         conn.execute(text("DELETE FROM transactions"))
+        conn.execute(text("DELETE FROM mpesa_transactions"))
+        conn.execute(text("DELETE FROM payouts"))
         conn.execute(text("DELETE FROM wallets"))
         conn.execute(text("DELETE FROM users"))
         conn.commit()
     yield
     # Cleanup after test
+    bet_buffer.stop()
     with engine.begin() as conn:
+        conn.execute(text("DELETE FROM bet_reservations"))
         conn.execute(text("DELETE FROM bets"))
         conn.execute(text("DELETE FROM transactions"))
+        conn.execute(text("DELETE FROM mpesa_transactions"))
+        conn.execute(text("DELETE FROM payouts"))
         conn.execute(text("DELETE FROM wallets"))
         conn.execute(text("DELETE FROM users"))
         conn.commit()
@@ -94,6 +103,27 @@ class TestAuthentication:
         assert response.status_code == 200
         assert "access_token" in response.json()
         assert response.json()["user"]["phone_number"] == test_user["phone"]
+
+    def test_login_token_carries_user_id(self, test_user):
+        """Test that access tokens embed the user id and role"""
+        from jwt_utils import verify_token
+
+        response = client.post("/auth/login", json={
+            "phone": test_user["phone"],
+            "password": test_user["password"]
+        })
+        claims = verify_token(response.json()["access_token"])
+        assert claims["uid"] == response.json()["user"]["id"]
+        assert claims["role"] == "user"
+
+    def test_password_pool_rejects_when_saturated(self):
+        """Test that a full hashing queue fails fast"""
+        from services.password_service import PasswordPool, PasswordServiceBusy, _hash
+
+        pool = PasswordPool(workers=1, max_pending=0, timeout=1)
+        with pytest.raises(PasswordServiceBusy):
+            pool.run(_hash, "secret")
+        assert pool.stats()["rejected"] == 1
     
     def test_login_invalid_credentials(self, test_user):
         """Test login with wrong password"""
@@ -144,6 +174,193 @@ class TestGameRound:
         # Either same round (still running) or new round
         assert round2 >= round1
 
+    def test_recent_rounds_etag(self):
+        """Test that unchanged recent rounds are answered with 304"""
+        response = client.get("/aviator/recent")
+        assert response.status_code == 200
+        assert "recent_rounds" in response.json()
+        etag = response.headers["etag"]
+
+        cached = client.get("/aviator/recent", headers={"If-None-Match": etag})
+        assert cached.status_code == 304
+
+    def test_recent_rounds_push_backfills_empty_buffer(self):
+        """Test that the engine's first push keeps the rounds already in the database"""
+        from services.aviator_service import RecentRounds, get_recent_rounds
+
+        with engine.begin() as conn:
+            round_ids = [
+                conn.execute(text("""
+                    INSERT INTO game_rounds (crash_point, status, created_at, ended_at)
+                    VALUES (1.50, 'crashed', NOW(), NOW())
+                    RETURNING id
+                """)).scalar_one()
+                for _ in range(3)
+            ]
+
+        # the last round has just crashed and is pushed by the engine
+        newest = get_recent_rounds(1)[0]
+        assert newest["round_id"] == round_ids[-1]
+
+        rounds = RecentRounds(5)
+        rounds.push(newest)
+        etag, body = rounds.snapshot()
+        served = [r["round_id"] for r in json.loads(body)["recent_rounds"]]
+
+        assert etag == f'"r{round_ids[-1]}"'
+        assert served[:3] == list(reversed(round_ids))
+        assert len(served) == len(set(served))
+
+    def test_recent_rounds_reload_after_engine_stops(self):
+        """Test that a deposed leader's recent rounds go back to reloading"""
+        from services.aviator_service import RecentRounds
+
+        rounds = RecentRounds(5)
+        rounds.push({"round_id": 10 ** 12})
+        loaded_at = rounds._loaded_at
+
+        # pushed rounds are served without touching the database
+        rounds.snapshot()
+        assert rounds._loaded_at == loaded_at
+
+        rounds.mark_stale()
+        rounds.snapshot()
+        assert rounds._loaded_at > loaded_at
+
+    def test_live_stream_receives_events(self):
+        """Test that engine events reach WebSocket clients"""
+        from services.broadcast_service import broadcaster
+
+        with client.websocket_connect("/ws/aviator") as ws:
+            broadcaster.publish("round_open", round_id=999999)
+            message = ws.receive_json()
+            while message["event"] != "round_open" or message["round_id"] != 999999:
+                message = ws.receive_json()
+            assert "server_time" in message
+
+    def test_hash_chain_links_seeds(self, tmp_path):
+        """Test that each popped seed hashes to the one before it"""
+        from services.hash_chain import HashChain, hash_seed
+
+        chain = HashChain(str(tmp_path), length=100, refill_at=0)
+        first, first_position = chain.pop()
+        second, second_position = chain.pop()
+
+        assert (first_position, second_position) == (0, 1)
+        assert hash_seed(second) == first
+
+    def test_round_seed_reproduces_crash_point(self):
+        """Test that a revealed seed recomputes the stored crash point"""
+        from services.aviator_service import crash_point_from_seed
+        from services.hash_chain import hash_seed
+
+        seed = "00" * 32
+        crash = crash_point_from_seed(seed, 7)
+        assert 1.0 <= crash <= 20.0
+        assert crash == crash_point_from_seed(seed, 7)
+        assert len(hash_seed(seed)) == 64
+
+    def test_rtp_simulator_matches_house_edge(self):
+        """Test that the simulated RTP of the HMAC generator is near 1 - edge"""
+        pytest.importorskip("numpy")
+        from rtp_simulator import simulate
+        from services.provablt_fair import HOUSE_EDGE
+
+        result = simulate(rounds=20000, players=10, seed=1, targets="fixed:1.5")
+        low, high = result["rtp_ci95"]
+        assert low - 0.01 < 1 - HOUSE_EDGE < high + 0.01
+
+    def test_round_creation_is_fenced_by_leader_epoch(self):
+        """Test that a deposed engine leader cannot open rounds"""
+        from services.aviator_service import create_new_round
+        from services.leader_service import LeadershipLost
+
+        with engine.connect() as conn:
+            epoch = conn.execute(
+                text("SELECT epoch FROM engine_leader WHERE id = 1")
+            ).scalar()
+
+        with pytest.raises(LeadershipLost):
+            create_new_round(epoch - 1)
+
+    def test_orphaned_round_is_voided_and_refunded(self, test_user):
+        """Test that a round left behind by a dead leader refunds its bets"""
+        from services.aviator_service import void_active_rounds
+        from services.bet_service import place_bet
+        from services.wallet_service import refund_round_bets
+
+        with engine.begin() as conn:
+            user_id = conn.execute(
+                text("SELECT id FROM users WHERE phone = :p"),
+                {"p": test_user["phone"]}
+            ).scalar()
+            conn.execute(text("""
+                UPDATE game_rounds SET status = 'closed'
+                WHERE status IN ('open', 'running')
+            """))
+            round_id = conn.execute(text("""
+                INSERT INTO game_rounds (crash_point, status, created_at)
+                VALUES (2.00, 'open', NOW())
+                RETURNING id
+            """)).scalar_one()
+
+        credit_wallet(user_id, 1000, "deposit", "ref_void")
+        place_bet(user_id, 200, None)
+        assert get_wallet(user_id) == 800
+
+        assert void_active_rounds() == [round_id]
+        assert refund_round_bets(round_id) == {user_id: 1000}
+        assert refund_round_bets(round_id) == {}
+        assert get_wallet(user_id) == 1000
+
+    def test_failed_round_is_abandoned(self, test_user):
+        """Test that a round whose lifecycle failed is voided so the next can open"""
+        import asyncio
+        from services.aviator_service import abandon_round, crash_round, start_round
+        from services.bet_service import place_bet
+        from services.leader_service import LeadershipLost
+
+        with engine.begin() as conn:
+            user_id = conn.execute(
+                text("SELECT id FROM users WHERE phone = :p"),
+                {"p": test_user["phone"]}
+            ).scalar()
+            epoch = conn.execute(
+                text("SELECT epoch FROM engine_leader WHERE id = 1")
+            ).scalar()
+            conn.execute(text("""
+                UPDATE game_rounds SET status = 'closed'
+                WHERE status IN ('open', 'running')
+            """))
+            round_id = conn.execute(text("""
+                INSERT INTO game_rounds (crash_point, status, created_at)
+                VALUES (2.00, 'open', NOW())
+                RETURNING id
+            """)).scalar_one()
+
+        credit_wallet(user_id, 1000, "deposit", "ref_abandon")
+        place_bet(user_id, 300, None)
+
+        # a deposed leader cannot move the round on
+        with pytest.raises(LeadershipLost):
+            start_round(round_id, epoch - 1)
+
+        asyncio.run(abandon_round(round_id, epoch))
+
+        with engine.connect() as conn:
+            status = conn.execute(
+                text("SELECT status FROM game_rounds WHERE id = :r"),
+                {"r": round_id}
+            ).scalar()
+        assert status == "voided"
+        assert get_wallet(user_id) == 1000
+
+        # nor can the old lifecycle revive a voided round
+        with pytest.raises(RuntimeError):
+            start_round(round_id, epoch)
+        with pytest.raises(RuntimeError):
+            crash_round(round_id, epoch)
+
 
 # ============================================================================
 # WALLET TESTS
@@ -184,6 +401,47 @@ class TestWallet:
         assert response.status_code == 200
         assert response.json()["balance"] == 0
 
+    def test_balance_cache_write_through(self, test_user):
+        """Test that wallet writes refresh the cached balance"""
+        from services.wallet_service import balance_cache
+
+        with engine.connect() as conn:
+            user_id = conn.execute(
+                text("SELECT id FROM users WHERE phone = :p"),
+                {"p": test_user["phone"]}
+            ).scalar()
+
+        assert get_wallet(user_id) == 0
+        credit_wallet(user_id, 2500, "deposit", "ref_cache")
+        assert balance_cache.get(user_id) == 2500
+        debit_wallet(user_id, 500, "withdraw", "ref_cache_out")
+        assert get_wallet(user_id) == 2000
+
+    def test_async_reads_match_sync(self, test_user):
+        """Test that the asyncpg service variants read the same rows"""
+        import asyncio
+        from services.settings_service import get_settings, get_settings_async
+        from services.user_service import get_user_id, get_user_id_async
+        from services.wallet_service import balance_cache, get_wallet_async
+        from database import async_engines, async_read_engines
+
+        user_id = get_user_id(test_user["phone"])
+        credit_wallet(user_id, 750, "deposit", "ref_async")
+        balance_cache.clear()
+
+        async def read():
+            try:
+                return (
+                    await get_user_id_async(test_user["phone"]),
+                    await get_wallet_async(user_id),
+                    await get_settings_async(),
+                )
+            finally:
+                await async_engines.dispose()
+                await async_read_engines.dispose()
+
+        assert asyncio.run(read()) == (user_id, 750, get_settings())
+
 
 # ============================================================================
 # BETTING TESTS
@@ -244,6 +502,162 @@ class TestBetting:
         # The validation happens at service layer
         assert auth_token is not None
 
+    def test_place_bet_is_atomic(self, test_user):
+        """Test that a rejected bet leaves no debit behind"""
+        from services.bet_service import place_bet
+
+        with engine.begin() as conn:
+            user_id = conn.execute(
+                text("SELECT id FROM users WHERE phone = :p"),
+                {"p": test_user["phone"]}
+            ).scalar()
+            conn.execute(text("UPDATE game_rounds SET status = 'closed' WHERE status IN ('open', 'running')"))
+            conn.execute(
+                text("""
+                    INSERT INTO game_rounds (crash_point, status, betting_close_at, created_at)
+                    VALUES (2.5, 'open', NOW() + INTERVAL '10 seconds', NOW())
+                """)
+            )
+        credit_wallet(user_id, 500, "deposit", "ref_atomic")
+
+        with pytest.raises(ValueError, match="Insufficient balance"):
+            place_bet(user_id, 1000, 2.0)
+        assert get_wallet(user_id) == 500
+
+        bet = place_bet(user_id, 200, 2.0)
+        assert bet["balance"] == 300
+        assert get_wallet(user_id) == 300
+
+    def test_buffered_bet_flush(self, test_user):
+        """Test that reserved bets land in bets and release the lock"""
+        from services.bet_service import submit_bet, bet_buffer
+
+        with engine.begin() as conn:
+            user_id = conn.execute(
+                text("SELECT id FROM users WHERE phone = :p"),
+                {"p": test_user["phone"]}
+            ).scalar()
+            conn.execute(text("UPDATE game_rounds SET status = 'closed' WHERE status IN ('open', 'running')"))
+            conn.execute(
+                text("""
+                    INSERT INTO game_rounds (crash_point, status, betting_close_at, created_at)
+                    VALUES (2.5, 'open', NOW() + INTERVAL '10 seconds', NOW())
+                """)
+            )
+        credit_wallet(user_id, 1000, "deposit", "ref_buffer")
+
+        bet = submit_bet(user_id, 400, None)
+        assert bet["balance"] == 600
+        bet_buffer.flush()
+
+        with engine.connect() as conn:
+            stored = conn.execute(
+                text("SELECT user_id, bet_amount FROM bets WHERE id = :b"),
+                {"b": bet["bet_id"]}
+            ).fetchone()
+            locked = conn.execute(
+                text("SELECT locked_balance FROM wallets WHERE user_id = :u"),
+                {"u": user_id}
+            ).scalar()
+        assert stored[0] == user_id and float(stored[1]) == 400
+        assert float(locked) == 0
+
+    def test_refunded_reservation_is_not_flushed(self, test_user):
+        """Test that a flush landing after the round's barrier refund writes nothing"""
+        from services.bet_service import (
+            submit_bet,
+            pending_reservations,
+            release_round_reservations,
+        )
+
+        with engine.begin() as conn:
+            user_id = conn.execute(
+                text("SELECT id FROM users WHERE phone = :p"),
+                {"p": test_user["phone"]}
+            ).scalar()
+            conn.execute(text("UPDATE game_rounds SET status = 'closed' WHERE status IN ('open', 'running')"))
+            conn.execute(
+                text("""
+                    INSERT INTO game_rounds (crash_point, status, betting_close_at, created_at)
+                    VALUES (2.5, 'open', NOW() + INTERVAL '10 seconds', NOW())
+                """)
+            )
+        credit_wallet(user_id, 1000, "deposit", "ref_late_flush")
+
+        # hold the flusher back so the bet stays buffered
+        with bet_buffer._flush_lock:
+            bet = submit_bet(user_id, 300, 2.0)
+            assert pending_reservations(bet["round_id"]) == 1
+            assert release_round_reservations(bet["round_id"]) == {user_id: 1000}
+        bet_buffer.stop()
+
+        with engine.connect() as conn:
+            stored = conn.execute(
+                text("SELECT COUNT(*) FROM bets WHERE id = :b"),
+                {"b": bet["bet_id"]}
+            ).scalar()
+            locked = conn.execute(
+                text("SELECT locked_balance FROM wallets WHERE user_id = :u"),
+                {"u": user_id}
+            ).scalar()
+        assert stored == 0
+        assert float(locked) == 0
+        assert get_wallet(user_id) == 1000
+
+    def test_bulk_settlement(self, test_user):
+        """Test settling winners and losers of a round in one batch"""
+        from services.wallet_service import settle_bets
+
+        with engine.begin() as conn:
+            user_id = conn.execute(
+                text("SELECT id FROM users WHERE phone = :p"),
+                {"p": test_user["phone"]}
+            ).scalar()
+            round_id = conn.execute(
+                text("""
+                    INSERT INTO game_rounds (crash_point, status, created_at)
+                    VALUES (3.0, 'running', NOW())
+                    RETURNING id
+                """)
+            ).scalar()
+            bet_ids = [
+                conn.execute(
+                    text("""
+                        INSERT INTO bets (user_id, round_id, bet_amount, auto_cashout, status)
+                        VALUES (:u, :r, 100, :ac, 'active')
+                        RETURNING id
+                    """),
+                    {"u": user_id, "r": round_id, "ac": ac}
+                ).scalar()
+                for ac in (1.5, 2.0, 5.0)
+            ]
+
+        balances = settle_bets(
+            round_id,
+            [(bet_ids[0], 1.5, 150, "auto_cashout"), (bet_ids[1], 2.0, 200, "cashout")],
+        )
+        assert balances == {user_id: 350}
+
+        settle_bets(round_id, [], lose_remaining=True)
+        with engine.connect() as conn:
+            statuses = conn.execute(
+                text("SELECT status FROM bets WHERE round_id = :r ORDER BY id"),
+                {"r": round_id}
+            ).scalars().all()
+            references = conn.execute(
+                text("SELECT reference FROM transactions WHERE user_id = :u AND type = 'win' ORDER BY reference"),
+                {"u": user_id}
+            ).scalars().all()
+        assert statuses == ["won", "won", "lost"]
+        assert references == [f"auto_cashout_{bet_ids[0]}", f"cashout_{bet_ids[1]}"]
+        assert get_wallet(user_id) == 350
+
+        with engine.begin() as conn:
+            conn.execute(
+                text("UPDATE game_rounds SET status = 'closed' WHERE id = :r"),
+                {"r": round_id}
+            )
+
 
 # ============================================================================
 # ADMIN TESTS
@@ -266,6 +680,66 @@ class TestAdmin:
         response = client.get("/admin/protected")
         assert response.status_code == 401
 
+    def test_settings_update_roundtrip(self):
+        """Test that settings updates are visible through the cache"""
+        from services.settings_service import get_settings, update_settings
+
+        original = get_settings()
+        try:
+            update_settings(50, 75, True, False)
+            assert get_settings() == {
+                "min_deposit": 50.0,
+                "min_withdraw": 75.0,
+                "deposit_enabled": True,
+                "withdraw_enabled": False,
+            }
+        finally:
+            update_settings(**original)
+
+    def test_stats_report_pool_wait_and_tick_lag(self):
+        """Test that admin stats expose DB pool waits and engine tick lag"""
+        from database import pool_stats
+        from services.multiplier_service import TickStats
+
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+        assert pool_stats(engine)["checkouts"] >= 1
+
+        ticks = TickStats(window=10)
+        for lag in (0.001, 0.002, 0.010):
+            ticks.record(lag)
+        snapshot = ticks.snapshot()
+        assert snapshot["ticks"] == 3
+        assert snapshot["lag_max_seconds"] == 0.010
+
+    def test_game_pool_is_separate_from_api_pool(self):
+        """Test that exhausting the API pool leaves the game pool usable"""
+        from database import engine_api, engine_game, pool_config, pool_stats
+
+        capacity = pool_stats(engine_api)["capacity"]
+        held = [engine_api.connect() for _ in range(capacity)]
+        try:
+            assert pool_stats(engine_api)["utilisation"] == 1.0
+            with engine_game.connect() as conn:
+                timeout = conn.execute(text(
+                    "SELECT setting FROM pg_settings WHERE name = 'statement_timeout'"
+                )).scalar()
+            assert int(timeout) == pool_config("game")["statement_timeout"]
+        finally:
+            for conn in held:
+                conn.close()
+
+    def test_metrics_endpoint(self):
+        """Test that /metrics exposes route latency and pool gauges"""
+        client.get("/aviator/round")
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        body = response.text
+        assert 'http_request_duration_seconds_count{method="GET",route="/aviator/round",status="200"}' in body
+        assert 'db_pool_checked_out{engine="api"}' in body
+        assert 'db_pool_utilisation{engine="game"}' in body
+        assert "engine_tick_lag_seconds_bucket" in body
+
 
 # ============================================================================
 # M-PESA WALLET TESTS
@@ -274,6 +748,42 @@ class TestAdmin:
 class TestMpesaWallet:
     """Test M-Pesa integration and wallet deposits/withdrawals"""
     
+    def test_mpesa_token_refresh_is_single_flight(self):
+        """Test concurrent callers share one OAuth round trip"""
+        import threading
+        import time
+        from services.mpesa_service import MpesaClient
+
+        calls = []
+
+        class TokenResponse:
+            def raise_for_status(self):
+                pass
+
+            def json(self):
+                return {"access_token": f"token{len(calls)}", "expires_in": "3599"}
+
+        def fake_get(*args, **kwargs):
+            calls.append(1)
+            time.sleep(0.05)
+            return TokenResponse()
+
+        mpesa = MpesaClient("https://mpesa.invalid", "key", "secret")
+        mpesa.session.get = fake_get
+
+        tokens = []
+        threads = [
+            threading.Thread(target=lambda: tokens.append(mpesa.access_token()))
+            for _ in range(10)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(calls) == 1
+        assert set(tokens) == {"token1"}
+
     def test_stk_push_mock(self, auth_token):
         """Test STK push (deposit) with mock M-Pesa"""
         response = client.post(
@@ -327,6 +837,164 @@ class TestMpesaWallet:
         # Callback should always return 200 to M-Pesa
         assert response.status_code == 200
 
+    def test_stk_callback_replay_credits_once(self, auth_token):
+        """Test that a replayed STK callback does not double-credit"""
+        response = client.post(
+            "/wallet/deposit/stk",
+            json={"amount": 1000},
+            headers={"Authorization": f"Bearer {auth_token}"}
+        )
+        checkout_request_id = response.json()["mpesa"]["CheckoutRequestID"]
+
+        callback_payload = {
+            "Body": {
+                "stkCallback": {
+                    "MerchantRequestID": "test123",
+                    "CheckoutRequestID": checkout_request_id,
+                    "ResultCode": 0,
+                    "ResultDesc": "Success",
+                    "CallbackMetadata": {
+                        "Item": [
+                            {"Name": "Amount", "Value": 1000},
+                            {"Name": "MpesaReceiptNumber", "Value": "TEST123"},
+                        ]
+                    }
+                }
+            }
+        }
+        for _ in range(3):
+            assert client.post("/mpesa/stk/callback", json=callback_payload).status_code == 200
+
+        balance = client.get(
+            "/wallet/balance",
+            headers={"Authorization": f"Bearer {auth_token}"}
+        ).json()["balance"]
+        assert balance == 1000
+
+    def test_withdraw_is_queued_and_rejection_refunds(self, auth_token):
+        """Test that withdrawals are queued, submitted once and refunded on rejection"""
+        from services.payout_service import (
+            claim_payouts,
+            handle_result,
+            mark_submitted,
+            submit_payout,
+        )
+
+        with engine.begin() as conn:
+            user_id = conn.execute(
+                text("SELECT id FROM users LIMIT 1")
+            ).scalar()
+        credit_wallet(user_id, 5000, "deposit", "ref_payout")
+        headers = {"Authorization": f"Bearer {auth_token}"}
+
+        first = client.post("/wallet/withdraw/mpesa", json={"amount": 1000}, headers=headers).json()
+        second = client.post("/wallet/withdraw/mpesa", json={"amount": 1000}, headers=headers).json()
+        assert first["status"] == "queued"
+        assert second["balance"] == 3000
+
+        claimed = claim_payouts(10)
+        assert sorted(p[0] for p in claimed) == sorted([first["payout_id"], second["payout_id"]])
+        assert claim_payouts(10) == []
+
+        # the mock settles the first payout immediately
+        submit_payout(next(p for p in claimed if p[0] == first["payout_id"]))
+        status = client.get(f"/wallet/withdraw/{first['payout_id']}", headers=headers).json()
+        assert status["status"] == "completed"
+
+        mark_submitted(second["payout_id"], "AG_test_conversation", f"payout_{second['payout_id']}")
+        rejected = {
+            "Result": {
+                "ResultCode": 2001,
+                "ResultDesc": "The initiator information is invalid.",
+                "OriginatorConversationID": f"payout_{second['payout_id']}",
+            }
+        }
+
+        # the originator id is guessable and is not enough to refund
+        handle_result(rejected)
+        status = client.get(f"/wallet/withdraw/{second['payout_id']}", headers=headers).json()
+        assert status["status"] == "submitted"
+
+        rejected["Result"]["ConversationID"] = "AG_test_conversation"
+        for _ in range(2):
+            handle_result(rejected)
+
+        status = client.get(f"/wallet/withdraw/{second['payout_id']}", headers=headers).json()
+        assert status["status"] == "refunded"
+        assert get_wallet(user_id) == 4000
+
+    def test_unknown_payout_outcome_is_reconciled_not_refunded(self, auth_token, monkeypatch):
+        """Test that a payout whose request may have reached M-Pesa is resolved by a status query"""
+        from services import payout_service
+
+        with engine.begin() as conn:
+            user_id = conn.execute(
+                text("SELECT id FROM users LIMIT 1")
+            ).scalar()
+        credit_wallet(user_id, 5000, "deposit", "ref_reconcile")
+        headers = {"Authorization": f"Bearer {auth_token}"}
+
+        payout = client.post("/wallet/withdraw/mpesa", json={"amount": 1000}, headers=headers).json()
+        monkeypatch.setattr(
+            payout_service,
+            "b2c_withdraw",
+            lambda *args: {"error": "Read timed out", "unknown_outcome": True},
+        )
+        payout_service.submit_payout(payout_service.claim_payouts(10)[0])
+
+        status = client.get(f"/wallet/withdraw/{payout['payout_id']}", headers=headers).json()
+        assert status["status"] == "needs_reconcile"
+        assert get_wallet(user_id) == 4000
+
+        with engine.begin() as conn:
+            conn.execute(text("UPDATE payouts SET next_attempt_at = NOW()"))
+        claimed = payout_service.claim_payouts(10)
+        assert [p[5] for p in claimed] == ["needs_reconcile"]
+
+        # the mock status query reports the payment as completed
+        payout_service.reconcile_payout(claimed[0])
+        status = client.get(f"/wallet/withdraw/{payout['payout_id']}", headers=headers).json()
+        assert status["status"] == "completed"
+        assert get_wallet(user_id) == 4000
+
+    def test_status_query_error_does_not_resubmit(self, auth_token, monkeypatch):
+        """Test that only a not-found status result requeues a reconciling payout"""
+        from services import payout_service
+
+        with engine.begin() as conn:
+            user_id = conn.execute(
+                text("SELECT id FROM users LIMIT 1")
+            ).scalar()
+        credit_wallet(user_id, 5000, "deposit", "ref_status_error")
+        headers = {"Authorization": f"Bearer {auth_token}"}
+
+        payout = client.post("/wallet/withdraw/mpesa", json={"amount": 1000}, headers=headers).json()
+        monkeypatch.setattr(
+            payout_service,
+            "b2c_withdraw",
+            lambda *args: {"error": "Read timed out", "unknown_outcome": True},
+        )
+        payout_service.submit_payout(payout_service.claim_payouts(10)[0])
+        payout_service.record_status_query(payout["payout_id"], "AG_status_query")
+
+        failed_query = {
+            "Result": {
+                "ResultCode": 2001,
+                "ResultDesc": "The initiator information is invalid.",
+                "ConversationID": "AG_status_query",
+            }
+        }
+        payout_service.handle_status_result(failed_query)
+        status = client.get(f"/wallet/withdraw/{payout['payout_id']}", headers=headers).json()
+        assert status["status"] == "needs_reconcile"
+
+        not_found = next(iter(payout_service.PAYOUT_NOT_FOUND_RESULT_CODES))
+        failed_query["Result"]["ResultCode"] = not_found
+        payout_service.handle_status_result(failed_query)
+        status = client.get(f"/wallet/withdraw/{payout['payout_id']}", headers=headers).json()
+        assert status["status"] == "queued"
+        assert get_wallet(user_id) == 4000
+
 
 # ============================================================================
 # INTEGRATION TESTS
@@ -408,6 +1076,143 @@ class TestIntegration:
         assert all("round_id" in r for r in responses)
 
 
+# ============================================================================
+# ROUND ORDER BOOK TESTS
+# ============================================================================
+
+class TestRoundOrderBook:
+    """Test in-memory auto-cashout order book"""
+
+    def test_advance_yields_each_bet_once(self):
+        """Test that ticks only return newly triggered bets"""
+        from services.order_book import RoundOrderBook
+
+        book = RoundOrderBook(1, [
+            (10, 1, 100, 3.0),
+            (11, 2, 200, 1.5),
+            (12, 3, 300, 1.5),
+        ])
+
+        assert book.advance(1.2) == []
+        assert [b[0] for b in book.advance(1.6)] == [11, 12]
+        assert book.advance(1.6) == []
+        assert [b[0] for b in book.advance(5.0)] == [10]
+        assert book.pending == 0
+
+    def test_manual_cashout_uses_current_multiplier(self):
+        """Test manual cashouts settle once, at the current tick"""
+        from services.order_book import RoundOrderBook
+
+        book = RoundOrderBook(1, [
+            (10, 1, 100, None),
+            (11, 1, 100, 3.0),
+            (12, 2, 100, None),
+        ])
+        book.advance(1.8)
+
+        entries = book.cash_out(1)
+        assert sorted((e[0], e[3]) for e in entries) == [(10, 1.8), (11, 1.8)]
+        assert book.drain_cashouts() == entries
+        assert book.advance(5.0) == []
+
+        with pytest.raises(ValueError):
+            book.cash_out(1)
+
+        book.close()
+        with pytest.raises(ValueError):
+            book.cash_out(2)
+
+    def test_multiplier_curve_is_time_based(self):
+        """Test the curve is monotonic and reaches the crash at crash_elapsed"""
+        from services.multiplier_service import crash_elapsed, multiplier_at
+
+        assert multiplier_at(0) == 1.0
+        samples = [multiplier_at(t / 10) for t in range(200)]
+        assert samples == sorted(samples)
+
+        crash_time = crash_elapsed(2.5)
+        assert multiplier_at(crash_time - 0.05) < 2.5
+        assert multiplier_at(crash_time + 0.05) >= 2.5
+
+    def test_cashout_without_running_round(self, auth_token):
+        """Test cashout endpoint rejects when no round is flying"""
+        response = client.post(
+            "/aviator/cashout",
+            json={},
+            headers={"Authorization": f"Bearer {auth_token}"}
+        )
+        assert response.status_code == 400
+
+
+# ============================================================================
+# PARTITIONING TESTS
+# ============================================================================
+
+class TestPartitioning:
+    """Test monthly partitions of the ledger tables"""
+
+    def test_partitions_cover_upcoming_months(self):
+        """Test that init creates partitioned tables with future months"""
+        from database import (
+            init_db_schema,
+            list_partitions,
+            month_start,
+            add_months,
+            PARTITION_MONTHS_AHEAD,
+        )
+
+        init_db_schema()
+        horizon = add_months(month_start(), PARTITION_MONTHS_AHEAD + 1)
+
+        with engine.connect() as conn:
+            for table in ("bets", "transactions"):
+                relkind = conn.execute(
+                    text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:t)"),
+                    {"t": table}
+                ).scalar()
+                assert relkind == "p"
+
+                uppers = [u for _, _, u in list_partitions(conn, table) if u]
+                assert max(uppers) >= horizon
+
+                # inserts past the last month land in the default partition
+                assert conn.execute(
+                    text("SELECT to_regclass(:t)"),
+                    {"t": f"{table}_default"}
+                ).scalar() is not None
+
+    def test_expired_partition_is_archived(self):
+        """Test that retention detaches old months next to the default partition"""
+        from datetime import timezone
+        from database import create_month_partition, list_partitions
+        from services.partition_service import (
+            LEDGER_ARCHIVE_SCHEMA,
+            archive_expired_partitions,
+        )
+
+        old_month = datetime(2000, 1, 1, tzinfo=timezone.utc)
+        with engine.begin() as conn:
+            if any(lower is None for _, lower, _ in list_partitions(conn, "bets")):
+                pytest.skip("a pre-partitioning legacy table covers old months")
+            create_month_partition(conn, "bets", old_month)
+
+        try:
+            assert "bets_p2000_01" in archive_expired_partitions(1)
+            with engine.connect() as conn:
+                names = [name for name, _, _ in list_partitions(conn, "bets")]
+                archived = conn.execute(
+                    text("SELECT to_regclass(:t)"),
+                    {"t": f"{LEDGER_ARCHIVE_SCHEMA}.bets_p2000_01"}
+                ).scalar()
+            assert "bets_p2000_01" not in names
+            assert archived is not None
+        finally:
+            with engine.begin() as conn:
+                conn.execute(text(
+                    f"DROP TABLE IF EXISTS {LEDGER_ARCHIVE_SCHEMA}.bets_p2000_01"
+                ))
+
+
 # ============================================================================
 # HEALTH CHECK
 # ============================================================================